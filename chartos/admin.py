@@ -0,0 +1,61 @@
+import asyncio
+import hmac
+import threading
+from typing import Optional
+
+import yaml
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from pydantic import ValidationError
+
+from .reload import ConfigReloader
+from .settings import Settings, get_settings
+from .utils import SamplingProfiler
+
+
+router = APIRouter()
+
+
+async def check_admin_token(
+        x_admin_token: Optional[str] = Header(None),
+        settings: Settings = Depends(get_settings),
+):
+    if settings.admin_token is None:
+        raise HTTPException(status_code=404, detail={"details": "Admin endpoints are disabled"})
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail={"details": "Invalid admin token"})
+
+
+@router.post(
+    "/admin/profile",
+    dependencies=[Depends(check_admin_token)],
+    response_class=PlainTextResponse,
+)
+async def profile(
+        seconds: float = Query(10, gt=0, le=300),
+        interval: float = Query(0.005, ge=0.001, le=1),
+):
+    """
+    Profiles the worker handling the request for some time, by sampling the stack
+    of its event loop. The result uses the collapsed stack format of flame graph tools.
+    """
+    profiler = SamplingProfiler(threading.get_ident(), interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    return PlainTextResponse(profiler.collapsed())
+
+
+@router.post("/admin/reload", dependencies=[Depends(check_admin_token)])
+async def reload_config(reloader: ConfigReloader = Depends(ConfigReloader.get)):
+    """
+    Reloads the layer configuration of all workers. The cached tiles of views
+    whose definition changed are dropped, other views keep their cache.
+    """
+    try:
+        changed = await reloader.reload(publish=True)
+    except (OSError, yaml.YAMLError, ValidationError, KeyError, ValueError) as err:
+        raise HTTPException(status_code=400, detail={"details": f"Invalid configuration: {err}"})
+    return {"changed_views": [{"layer": layer.name, "view": view.name} for layer, view in changed]}
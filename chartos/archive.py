@@ -0,0 +1,295 @@
+"""
+Tile archive writers, used to export a whole tile pyramid as a single file.
+
+Both writers keep their state on disk, so that memory usage doesn't depend
+on the number of tiles being written.
+"""
+
+import os
+import gzip
+import json
+import shutil
+import sqlite3
+import struct
+import hashlib
+import tempfile
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .layer_cache import AffectedTile
+from .disk_cache import MBTILES_SCHEMA, tms_row
+
+
+WEB_MERCATOR_MAX_LAT = 85.0511287798
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def read_file_chunks(path: str) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK_SIZE):
+            yield chunk
+
+
+class TileArchiveWriter(ABC):
+    media_type: str
+    extension: str
+
+    def __init__(self, metadata: Dict[str, Any], minzoom: int, maxzoom: int):
+        self.metadata = metadata
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        self.workdir = tempfile.mkdtemp(prefix="chartos_export_")
+
+    @abstractmethod
+    def add_tile(self, tile: AffectedTile, data: bytes):
+        raise NotImplementedError
+
+    @abstractmethod
+    def finish(self) -> Iterator[bytes]:
+        """Finalizes the archive, and returns an iterator over its content"""
+        raise NotImplementedError
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class MBTilesWriter(TileArchiveWriter):
+    media_type = "application/vnd.mapbox-vector-tile+sqlite3"
+    extension = "mbtiles"
+
+    def __init__(self, metadata: Dict[str, Any], minzoom: int, maxzoom: int):
+        super().__init__(metadata, minzoom, maxzoom)
+        self.path = os.path.join(self.workdir, "tiles.mbtiles")
+        # writers are created and used in a thread of their own
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=OFF;")
+        self.conn.execute("PRAGMA synchronous=OFF;")
+        for statement in MBTILES_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.execute("BEGIN;")
+
+    def add_tile(self, tile: AffectedTile, data: bytes):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?);",
+            (tile.z, tile.x, tms_row(tile), data),
+        )
+
+    def finish(self) -> Iterator[bytes]:
+        entries = {
+            "name": self.metadata["name"],
+            "minzoom": str(self.minzoom),
+            "maxzoom": str(self.maxzoom),
+            "bounds": f"-180,{-WEB_MERCATOR_MAX_LAT},180,{WEB_MERCATOR_MAX_LAT}",
+            "json": json.dumps({"vector_layers": self.metadata["vector_layers"]}),
+        }
+        self.conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?);", entries.items())
+        self.conn.execute("COMMIT;")
+        self.conn.close()
+        return read_file_chunks(self.path)
+
+
+def rotate(n: int, x: int, y: int, rx: int, ry: int) -> Tuple[int, int]:
+    if ry == 0:
+        if rx == 1:
+            x = n - 1 - x
+            y = n - 1 - y
+        return y, x
+    return x, y
+
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    """Computes the position of a tile along the pmtiles hilbert curve"""
+    acc = ((1 << (z * 2)) - 1) // 3
+    s = (1 << z) // 2
+    d = 0
+    while s > 0:
+        rx = 1 if (x & s) > 0 else 0
+        ry = 1 if (y & s) > 0 else 0
+        d += s * s * ((3 * rx) ^ ry)
+        x, y = rotate(s, x, y, rx, ry)
+        s //= 2
+    return acc + d
+
+
+def write_varint(buf: bytearray, value: int):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+# (tile_id, offset, length, run_length)
+Entry = Tuple[int, int, int, int]
+
+
+def serialize_directory(entries: List[Entry]) -> bytes:
+    buf = bytearray()
+    write_varint(buf, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(buf, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(buf, run_length)
+    for _, _, length, _ in entries:
+        write_varint(buf, length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        if i > 0:
+            _, prev_offset, prev_length, _ = entries[i - 1]
+            if offset == prev_offset + prev_length:
+                write_varint(buf, 0)
+                continue
+        write_varint(buf, offset + 1)
+    return gzip.compress(bytes(buf))
+
+
+class PMTilesWriter(TileArchiveWriter):
+    """
+    Writes version 3 pmtiles archives. Tile data is appended to a temporary
+    file as it comes, and directory entries are kept in a temporary sqlite
+    database until the archive is finalized, as they must be sorted.
+    """
+
+    media_type = "application/vnd.pmtiles"
+    extension = "pmtiles"
+
+    HEADER_SIZE = 127
+    ROOT_MAX_SIZE = 16384 - HEADER_SIZE
+    # pmtiles enum values
+    COMPRESSION_NONE = 1
+    COMPRESSION_GZIP = 2
+    TILE_TYPE_MVT = 1
+
+    def __init__(self, metadata: Dict[str, Any], minzoom: int, maxzoom: int):
+        super().__init__(metadata, minzoom, maxzoom)
+        self.data_path = os.path.join(self.workdir, "data")
+        self.data_file = open(self.data_path, "wb")
+        self.data_size = 0
+        self.entries = sqlite3.connect(
+            os.path.join(self.workdir, "entries.sqlite"), isolation_level=None, check_same_thread=False)
+        self.entries.execute("PRAGMA journal_mode=OFF;")
+        self.entries.execute("PRAGMA synchronous=OFF;")
+        self.entries.execute(
+            "CREATE TABLE entries (tile_id integer PRIMARY KEY, offset integer, length integer, hash blob);"
+        )
+        self.entries.execute("BEGIN;")
+
+    def add_tile(self, tile: AffectedTile, data: bytes):
+        self.entries.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?);",
+            (
+                zxy_to_tile_id(tile.z, tile.x, tile.y),
+                self.data_size,
+                len(data),
+                hashlib.blake2b(data, digest_size=16).digest(),
+            ),
+        )
+        self.data_file.write(data)
+        self.data_size += len(data)
+
+    def iter_entries(self) -> Iterator[Entry]:
+        """Iterates on sorted entries, merging runs of consecutive identical tiles"""
+        run = None
+        run_hash = None
+        for tile_id, offset, length, data_hash in self.entries.execute(
+            "SELECT tile_id, offset, length, hash FROM entries ORDER BY tile_id;"
+        ):
+            if run is not None and data_hash == run_hash and tile_id == run[0] + run[3]:
+                run = (run[0], run[1], run[2], run[3] + 1)
+                continue
+            if run is not None:
+                yield run
+            run = (tile_id, offset, length, 1)
+            run_hash = data_hash
+        if run is not None:
+            yield run
+
+    def build_directories(self, leaf_size: int, leaves_path: str) -> Tuple[bytes, int, int]:
+        """Returns the root directory, the number of addressed tiles and tile entries"""
+        addressed_tiles = 0
+        entry_count = 0
+        root_entries: List[Entry] = []
+        leaf_entries: List[Entry] = []
+        leaves_size = 0
+
+        with open(leaves_path, "wb") as leaves_file:
+            def flush_leaf():
+                nonlocal leaves_size
+                leaf = serialize_directory(leaf_entries)
+                root_entries.append((leaf_entries[0][0], leaves_size, len(leaf), 0))
+                leaves_file.write(leaf)
+                leaves_size += len(leaf)
+                leaf_entries.clear()
+
+            for entry in self.iter_entries():
+                addressed_tiles += entry[3]
+                entry_count += 1
+                leaf_entries.append(entry)
+                if len(leaf_entries) == leaf_size:
+                    flush_leaf()
+            if leaf_entries:
+                flush_leaf()
+
+        return serialize_directory(root_entries), addressed_tiles, entry_count
+
+    def finish(self) -> Iterator[bytes]:
+        self.data_file.close()
+        self.entries.execute("COMMIT;")
+        (row_count,) = self.entries.execute("SELECT count(*) FROM entries;").fetchone()
+
+        # try to fit all entries in the root directory, and
+        # use bigger and bigger leaf directories otherwise
+        leaves_path = os.path.join(self.workdir, "leaves")
+        root = None
+        if row_count <= 16384:
+            entries = list(self.iter_entries())
+            root = serialize_directory(entries)
+            addressed_tiles = sum(entry[3] for entry in entries)
+            entry_count = len(entries)
+            open(leaves_path, "wb").close()
+        leaf_size = 4096
+        while root is None or len(root) > self.ROOT_MAX_SIZE:
+            root, addressed_tiles, entry_count = self.build_directories(leaf_size, leaves_path)
+            leaf_size *= 2
+        self.entries.close()
+
+        metadata = gzip.compress(json.dumps(self.metadata).encode())
+        leaves_size = os.path.getsize(leaves_path)
+
+        root_offset = self.HEADER_SIZE
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + leaves_size
+        header = struct.pack(
+            "<7sB8Q3Q6B4iB2i",
+            b"PMTiles", 3,
+            root_offset, len(root),
+            metadata_offset, len(metadata),
+            leaves_offset, leaves_size,
+            data_offset, self.data_size,
+            # each entry references distinct tile data
+            addressed_tiles, entry_count, entry_count,
+            0,  # tile data isn't clustered, as tiles are written in rendering order
+            self.COMPRESSION_GZIP,
+            self.COMPRESSION_NONE,
+            self.TILE_TYPE_MVT,
+            self.minzoom, self.maxzoom,
+            -180 * 10_000_000, int(-WEB_MERCATOR_MAX_LAT * 10_000_000),
+            180 * 10_000_000, int(WEB_MERCATOR_MAX_LAT * 10_000_000),
+            self.minzoom, 0, 0,
+        )
+        assert len(header) == self.HEADER_SIZE
+
+        def content() -> Iterator[bytes]:
+            yield header
+            yield root
+            yield metadata
+            yield from read_file_chunks(leaves_path)
+            yield from read_file_chunks(self.data_path)
+        return content()
+
+
+ARCHIVE_WRITERS = {
+    "mbtiles": MBTilesWriter,
+    "pmtiles": PMTilesWriter,
+}
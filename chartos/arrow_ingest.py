@@ -0,0 +1,190 @@
+import io
+from typing import Dict, List, Set
+
+import asyncpg
+import shapely.wkb
+from fastapi import HTTPException
+
+from .config import Field, GeomField, JsonField, Layer
+from .layer_cache import AffectedTile, find_affected_tiles
+from .tile_index import find_indexed_tiles, insert_tile_index_rows
+
+try:
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+ARROW_STREAM_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+STAGING_TABLE = "chartos_arrow_staging"
+
+
+def staging_column_type(field: Field) -> str:
+    # geometries are loaded as hex encoded WKB, and json as text, and converted when moved to the layer table
+    if isinstance(field.type, (GeomField, JsonField)):
+        return "text"
+    return field.pg_type()
+
+
+def staged_wkb(field: Field) -> str:
+    return f"decode({field.pg_name()}, 'hex')"
+
+
+def select_staged(field: Field) -> str:
+    if isinstance(field.type, GeomField):
+        return f"ST_Transform(ST_SetSRID(ST_GeomFromWKB({staged_wkb(field)}), 4326), 3857)"
+    if isinstance(field.type, JsonField):
+        return f"{field.pg_name()}::jsonb"
+    return field.pg_name()
+
+
+def hex_column(column: "pyarrow.Array") -> "pyarrow.Array":
+    """
+    Encodes a binary column as hex text, without going through python objects.
+    Postgresql CSV can't hold raw bytes, and the CSV writer only writes valid UTF-8.
+    """
+    column = column.cast(pyarrow.large_binary())
+    _, offsets_buffer, data = column.buffers()
+    offsets = pyarrow.Array.from_buffers(pyarrow.int64(), len(column) + 1, [None, offsets_buffer], offset=column.offset)
+    start, end = offsets[0].as_py(), offsets[-1].as_py()
+    hex_data = b"" if data is None else data[start:end].hex()
+    hex_offsets = pyarrow.compute.multiply(pyarrow.compute.subtract(offsets, start), 2)
+    hexed = pyarrow.Array.from_buffers(
+        pyarrow.large_string(), len(column), [None, hex_offsets.buffers()[1], pyarrow.py_buffer(hex_data)])
+    if column.null_count:
+        hexed = pyarrow.compute.if_else(column.is_null(), pyarrow.scalar(None, pyarrow.large_string()), hexed)
+    return hexed
+
+
+def encode_staged_batch(batch: "pyarrow.RecordBatch") -> "pyarrow.RecordBatch":
+    columns = [
+        hex_column(column)
+        if pyarrow.types.is_binary(column.type) or pyarrow.types.is_large_binary(column.type)
+        else column
+        for column in batch.columns
+    ]
+    return pyarrow.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+async def copy_batch(psql, batch: "pyarrow.RecordBatch"):
+    """Copies a record batch into the staging table, as CSV written by arrow"""
+    batch = encode_staged_batch(batch)
+    if any(pyarrow.types.is_nested(column.type) for column in batch.columns):
+        # arrays can't be written as CSV, and are converted by asyncpg instead
+        await psql.copy_records_to_table(
+            STAGING_TABLE,
+            records=zip(*(column.to_pylist() for column in batch.columns)),
+            columns=batch.schema.names,
+        )
+        return
+    csv_data = io.BytesIO()
+    # nulls are written as empty unquoted values, and empty strings as quoted values, as postgresql expects
+    pyarrow.csv.write_csv(batch, csv_data, pyarrow.csv.WriteOptions(include_header=False))
+    csv_data.seek(0)
+    await psql.copy_to_table(STAGING_TABLE, source=csv_data, columns=batch.schema.names, format="csv")
+
+
+def resolve_columns(layer: Layer, column_names: List[str]) -> List[Field]:
+    fields = []
+    for column_name in column_names:
+        field = layer.fields.get(column_name)
+        if field is None:
+            raise HTTPException(status_code=400, detail={
+                "details": f"Unknown field name `{column_name}`",
+                "choices": list(layer.fields.keys()),
+            })
+        fields.append(field)
+    missing_field_names = layer.validator.mandatory_field_names - set(column_names)
+    if missing_field_names:
+        raise HTTPException(status_code=400, detail={
+            "details": f"Field `{next(iter(missing_field_names))}` is mandatory.",
+            "choices": column_names,
+        })
+    return fields
+
+
+async def insert_arrow_payload(
+        psql,
+        layer: Layer,
+        version: str,
+        payload: bytes,
+        max_zoom: int,
+) -> Dict[Field, Set[AffectedTile]]:
+    """
+    Inserts an Arrow IPC stream into a layer version, and returns the affected tiles.
+    Geometry columns are WKB in EPSG:4326, and json columns hold json text.
+    Record batches are copied into a temporary staging table, which is then moved
+    into the layer table by a single query, so that geometries are never decoded in python.
+    This must run inside a transaction.
+    """
+    if pyarrow is None:
+        raise HTTPException(status_code=415, detail={
+            "details": "Arrow payloads aren't supported, as pyarrow isn't installed",
+        })
+
+    try:
+        reader = pyarrow.ipc.open_stream(payload)
+    except pyarrow.ArrowInvalid as err:
+        raise HTTPException(status_code=400, detail={"details": f"Invalid Arrow stream: {err}"})
+
+    column_names = reader.schema.names
+    fields = resolve_columns(layer, column_names)
+    staging_columns = ", ".join(f"{field.pg_name()} {staging_column_type(field)}" for field in fields)
+    await psql.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} ({staging_columns}) ON COMMIT DROP")
+    field_names = ", ".join(field.pg_name() for field in fields)
+    try:
+        for batch in reader:
+            await copy_batch(psql, batch)
+        await psql.execute(
+            f"INSERT INTO {layer.pg_table_name()} (version, {field_names}) "
+            f"SELECT $1, {', '.join(map(select_staged, fields))} FROM {STAGING_TABLE}",
+            version,
+        )
+    except pyarrow.ArrowInvalid as err:
+        raise HTTPException(status_code=400, detail={"details": f"Invalid Arrow stream: {err}"})
+    except asyncpg.DataError as err:
+        # values which don't fit the type of their field
+        raise HTTPException(status_code=400, detail={"details": f"Invalid value: {err}"})
+
+    viewed_fields = layer.get_viewed_fields()
+    if layer.tile_index_zoom is not None:
+        staged_viewed_fields = [field for field in fields if field in viewed_fields]
+        return await index_staged_features(psql, layer, version, staged_viewed_fields, max_zoom)
+
+    # compute the tiles affected by the new geometries, using a single collection per field
+    affected_tiles: Dict[Field, Set[AffectedTile]] = {}
+    for field in fields:
+        if field not in viewed_fields:
+            continue
+        collection = await psql.fetchval(
+            f"SELECT ST_AsBinary(ST_Collect(ST_GeomFromWKB({staged_wkb(field)}))) FROM {STAGING_TABLE}")
+        if collection is None:
+            continue
+        affected_tiles[field] = set(find_affected_tiles(max_zoom, shapely.wkb.loads(collection)))
+    return affected_tiles
+
+
+async def index_staged_features(
+        psql,
+        layer: Layer,
+        version: str,
+        viewed_fields: List[Field],
+        max_zoom: int,
+) -> Dict[Field, Set[AffectedTile]]:
+    """Fills the tile index with the staged features, and returns the affected tiles"""
+    assert layer.tile_index_zoom is not None
+    id_field_name = layer.id_field.pg_name()
+    affected_tiles: Dict[Field, Set[AffectedTile]] = {}
+    index_rows = []
+    for field in viewed_fields:
+        field_affected_tiles = affected_tiles[field] = set()
+        staged_features = await psql.fetch(
+            f"SELECT {id_field_name}, {staged_wkb(field)} FROM {STAGING_TABLE} WHERE {field.pg_name()} IS NOT NULL")
+        for feature_id, wkb in staged_features:
+            tiles, quadkeys = find_indexed_tiles(max_zoom, layer.tile_index_zoom, shapely.wkb.loads(wkb))
+            field_affected_tiles.update(tiles)
+            index_rows.extend((version, feature_id, field.name, quadkey) for quadkey in quadkeys)
+    await insert_tile_index_rows(psql, layer, index_rows)
+    return affected_tiles
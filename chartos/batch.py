@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import struct
+from typing import AsyncIterator, List, Tuple
+
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from .config import Config, get_config
+from .settings import Settings, get_settings
+from .psql import PSQLReadPool
+from .redis import RedisPool
+from .disk_cache import DiskTileCache
+from .render import render_tile
+from .render_scheduler import RenderScheduler, RenderUnavailable
+from .memory_render import MemoryLayerStore
+from .tile_refresher import TileRefresher
+from .generations import check_cache_generation, check_public_version
+from .layer_cache import AffectedTile, get_view_cache_prefix, load_cached_tiles, store_cached_tile
+
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+
+MAX_BATCH_TILES = 1000
+
+# each tile of a batch response is preceded by a frame header:
+# zoom (u8), status (u8), x (u32), y (u32), tile length (u32), all big endian
+FRAME_HEADER = struct.Struct(">BBIII")
+FRAME_OK = 0
+# the tile couldn't be rendered right now, and must be fetched again later
+FRAME_UNAVAILABLE = 1
+# the tile failed to render. other tiles of the batch are still sent
+FRAME_ERROR = 2
+
+
+def encode_frame(tile: AffectedTile, status: int, tile_data: bytes) -> bytes:
+    return FRAME_HEADER.pack(tile.z, status, tile.x, tile.y, len(tile_data)) + tile_data
+
+
+def parse_tiles(raw_tiles: List[Tuple[int, int, int]], max_zoom: int) -> List[AffectedTile]:
+    if len(raw_tiles) > MAX_BATCH_TILES:
+        raise HTTPException(status_code=400, detail={
+            "details": f"Batches can't have more than {MAX_BATCH_TILES} tiles",
+        })
+    tiles = []
+    for z, x, y in raw_tiles:
+        if not 0 <= z <= max_zoom or not 0 <= x < 1 << z or not 0 <= y < 1 << z:
+            raise HTTPException(status_code=400, detail={"details": f"Invalid tile {z}/{x}/{y}"})
+        tiles.append(AffectedTile(x, y, z))
+    # remove duplicates, keeping the order
+    return list(dict.fromkeys(tiles))
+
+
+@router.post("/tiles/{layer_slug}/{view_slug}/batch")
+async def batch_tiles(
+        layer_slug: str,
+        view_slug: str,
+        version: str = Query(...),
+        raw_tiles: List[Tuple[int, int, int]] = Body(..., description="a list of [z, x, y] tiles"),
+        config: Config = Depends(get_config),
+        settings: Settings = Depends(get_settings),
+        read_pool: PSQLReadPool = Depends(PSQLReadPool.get_pool),
+        redis=Depends(RedisPool.get),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
+        scheduler: RenderScheduler = Depends(RenderScheduler.get),
+        memory_store: MemoryLayerStore = Depends(MemoryLayerStore.get),
+        refresher: TileRefresher = Depends(TileRefresher.get),
+):
+    """
+    Fetches many tiles of a view at once. The response is a stream of frames, each made of a
+    13 bytes header (zoom u8, status u8, x u32, y u32, length u32, big endian) followed by the tile.
+    Cached tiles come first, and others follow as they are rendered. A status of 1 means the
+    tile couldn't be rendered right now, and must be fetched again later, and a status of 2
+    means the tile failed to render.
+    """
+    layer = config.layers[layer_slug]
+    view = layer.views[view_slug]
+    tiles = parse_tiles(raw_tiles, settings.max_zoom)
+    check_public_version(version)
+    await check_cache_generation(redis, layer, version)
+    view_cache_prefix = get_view_cache_prefix(layer, version, view)
+
+    cached_tiles = await load_cached_tiles(redis, view, view_cache_prefix, tiles)
+    missing_tiles = []
+    cached_frames = []
+    for tile, (tile_data, is_stale) in zip(tiles, cached_tiles):
+        if tile_data is None:
+            missing_tiles.append(tile)
+            continue
+        if is_stale:
+            await refresher.refresh(redis, layer, version, view, tile)
+        cached_frames.append(encode_frame(tile, FRAME_OK, tile_data))
+
+    async def load_missing_tile(tile: AffectedTile) -> bytes:
+        tile_data = await disk_cache.read_tile(layer, version, view, tile)
+        if tile_data is None:
+            tile_data = await render_tile(
+                read_pool, scheduler, redis, layer, version, view, tile, memory_store=memory_store)
+            await disk_cache.write_tile(layer, version, view, tile, tile_data)
+        await store_cached_tile(redis, view, view_cache_prefix, tile, tile_data)
+        return tile_data
+
+    async def stream_frames() -> AsyncIterator[bytes]:
+        if cached_frames:
+            yield b"".join(cached_frames)
+        async for tile, status, tile_data in load_tiles(missing_tiles, load_missing_tile, settings.batch_concurrency):
+            yield encode_frame(tile, status, tile_data)
+
+    return StreamingResponse(stream_frames(), media_type="application/octet-stream")
+
+
+async def load_tiles(
+        tiles: List[AffectedTile],
+        load_tile,
+        concurrency: int,
+) -> AsyncIterator[Tuple[AffectedTile, int, bytes]]:
+    """Loads tiles with bounded concurrency, yielding them with their frame status as they complete"""
+    pending = iter(tiles)
+    running = {}
+
+    def start_next():
+        tile = next(pending, None)
+        if tile is not None:
+            running[asyncio.create_task(load_tile(tile))] = tile
+
+    for _ in range(concurrency):
+        start_next()
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tile = running.pop(task)
+                start_next()
+                status, tile_data = FRAME_OK, b""
+                try:
+                    tile_data = task.result()
+                except RenderUnavailable:
+                    status = FRAME_UNAVAILABLE
+                except Exception:
+                    # a failed tile doesn't end the response, which would lose the tiles after it
+                    logger.exception("failed to load tile %s/%s/%s", tile.z, tile.x, tile.y)
+                    status = FRAME_ERROR
+                yield tile, status, tile_data
+    finally:
+        for task in running:
+            task.cancel()
@@ -1,12 +1,21 @@
 import yaml
+import json
 import string
 import typing
+import hashlib
 from abc import ABC, abstractmethod
 from typing import Optional, List, Iterator, TypeVar, Dict, Type, Literal, Union, ClassVar, Generator, Tuple
 from enum import IntEnum, auto
 from dataclasses import dataclass, field
+from functools import cached_property
 from chartos.utils import PeekableIterator, ValueDependable
-from chartos.serialized_config import SerializedConfig, SerializedLayer, SerializedView, SerializedField
+from chartos.serialized_config import (
+    SerializedConfig,
+    SerializedLayer,
+    SerializedView,
+    SerializedField,
+    SerializedJsonProjection,
+)
 from collections import defaultdict
 from shapely.geometry import shape
 
@@ -15,6 +24,9 @@ get_config = ValueDependable("get_config")
 
 
 class FieldType(ABC):
+    # the types of the json values accepted for this field, or None if anything goes
+    json_types: ClassVar[Optional[Tuple[type, ...]]] = None
+
     @property
     @abstractmethod
     def pg_type(self) -> str:
@@ -45,6 +57,14 @@ class Field:
     def pg_name(self) -> str:
         return f'"{self.name}"'
 
+    def pg_4326_name(self) -> str:
+        """The generated column holding the geometry in EPSG:4326"""
+        return f'"{self.name}_4326"'
+
+    def pg_is_collection_name(self) -> str:
+        """The generated column telling whether the geometry is a collection"""
+        return f'"{self.name}_is_collection"'
+
     def pg_type(self) -> str:
         return self.type.pg_type
 
@@ -54,37 +74,203 @@ class Field:
         return json_data
 
 
+JSON_PATH_ELEMENT_CHARS = set(string.ascii_letters + string.digits + "_-")
+
+
+@dataclass(frozen=True, eq=True)
+class JsonProjection:
+    """A value extracted from a json field, which becomes a typed tile attribute"""
+    name: str
+    field: Field
+    path: Tuple[str, ...]
+    type: FieldType
+    description: str = ""
+
+    @staticmethod
+    def parse(layer_fields: Dict[str, Field], raw_config: SerializedJsonProjection) -> "JsonProjection":
+        field_name, *path = raw_config.path.split(".")
+        field = layer_fields[field_name]
+        if not isinstance(field.type, JsonField):
+            raise ValueError(f"can't project {raw_config.path}: {field_name} isn't a json field")
+        if not path:
+            raise ValueError(f"can't project {raw_config.path}: the path is empty")
+        for path_element in path:
+            if not path_element or not set(path_element) <= JSON_PATH_ELEMENT_CHARS:
+                raise ValueError(f"invalid json path element: {path_element!r}")
+        projection_type = TypeParser.parse_str(raw_config.type)
+        if not isinstance(projection_type, JSON_PROJECTION_TYPES):
+            raise ValueError(f"can't project {raw_config.path} as {raw_config.type}")
+        return JsonProjection(
+            raw_config.name or raw_config.path,
+            field,
+            tuple(path),
+            projection_type,
+            raw_config.description,
+        )
+
+    def pg_name(self) -> str:
+        return f'"{self.name}"'
+
+    def pg_value(self) -> str:
+        """
+        The projected value. Json values of the wrong type, or out of the range of the
+        projection type, become NULL instead of failing the whole tile query
+        """
+        pg_path = "'{" + ",".join(self.path) + "}'"
+        json_value = f"({self.field.pg_name()} #> {pg_path})"
+        text_value = f"({self.field.pg_name()} #>> {pg_path})"
+        if isinstance(self.type, JsonField):
+            return f"{json_value}::text"
+        if isinstance(self.type, BoolField):
+            return f"(CASE WHEN jsonb_typeof({json_value}) = 'boolean' THEN {text_value}::boolean END)"
+        if isinstance(self.type, (IntField, BigIntField, DoubleField)):
+            min_value, max_value = JSON_PROJECTION_RANGES[type(self.type)]
+            number = f"{json_value}::numeric"
+            in_range = f"{number} BETWEEN {min_value} AND {max_value}"
+            if not isinstance(self.type, DoubleField):
+                in_range += f" AND {number} = trunc({number})"
+            # conditions of a CASE are evaluated in order, unlike operands of AND
+            return (
+                f"(CASE WHEN jsonb_typeof({json_value}) = 'number' THEN "
+                f"CASE WHEN {in_range} THEN {text_value}::{self.type.pg_type} END END)"
+            )
+        # any json value has a text representation
+        return f"{text_value}::{self.type.pg_type}"
+
+    def pg_select(self) -> str:
+        return f"{self.pg_value()} AS {self.pg_name()}"
+
+
 @dataclass
 class View:
     name: str
     on_field: Field
     fields: List[Field]
     cache_duration: int
+    max_stale: Optional[int] = None
+    json_projections: List[JsonProjection] = field(default_factory=list)
+    cluster_below_zoom: Optional[int] = None
+    cluster_grid_size: int = 256
+
+    def is_clustered(self, z: int) -> bool:
+        return self.cluster_below_zoom is not None and z < self.cluster_below_zoom
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """A hash of what the view renders. It is part of the cache namespace of the view"""
+        definition = [
+            [self.on_field.name, self.on_field.pg_type()],
+            [[view_field.name, view_field.pg_type()] for view_field in self.fields],
+            [
+                [projection.name, projection.field.name, projection.path, projection.type.pg_type]
+                for projection in self.json_projections
+            ],
+            self.cluster_below_zoom,
+            self.cluster_grid_size,
+        ]
+        return hashlib.sha256(json.dumps(definition).encode()).hexdigest()[:16]
 
     @staticmethod
     def parse(layer_fields: Dict[str, Field], raw_config: SerializedView) -> "View":
         resolved_on_field = layer_fields[raw_config.on_field]
-        view_fields = (
-            raw_config.fields
-            if raw_config.fields is not None
-            else list(layer_fields.keys())
-        )
+        json_projections = [
+            JsonProjection.parse(layer_fields, raw_projection)
+            for raw_projection in raw_config.json_projections
+        ]
+        projected_fields = {projection.field.name for projection in json_projections}
+        if raw_config.fields is not None:
+            view_fields = list(raw_config.fields)
+        else:
+            # json fields which values are projected are only included on demand
+            view_fields = [name for name in layer_fields.keys() if name not in projected_fields]
         if raw_config.exclude_fields is not None:
             for excluded_field in raw_config.exclude_fields:
-                view_fields.remove(excluded_field)
+                if excluded_field in view_fields:
+                    view_fields.remove(excluded_field)
+                # excluding projected fields is allowed, as they were included before projections
+                elif excluded_field not in projected_fields:
+                    raise ValueError(f"{raw_config.name} excludes {excluded_field}, which isn't one of its fields")
 
         resolved_fields = [layer_fields[name] for name in view_fields]
+        attribute_names = set(view_fields)
+        for projection in json_projections:
+            if projection.name in attribute_names:
+                raise ValueError(f"the json projection {projection.name} of {raw_config.name} is already a field")
+            attribute_names.add(projection.name)
         cache_duration = raw_config.cache_duration
         if cache_duration is None:
             cache_duration = 3600
+        if raw_config.cluster_grid_size <= 0:
+            raise ValueError(f"the cluster grid size of {raw_config.name} must be positive")
         return View(
             raw_config.name,
             resolved_on_field,
             resolved_fields,
             cache_duration,
+            raw_config.max_stale,
+            json_projections,
+            raw_config.cluster_below_zoom,
+            raw_config.cluster_grid_size,
         )
 
 
+class PayloadError(ValueError):
+    def __init__(self, row_index: int, details: str, choices: Optional[List[str]] = None):
+        super().__init__(f"row {row_index}: {details}")
+        self.row_index = row_index
+        self.details = details
+        self.choices = choices
+
+
+class PayloadValidator:
+    """
+    Checks rows pushed to a layer. All the lookup tables are built once per layer,
+    so that checking a row is mostly a few set operations.
+    """
+
+    def __init__(self, layer: "Layer"):
+        self.field_names = frozenset(layer.fields.keys())
+        self.mandatory_field_names = frozenset(
+            [layer.id_field.name, *(view.on_field.name for view in layer.views.values())])
+        self.field_json_types = {
+            name: layer_field.type.json_types
+            for name, layer_field in layer.fields.items()
+            if layer_field.type.json_types is not None
+        }
+        self.point_field_names = frozenset(
+            name for name, layer_field in layer.fields.items() if isinstance(layer_field.type, PointField))
+
+    def validate(self, rows: List[Dict], first_row_index: int = 0):
+        """Raises a PayloadError about the first invalid row"""
+        field_names = self.field_names
+        mandatory_field_names = self.mandatory_field_names
+        field_json_types = self.field_json_types
+        point_field_names = self.point_field_names
+        for row_index, row in enumerate(rows, first_row_index):
+            if type(row) is not dict:
+                raise PayloadError(row_index, "Rows must be objects")
+            row_field_names = row.keys()
+            if not row_field_names <= field_names:
+                unknown_field_name = next(iter(row_field_names - field_names))
+                raise PayloadError(
+                    row_index, f"Unknown field name `{unknown_field_name}`", sorted(field_names))
+            if not mandatory_field_names <= row_field_names:
+                missing_field_name = next(iter(mandatory_field_names - row_field_names))
+                raise PayloadError(
+                    row_index, f"Field `{missing_field_name}` is mandatory.", list(row_field_names))
+            for field_name, value in row.items():
+                json_types = field_json_types.get(field_name)
+                # type() rather than isinstance, as booleans are integers
+                if json_types is not None and value is not None and type(value) not in json_types:
+                    raise PayloadError(
+                        row_index,
+                        f"Field `{field_name}` expects {' or '.join(t.__name__ for t in json_types)}, "
+                        f"got {type(value).__name__}",
+                    )
+                if field_name in point_field_names and value is not None and value.get("type") != "Point":
+                    raise PayloadError(row_index, f"Field `{field_name}` expects a Point geometry")
+
+
 @dataclass
 class Layer:
     name: str
@@ -93,10 +279,19 @@ class Layer:
     views: Dict[str, View]
     description: Optional[str] = None
     attribution: Optional[str] = None
+    tile_index_zoom: Optional[int] = None
+    render_in_memory: bool = False
+    validator: PayloadValidator = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.validator = PayloadValidator(self)
 
     def pg_table_name(self):
         return self.name
 
+    def pg_tile_index_table_name(self):
+        return f"{self.name}_tile_index"
+
     @staticmethod
     def parse(raw_config: SerializedLayer) -> "Layer":
         parsed_fields = map(Field.parse, raw_config.fields)
@@ -104,6 +299,13 @@ class Layer:
         parsed_views = (View.parse(fields, view) for view in raw_config.views)
         views = {view.name: view for view in parsed_views}
         id_field = fields[raw_config.id_field_name]
+        # quadkeys must fit in a bigint
+        if raw_config.tile_index_zoom is not None and not 0 <= raw_config.tile_index_zoom <= 30:
+            raise ValueError(f"the tile index zoom of {raw_config.name} must be between 0 and 30")
+        # tiles rendered in memory only match postgis for points
+        if raw_config.render_in_memory and not all(
+                isinstance(view.on_field.type, PointField) for view in views.values()):
+            raise ValueError(f"{raw_config.name} can only be rendered in memory if all its views are on point fields")
         return Layer(
             raw_config.name,
             id_field,
@@ -111,6 +313,8 @@ class Layer:
             views,
             description=raw_config.description,
             attribution=raw_config.attribution,
+            tile_index_zoom=raw_config.tile_index_zoom,
+            render_in_memory=raw_config.render_in_memory,
         )
 
     def pg_schema(self):
@@ -136,6 +340,16 @@ class Layer:
         )
         return f"({fields_sig})"
 
+    def get_projected_geom_fields(self) -> List[Field]:
+        """The geometry fields selected by views, which have a generated EPSG:4326 column"""
+        projected_fields = {
+            view_field
+            for view in self.views.values()
+            for view_field in view.fields
+            if isinstance(view_field.type, GeomField)
+        }
+        return sorted(projected_fields, key=lambda projected_field: projected_field.name)
+
     def get_viewed_fields(self) -> Dict[Field, View]:
         indexed_geo_fields: Dict[Field, View] = defaultdict(list)
         for view in self.views.values():
@@ -162,6 +376,7 @@ class Config:
 
 @dataclass(frozen=True, eq=True)
 class TextField(FieldType):
+    json_types = (str,)
     pg_type = "varchar"
 
 
@@ -172,26 +387,31 @@ class JsonField(FieldType):
 
 @dataclass(frozen=True, eq=True)
 class IntField(FieldType):
+    json_types = (int,)
     pg_type = "integer"
 
 
 @dataclass(frozen=True, eq=True)
 class BoolField(FieldType):
+    json_types = (bool,)
     pg_type = "boolean"
 
 
 @dataclass(frozen=True, eq=True)
 class BigIntField(FieldType):
+    json_types = (int,)
     pg_type = "bigint"
 
 
 @dataclass(frozen=True, eq=True)
 class DoubleField(FieldType):
+    json_types = (float, int)
     pg_type = "double precision"
 
 
 @dataclass(frozen=True, eq=True)
 class StringField(FieldType):
+    json_types = (str,)
     max_len: Optional[int] = None
 
     @property
@@ -203,6 +423,7 @@ class StringField(FieldType):
 
 @dataclass(frozen=True, eq=True)
 class CharField(FieldType):
+    json_types = (str,)
     max_len: Optional[int] = None
 
     def __post_init__(self) -> None:
@@ -217,6 +438,7 @@ class CharField(FieldType):
 
 @dataclass(frozen=True, eq=True)
 class ArrayField(FieldType):
+    json_types = (list,)
     of: Optional[FieldType] = None
 
     def __post_init__(self) -> None:
@@ -230,11 +452,18 @@ class ArrayField(FieldType):
 
 @dataclass(frozen=True, eq=True)
 class GeomField(FieldType):
+    json_types = (dict,)
     pg_type = "geometry(Geometry, 3857)"
 
 
+@dataclass(frozen=True, eq=True)
+class PointField(GeomField):
+    pg_type = "geometry(Point, 3857)"
+
+
 @dataclass(frozen=True, eq=True)
 class TimestampField(FieldType):
+    json_types = (str,)
     pg_type = 'timestamp with time zone'
 
 
@@ -372,6 +601,15 @@ def lex(stream: PeekableIterator[str]) -> Iterator[Tok]:
         yield tok
 
 
+# the types json values can be projected to
+JSON_PROJECTION_TYPES = (TextField, StringField, CharField, IntField, BigIntField, DoubleField, BoolField, JsonField)
+JSON_PROJECTION_RANGES = {
+    IntField: (-2 ** 31, 2 ** 31 - 1),
+    BigIntField: (-2 ** 63, 2 ** 63 - 1),
+    DoubleField: ("-1.7976931348623157e308", "1.7976931348623157e308"),
+}
+
+
 FIELD_TYPES: Dict[str, Type[FieldType]] = {
     "text": TextField,
     "char": CharField,
@@ -383,6 +621,7 @@ FIELD_TYPES: Dict[str, Type[FieldType]] = {
     "json": JsonField,
     "array": ArrayField,
     "geom": GeomField,
+    "point": PointField,
     "timestamp": TimestampField,
 }
 
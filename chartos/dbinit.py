@@ -1,6 +1,10 @@
+import asyncio
+import hashlib
 import asyncpg
+from dataclasses import dataclass
+from typing import List, Optional, Set
 from fastapi import FastAPI
-from .config import Layer
+from .config import Field, Layer
 from .utils import AsyncProcess, process_dependable
 
 
@@ -31,37 +35,205 @@ tilebbox_func = """
 """
 
 
-async def init_layer(conn, layer: Layer):
+# the morton code of a tile, as computed by tile_index.get_quadkey
+tilequadkey_func = """
+    create or replace function TileQuadkey (x bigint, y bigint)
+        returns bigint
+        language plpgsql immutable as
+    $func$
+    declare
+        quadkey bigint := 0;
+    begin
+        for i in 0..29 loop
+            quadkey := quadkey | (((x >> i) & 1) << (2 * i)) | (((y >> i) & 1) << (2 * i + 1));
+        end loop;
+        return quadkey;
+    end;
+    $func$
+"""
+
+
+def layer_ddl(layer: Layer) -> List[str]:
     table_name = layer.pg_table_name()
+    statements = []
 
     # create the table if it doesn't exist
-    query = f"CREATE TABLE IF NOT EXISTS {table_name} {layer.pg_table_sig()};"
-    await conn.execute(query)
+    statements.append(f"CREATE TABLE IF NOT EXISTS {table_name} {layer.pg_table_sig()};")
 
     # add the missing columns
     cols = ", ".join(
         f"ADD COLUMN IF NOT EXISTS {pg_name} {pg_type}"
         for _, pg_name, pg_type in layer.pg_schema()
     )
-    await conn.execute(f"ALTER TABLE {table_name} {cols};")
+    statements.append(f"ALTER TABLE {table_name} {cols};")
+
+    # add generated columns, so that renders neither check geometry types nor reproject geometries
+    geo_fields = sorted({view.on_field.name for view in layer.views.values()})
+    generated_cols = [
+        *(
+            f"ADD COLUMN IF NOT EXISTS {layer.fields[name].pg_is_collection_name()} boolean "
+            f"GENERATED ALWAYS AS (ST_GeometryType({layer.fields[name].pg_name()}) = 'ST_GeometryCollection') STORED"
+            for name in geo_fields
+        ),
+        *(
+            f"ADD COLUMN IF NOT EXISTS {projected_field.pg_4326_name()} geometry(Geometry, 4326) "
+            f"GENERATED ALWAYS AS (ST_Transform({projected_field.pg_name()}, 4326)) STORED"
+            for projected_field in layer.get_projected_geom_fields()
+        ),
+    ]
+    if generated_cols:
+        statements.append(f"ALTER TABLE {table_name} {', '.join(generated_cols)};")
 
     # add indexes on geographic fields used in views
-    geo_fields = {view.on_field for view in layer.views.values()}
-    for geo_field in geo_fields:
+    for geo_field_name in geo_fields:
+        geo_field = layer.fields[geo_field_name]
         index_name = f"{table_name}_{geo_field.name}_spgist"
-        await conn.execute(
+        statements.append(
             f'CREATE INDEX IF NOT EXISTS "{index_name}" ON {table_name} '
             f'USING SPGIST ({geo_field.pg_name()});'
         )
     # add the version index
-    await conn.execute(
+    statements.append(
         f"CREATE INDEX IF NOT EXISTS {table_name}_version "
         f"ON {table_name} (\"version\");"
     )
+    # used by feature queries, which are ordered and paginated by id
+    statements.append(
+        f"CREATE INDEX IF NOT EXISTS {table_name}_version_id "
+        f"ON {table_name} (\"version\", {layer.id_field.pg_name()});"
+    )
+    return statements
+
+
+def tile_index_ddl(layer: Layer) -> List[str]:
+    index_table_name = layer.pg_tile_index_table_name()
+    return [
+        f"CREATE TABLE IF NOT EXISTS {index_table_name} ("
+        "version varchar NOT NULL, "
+        f"feature_id {layer.id_field.pg_type()} NOT NULL, "
+        "field varchar NOT NULL, "
+        "quadkey bigint NOT NULL);",
+        # used by tile queries
+        f"CREATE INDEX IF NOT EXISTS {index_table_name}_quadkey "
+        f"ON {index_table_name} (version, field, quadkey);",
+        # used by deletions
+        f"CREATE INDEX IF NOT EXISTS {index_table_name}_feature "
+        f"ON {index_table_name} (version, feature_id);",
+        # the index is rebuilt from existing rows when it is created, or when its zoom changes
+        f"TRUNCATE {index_table_name};",
+        *(
+            tile_index_backfill(layer, view.on_field)
+            for view in {view.on_field.name: view for view in layer.views.values()}.values()
+        ),
+    ]
+
+
+def tile_index_backfill(layer: Layer, geo_field: Field) -> str:
+    """
+    Indexes the existing features of a layer in the tiles they touch at the index zoom.
+    It only runs on migrations, as ingestion indexes new features. Like ingestion
+    (see tile_index.find_indexed_tiles), it intersects EPSG:4326 geometries with tiles
+    """
+    assert layer.tile_index_zoom is not None
+    index_zoom = layer.tile_index_zoom
+    tile_count = 1 << index_zoom
+    tile_size = f"(40075016.68 / {tile_count})"
+    # the candidate tiles are the tiles of the bounding box of the feature
+    bounds = f"t.{geo_field.pg_name()}"
+    return (
+        f"INSERT INTO {layer.pg_tile_index_table_name()} (version, feature_id, field, quadkey) "
+        f"SELECT t.version, t.{layer.id_field.pg_name()}, '{geo_field.name}', TileQuadkey(tile_x, tile_y) "
+        f"FROM {layer.pg_table_name()} t, "
+        f"LATERAL generate_series("
+        f"greatest(0, floor((ST_XMin({bounds}) + 20037508.34) / {tile_size})::bigint), "
+        f"least({tile_count - 1}, floor((ST_XMax({bounds}) + 20037508.34) / {tile_size})::bigint)) AS tile_x, "
+        f"LATERAL generate_series("
+        f"greatest(0, floor((20037508.34 - ST_YMax({bounds})) / {tile_size})::bigint), "
+        f"least({tile_count - 1}, floor((20037508.34 - ST_YMin({bounds})) / {tile_size})::bigint)) AS tile_y "
+        f"WHERE t.{geo_field.pg_name()} IS NOT NULL "
+        f"AND ST_Intersects(t.{geo_field.pg_4326_name()}, TileBBox({index_zoom}, tile_x::int, tile_y::int, 4326));"
+    )
+
+
+@dataclass
+class SchemaObject:
+    """A set of DDL statements, which only need to run when they change"""
+    name: str
+    statements: List[str]
+    # if the relation goes missing, the statements are run again
+    relation: Optional[str] = None
+    # objects are migrated by increasing stage, as they may use objects of previous stages
+    stage: int = 0
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha256("\n".join(self.statements).encode()).hexdigest()
+
+    @property
+    def lock_key(self) -> int:
+        digest = hashlib.sha256(f"chartos.schema.{self.name}".encode()).digest()
+        return int.from_bytes(digest[:8], "big", signed=True)
+
+
+SCHEMA_TABLE = "chartos_schema"
+SCHEMA_TABLE_LOCK_KEY = SchemaObject(SCHEMA_TABLE, []).lock_key
+
+
+def schema_objects(config) -> List[SchemaObject]:
+    objects = [
+        SchemaObject("function:TileBBox", [tilebbox_func]),
+        SchemaObject("function:TileQuadkey", [tilequadkey_func]),
+    ]
+    for layer in config.layers.values():
+        objects.append(SchemaObject(f"layer:{layer.name}", layer_ddl(layer), layer.pg_table_name()))
+        if layer.tile_index_zoom is not None:
+            objects.append(SchemaObject(
+                f"tile_index:{layer.name}", tile_index_ddl(layer), layer.pg_tile_index_table_name(), stage=1))
+    return objects
+
+
+async def init_schema_table(conn):
+    if await conn.fetchval("SELECT to_regclass($1::text) IS NOT NULL;", SCHEMA_TABLE):
+        return
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1);", SCHEMA_TABLE_LOCK_KEY)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} "
+            "(name varchar PRIMARY KEY, fingerprint varchar NOT NULL);"
+        )
+
+
+async def find_up_to_date(conn, objects: List[SchemaObject]) -> Set[str]:
+    """Returns the names of objects whose fingerprint matches the database"""
+    query = (
+        "SELECT o.name FROM unnest($1::varchar[], $2::varchar[], $3::varchar[]) "
+        "AS o(name, fingerprint, relation) "
+        f"JOIN {SCHEMA_TABLE} s ON s.name = o.name AND s.fingerprint = o.fingerprint "
+        "WHERE o.relation IS NULL OR to_regclass(o.relation) IS NOT NULL;"
+    )
+    rows = await conn.fetch(
+        query,
+        [obj.name for obj in objects],
+        [obj.fingerprint for obj in objects],
+        [obj.relation for obj in objects],
+    )
+    return {name for (name,) in rows}
 
-    # add the TileBBox utility
-    await conn.execute(tilebbox_func)
 
+async def apply_schema_object(conn, obj: SchemaObject):
+    async with conn.transaction():
+        # only one worker migrates a given object, the others wait
+        # and find the fingerprint up to date once they get the lock
+        await conn.execute("SELECT pg_advisory_xact_lock($1);", obj.lock_key)
+        if obj.name in await find_up_to_date(conn, [obj]):
+            return
+        for statement in obj.statements:
+            await conn.execute(statement)
+        await conn.execute(
+            f"INSERT INTO {SCHEMA_TABLE} (name, fingerprint) VALUES ($1, $2) "
+            "ON CONFLICT (name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint;",
+            obj.name, obj.fingerprint,
+        )
 
 
 class DBInit(AsyncProcess):
@@ -69,13 +241,31 @@ class DBInit(AsyncProcess):
         self.config = config
         self.psql_pool = psql_pool
 
-    async def on_startup(self):
+    async def migrate(self, obj: SchemaObject):
         async with self.psql_pool.acquire() as conn:
             try:
-                for layer in self.config.layers.values():
-                    await init_layer(conn, layer)
+                await apply_schema_object(conn, obj)
             finally:
                 await conn.reload_schema_state()
 
+    async def on_startup(self):
+        await self.apply(self.config)
+
+    async def apply(self, config):
+        """Runs the DDL of the schema objects which changed, and makes the configuration current"""
+        objects = schema_objects(config)
+        async with self.psql_pool.acquire() as conn:
+            await init_schema_table(conn)
+            up_to_date = await find_up_to_date(conn, objects)
+
+        # independent objects are migrated concurrently
+        for stage in sorted({obj.stage for obj in objects}):
+            await asyncio.gather(*(
+                self.migrate(obj)
+                for obj in objects
+                if obj.stage == stage and obj.name not in up_to_date
+            ))
+        self.config = config
+
     async def on_shutdown(self):
         pass
@@ -0,0 +1,297 @@
+import os
+import glob
+import math
+import time
+import fcntl
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Set
+from urllib.parse import quote as url_quote
+
+from .config import Layer, View
+from .layer_cache import AffectedTile
+from .generations import get_cache_generation
+from .utils import AsyncProcess, process_dependable
+
+
+logger = logging.getLogger(__name__)
+
+
+MBTILES_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS metadata (name text PRIMARY KEY, value text);",
+    "CREATE TABLE IF NOT EXISTS tiles ("
+    "zoom_level integer, tile_column integer, tile_row integer, tile_data blob, "
+    "PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;",
+    "INSERT OR IGNORE INTO metadata VALUES ('format', 'pbf');",
+)
+# tiles expire like their redis copy, after the cache duration of their view. this column
+# isn't part of the mbtiles schema, and is added to files created before it existed
+EXPIRES_AT_COLUMN = "expires_at"
+# held by the worker purging the files of a cache directory
+PURGE_LOCK_FILE = ".purge.lock"
+
+
+def tms_row(tile: AffectedTile) -> int:
+    """mbtiles uses the TMS scheme, where the y axis is flipped"""
+    return (1 << tile.z) - 1 - tile.y
+
+
+class DiskTileCache(AsyncProcess):
+    """
+    An optional on-disk tile cache, which sits between redis and postgresql.
+    Tiles are stored in one mbtiles file per (layer, version, view), which
+    is read through a memory map. Each thread keeps at most max_open_files
+    files open. When no path is configured, all operations are no-ops.
+    Every purge_interval seconds, expired tiles are deleted, and when the tiles
+    take more than max_size bytes, the tiles closest to their expiration go too.
+    """
+
+    def __init__(
+            self,
+            root: Optional[str],
+            mmap_size: int,
+            max_open_files: int = 64,
+            max_workers: int = 4,
+            max_size: Optional[int] = None,
+            purge_interval: float = 300,
+    ):
+        self.root = root
+        self.mmap_size = mmap_size
+        self.max_open_files = max_open_files
+        self.max_workers = max_workers
+        self.max_size = max_size
+        self.purge_interval = purge_interval
+        self.purge_task: Optional[asyncio.Task] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.local = threading.local()
+        # the connections of all threads, which are closed on shutdown
+        self.connections: Set[sqlite3.Connection] = set()
+        self.connections_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    async def on_startup(self):
+        if not self.enabled:
+            return
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="disk_cache")
+        self.purge_task = asyncio.create_task(self.purge_loop())
+
+    async def on_shutdown(self):
+        if self.purge_task is not None:
+            self.purge_task.cancel()
+            await asyncio.gather(self.purge_task, return_exceptions=True)
+            self.purge_task = None
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=True)
+        self.executor = None
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
+    @process_dependable
+    async def get(self) -> "DiskTileCache":
+        yield self
+
+    def layer_path(self, layer: Layer, version: str, generation: Optional[int] = None) -> str:
+        assert self.root is not None
+        if generation is None:
+            generation = get_cache_generation(layer, version)
+        # the version is user provided, and must not be allowed to escape the cache directory
+        version_dir = f"version_{url_quote(version, safe='')}"
+        if generation == 0:
+            return os.path.join(self.root, layer.name, version_dir)
+        return os.path.join(self.root, layer.name, f"generation_{generation}", version_dir)
+
+    def view_path(self, layer: Layer, version: str, view: View, generation: Optional[int] = None) -> str:
+        return os.path.join(self.layer_path(layer, version, generation), f"{view.name}.{view.fingerprint}.mbtiles")
+
+    def _connect(self, path: str, create: bool) -> Optional[sqlite3.Connection]:
+        """Returns the connection of the current thread to a given tile file"""
+        thread_conns = getattr(self.local, "conns", None)
+        if thread_conns is None:
+            # the least recently used connections come first
+            thread_conns = self.local.conns = OrderedDict()
+
+        conn = thread_conns.get(path)
+        if conn is not None:
+            thread_conns.move_to_end(path)
+            return conn
+
+        if not os.path.exists(path):
+            if not create:
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)};")
+        for statement in MBTILES_SCHEMA:
+            conn.execute(statement)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(tiles);")}
+        if EXPIRES_AT_COLUMN not in columns:
+            conn.execute(f"ALTER TABLE tiles ADD COLUMN {EXPIRES_AT_COLUMN} integer;")
+        thread_conns[path] = conn
+        with self.connections_lock:
+            self.connections.add(conn)
+
+        while len(thread_conns) > self.max_open_files:
+            _, evicted_conn = thread_conns.popitem(last=False)
+            with self.connections_lock:
+                self.connections.discard(evicted_conn)
+            evicted_conn.close()
+        return conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _read_tile(self, path: str, tile: AffectedTile) -> Optional[bytes]:
+        conn = self._connect(path, create=False)
+        if conn is None:
+            return None
+        row = conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? "
+            f"AND ({EXPIRES_AT_COLUMN} IS NULL OR {EXPIRES_AT_COLUMN} > ?);",
+            (tile.z, tile.x, tms_row(tile), int(time.time())),
+        ).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def _write_tile(self, path: str, tile: AffectedTile, data: bytes, expires_at: int):
+        conn = self._connect(path, create=True)
+        assert conn is not None
+        conn.execute(
+            "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, "
+            f"{EXPIRES_AT_COLUMN}) VALUES (?, ?, ?, ?, ?);",
+            (tile.z, tile.x, tms_row(tile), data, expires_at),
+        )
+
+    def _evict_tiles(self, path: str, tiles: List[AffectedTile]):
+        conn = self._connect(path, create=False)
+        if conn is None:
+            return
+        with conn:
+            conn.execute("BEGIN;")
+            conn.executemany(
+                "DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;",
+                ((tile.z, tile.x, tms_row(tile)) for tile in tiles),
+            )
+
+    def _clear(self, path: str):
+        # the file is emptied instead of being removed, as other threads
+        # and processes may still have it open
+        conn = self._connect(path, create=False)
+        if conn is None:
+            return
+        conn.execute("DELETE FROM tiles;")
+
+    def _clear_matching(self, pattern: str):
+        for path in glob.glob(pattern, recursive=True):
+            self._clear(path)
+
+    def _purge(self):
+        assert self.root is not None
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, PURGE_LOCK_FILE), "a") as lock_file:
+            # workers sharing the directory take turns
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self._purge_files()
+
+    def _purge_files(self):
+        assert self.root is not None
+        now = int(time.time())
+        used_sizes = {}
+        for path in glob.glob(os.path.join(glob.escape(self.root), "**", "*.mbtiles"), recursive=True):
+            conn = self._connect(path, create=False)
+            if conn is None:
+                continue
+            # tiles written before expiration dates were stored have none
+            conn.execute(
+                f"DELETE FROM tiles WHERE {EXPIRES_AT_COLUMN} IS NULL OR {EXPIRES_AT_COLUMN} <= ?;", (now,))
+            # deleted tiles leave free pages, which are reused by later writes
+            page_size, page_count, free_pages = (
+                conn.execute(f"PRAGMA {pragma};").fetchone()[0]
+                for pragma in ("page_size", "page_count", "freelist_count")
+            )
+            used_sizes[path] = page_size * (page_count - free_pages)
+
+        total_size = sum(used_sizes.values())
+        if self.max_size is None or total_size <= self.max_size:
+            return
+        # evict the same share of the tiles of each file, the closest to their expiration first
+        evicted_share = 1 - self.max_size / total_size
+        for path in used_sizes:
+            conn = self._connect(path, create=False)
+            if conn is None:
+                continue
+            tile_count = conn.execute("SELECT count(*) FROM tiles;").fetchone()[0]
+            conn.execute(
+                "DELETE FROM tiles WHERE (zoom_level, tile_column, tile_row) IN ("
+                f"SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY {EXPIRES_AT_COLUMN} LIMIT ?);",
+                (math.ceil(tile_count * evicted_share),),
+            )
+
+    async def purge(self):
+        """Deletes expired tiles, and the tiles closest to their expiration when the cache is too large"""
+        if not self.enabled:
+            return
+        await self._run(self._purge)
+
+    async def purge_loop(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                await self.purge()
+            except Exception:
+                logger.exception("failed to purge the disk tile cache")
+
+    async def read_tile(self, layer: Layer, version: str, view: View, tile: AffectedTile) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        return await self._run(self._read_tile, self.view_path(layer, version, view), tile)
+
+    async def write_tile(self, layer: Layer, version: str, view: View, tile: AffectedTile, data: bytes):
+        if not self.enabled:
+            return
+        expires_at = int(time.time()) + view.cache_duration
+        await self._run(self._write_tile, self.view_path(layer, version, view), tile, data, expires_at)
+
+    async def evict_tiles(
+            self,
+            layer: Layer, version: str, view: View,
+            tiles: Iterable[AffectedTile],
+            generation: Optional[int] = None,
+    ):
+        if not self.enabled:
+            return
+        await self._run(self._evict_tiles, self.view_path(layer, version, view, generation), list(tiles))
+
+    async def clear_layer(self, layer: Layer, version: str, generation: Optional[int] = None):
+        if not self.enabled:
+            return
+        await asyncio.gather(*(
+            self._run(self._clear, self.view_path(layer, version, view, generation))
+            for view in layer.views.values()
+        ))
+
+    async def clear_view(self, layer: Layer, view: View):
+        """Empties the files of a view definition, in all versions and generations of a layer"""
+        if not self.enabled:
+            return
+        assert self.root is not None
+        file_name = f"{view.name}.{view.fingerprint}.mbtiles"
+        pattern = os.path.join(glob.escape(self.root), glob.escape(layer.name), "**", glob.escape(file_name))
+        await self._run(self._clear_matching, pattern)
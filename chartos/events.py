@@ -0,0 +1,178 @@
+import json
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from aioredis import Redis
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+
+from .config import Config, Layer, get_config
+from .redis import RedisPool
+from .generations import load_cache_generations, set_cache_generation
+from .utils import AsyncProcess, process_dependable
+
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+
+EVENTS_CHANNEL_PREFIX = "chartis.events."
+
+
+def get_events_channel(layer: Layer) -> str:
+    return f"{EVENTS_CHANNEL_PREFIX}{layer.name}"
+
+
+async def publish_impacted_tiles(
+        redis,
+        layer: Layer,
+        version: str,
+        impacted_tiles: Dict[str, Any],
+        generation: Optional[int] = None,
+):
+    """Notifies the subscribers of all workers that some tiles of a layer version changed"""
+    event: Dict[str, Any] = {
+        "layer": layer.name,
+        "version": version,
+        "impacted_tiles": impacted_tiles,
+    }
+    # set when the version moved to a new cache generation
+    if generation is not None:
+        event["generation"] = generation
+    message = json.dumps(event)
+    await redis.publish(get_events_channel(layer), message)
+
+
+class Subscription:
+    """
+    The events waiting to be sent to a client. When the client is too slow and
+    the buffer is full, pending events are replaced by a single reset event,
+    telling the client to reload everything.
+    """
+    __slots__ = ("queue",)
+
+    # sent instead of the pending events on overflow
+    RESET = None
+
+    def __init__(self, buffer_size: int):
+        self.queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue(buffer_size)
+
+    def push(self, event: str):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(self.RESET)
+
+    async def get(self) -> Optional[str]:
+        return await self.queue.get()
+
+
+class EventBroker(AsyncProcess):
+    """
+    Listens to layer events published by all workers on redis,
+    and dispatches them to the subscribers of this worker.
+    """
+
+    def __init__(self, redis_pool: RedisPool, buffer_size: int):
+        self.redis_pool = redis_pool
+        self.buffer_size = buffer_size
+        self.subscriptions: Dict[Tuple[str, str], Set[Subscription]] = defaultdict(set)
+        # called with every event, before subscribers are notified
+        self.listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self.listener: Optional[asyncio.Task] = None
+
+    async def on_startup(self):
+        self.listener = asyncio.create_task(self.listen())
+
+    async def on_shutdown(self):
+        if self.listener is None:
+            return
+        self.listener.cancel()
+        await asyncio.gather(self.listener, return_exceptions=True)
+        self.listener = None
+
+    @process_dependable
+    async def get(self) -> "EventBroker":
+        yield self
+
+    async def listen(self):
+        while True:
+            try:
+                # pub/sub messages aren't sharded, they all go through the first node
+                redis = Redis(connection_pool=self.redis_pool.pools[0])
+                async with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.psubscribe(f"{EVENTS_CHANNEL_PREFIX}*")
+                    # generation changes may have been missed while disconnected
+                    await load_cache_generations(redis)
+                    async for message in pubsub.listen():
+                        if message is not None and message["type"] == "pmessage":
+                            self.dispatch(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("layer events listener failed, reconnecting")
+                await asyncio.sleep(1)
+
+    def dispatch(self, raw_event: str):
+        event = json.loads(raw_event)
+        generation = event.get("generation")
+        if generation is not None:
+            set_cache_generation(event["layer"], event["version"], generation)
+        for listener in self.listeners:
+            listener(event)
+        for subscription in self.subscriptions.get((event["layer"], event["version"]), ()):
+            subscription.push(raw_event)
+
+    @contextmanager
+    def subscribe(self, layer: Layer, version: str) -> Iterator[Subscription]:
+        key = (layer.name, version)
+        subscription = Subscription(self.buffer_size)
+        self.subscriptions[key].add(subscription)
+        try:
+            yield subscription
+        finally:
+            self.subscriptions[key].discard(subscription)
+            if not self.subscriptions[key]:
+                del self.subscriptions[key]
+
+
+@router.get("/events/{layer_slug}")
+async def layer_events(
+        layer_slug: str,
+        request: Request,
+        version: str = Query(...),
+        config: Config = Depends(get_config),
+        broker: EventBroker = Depends(EventBroker.get),
+):
+    """
+    A server-sent event stream of the tiles impacted by changes to a layer version.
+    impacted_tiles events list the impacted tiles per view, like the response of push
+    endpoints, and reset events mean that all tiles of the layer must be reloaded.
+    """
+    layer = config.layers[layer_slug]
+    keepalive_interval = 15
+
+    async def event_stream():
+        with broker.subscribe(layer, version) as subscription:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is Subscription.RESET:
+                    yield "event: reset\ndata: {}\n\n"
+                    continue
+                yield f"event: impacted_tiles\ndata: {event}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Awaitable, Callable, Iterator, List, Optional, TypeVar
+from urllib.parse import quote as url_quote
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from .config import Config, Layer, View, get_config
+from .settings import Settings, get_settings
+from .psql import PSQLReadPool
+from .redis import RedisPool
+from .disk_cache import DiskTileCache
+from .layer_cache import AffectedTile, get_view_cache_prefix, load_cached_tile
+from .render import CLUSTER_COUNT_DESCRIPTION, CLUSTER_COUNT_FIELD, render_tile
+from .render_scheduler import RenderScheduler, RenderUnavailable
+from .memory_render import MemoryLayerStore
+from .tile_refresher import REGENERATION_PRIORITY_OFFSET
+from .archive import ARCHIVE_WRITERS, TileArchiveWriter
+from .generations import check_cache_generation, check_public_version
+
+
+logger = logging.getLogger(__name__)
+
+
+router = APIRouter()
+
+
+# tiles which fail to render, for instance when renders are busy, are tried again after
+# EXPORT_RETRY_DELAY seconds, which doubles after each attempt, before the export fails
+EXPORT_TILE_ATTEMPTS = 5
+EXPORT_RETRY_DELAY = 1.0
+
+T = TypeVar("T")
+
+
+class ArchiveFormat(str, Enum):
+    mbtiles = "mbtiles"
+    pmtiles = "pmtiles"
+
+
+def child_tiles(tile: AffectedTile) -> List[AffectedTile]:
+    return [
+        AffectedTile(x, y, tile.z + 1)
+        for x in range(tile.x * 2, tile.x * 2 + 2)
+        for y in range(tile.y * 2, tile.y * 2 + 2)
+    ]
+
+
+async def tile_has_content(psql, layer: Layer, version: str, view: View, tile: AffectedTile) -> bool:
+    """Checks whether some objects of the view are inside a tile, without rendering it"""
+    on_field_name = view.on_field.pg_name()
+    query = (
+        f"SELECT EXISTS (SELECT 1 FROM {layer.pg_table_name()} "
+        "WHERE version = $4 "
+        f"AND {on_field_name} && TileBBox($1, $2, $3, 3857) "
+        f"AND NOT {view.on_field.pg_is_collection_name()})"
+    )
+    return await psql.fetchval(query, tile.z, tile.x, tile.y, version)
+
+
+class PyramidExporter:
+    """
+    Walks the tile pyramid depth first, only descending into tiles which have
+    some content. Workers share a stack of tiles to visit, which keeps the
+    number of pending tiles proportional to the depth of the pyramid.
+    Queries go through the render scheduler as background renders, behind user
+    requested renders, and archive writes run in a thread of their own, off the event loop.
+    """
+
+    def __init__(
+            self,
+            read_pool: PSQLReadPool,
+            scheduler: RenderScheduler,
+            redis_pool: RedisPool,
+            disk_cache: DiskTileCache,
+            memory_store: MemoryLayerStore,
+            layer: Layer,
+            version: str,
+            view: View,
+    ):
+        self.read_pool = read_pool
+        self.scheduler = scheduler
+        self.redis = redis_pool.acquire()
+        self.disk_cache = disk_cache
+        self.memory_store = memory_store
+        self.layer = layer
+        self.version = version
+        self.view = view
+        self.view_cache_prefix = get_view_cache_prefix(layer, version, view)
+        self.writer: Optional[TileArchiveWriter] = None
+        # writers aren't thread safe, so all their calls go through a single thread
+        self.writer_executor = ThreadPoolExecutor(1, thread_name_prefix="export_writer")
+        self.cleaned_up = False
+
+    async def run_writer(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.writer_executor, func, *args)
+
+    async def open_writer(self, format: str, metadata: dict, minzoom: int, maxzoom: int):
+        self.writer = await self.run_writer(ARCHIVE_WRITERS[format], metadata, minzoom, maxzoom)
+
+    async def finish(self) -> Iterator[bytes]:
+        assert self.writer is not None
+        return await self.run_writer(self.writer.finish)
+
+    def cleanup(self):
+        """Removes the files of the archive, without blocking. Later calls do nothing"""
+        if self.cleaned_up:
+            return
+        self.cleaned_up = True
+        if self.writer is not None:
+            self.writer_executor.submit(self.writer.cleanup)
+        self.writer_executor.shutdown(wait=False)
+
+    def priority(self, tile: AffectedTile) -> int:
+        # exports wait behind user requested renders
+        return tile.z + REGENERATION_PRIORITY_OFFSET
+
+    async def load_tile(self, tile: AffectedTile) -> bytes:
+        # reuse cached tiles when possible, but don't fill the cache with the whole pyramid
+        tile_data, _ = await load_cached_tile(self.redis, self.view, self.view_cache_prefix, tile)
+        if tile_data is not None:
+            return tile_data
+        tile_data = await self.disk_cache.read_tile(self.layer, self.version, self.view, tile)
+        if tile_data is not None:
+            return tile_data
+        return await render_tile(
+            self.read_pool, self.scheduler, self.redis, self.layer, self.version, self.view, tile,
+            priority=self.priority(tile), memory_store=self.memory_store, background=True,
+        )
+
+    async def has_content(self, tile: AffectedTile) -> bool:
+        async with self.scheduler.slot(self.priority(tile), background=True):
+            async with self.read_pool.acquire() as psql:
+                async with self.scheduler.statement_timeout(psql):
+                    return await tile_has_content(psql, self.layer, self.version, self.view, tile)
+
+    async def with_retries(self, func: Callable[[AffectedTile], Awaitable[T]], tile: AffectedTile) -> T:
+        """Calls func on a tile, trying again with a growing delay when it fails"""
+        delay = EXPORT_RETRY_DELAY
+        for _ in range(EXPORT_TILE_ATTEMPTS - 1):
+            try:
+                return await func(tile)
+            except RenderUnavailable as err:
+                logger.info("exporting tile %s again in %ss: %s", tile, delay, err.details)
+            except Exception:
+                logger.exception("exporting tile %s again in %ss", tile, delay)
+            await asyncio.sleep(delay)
+            delay *= 2
+        return await func(tile)
+
+    async def export_tile(self, tile: AffectedTile) -> List[AffectedTile]:
+        """Exports a tile if it's in the zoom range, and returns the children tiles to visit"""
+        writer = self.writer
+        assert writer is not None
+        if tile.z >= writer.minzoom:
+            tile_data = await self.with_retries(self.load_tile, tile)
+            if tile_data:
+                await self.run_writer(writer.add_tile, tile, tile_data)
+                return child_tiles(tile) if tile.z < writer.maxzoom else []
+
+        if tile.z >= writer.maxzoom:
+            return []
+
+        # the tile is empty or wasn't rendered. objects may still be there, but too small
+        # to appear in the tile, in which case children tiles have to be visited
+        has_content = await self.with_retries(self.has_content, tile)
+        return child_tiles(tile) if has_content else []
+
+    async def run(self, concurrency: int):
+        stack = [AffectedTile(0, 0, 0)]
+        busy = 0
+        cond = asyncio.Condition()
+
+        async def worker():
+            nonlocal busy
+            while True:
+                async with cond:
+                    await cond.wait_for(lambda: stack or busy == 0)
+                    if not stack:
+                        return
+                    tile = stack.pop()
+                    busy += 1
+                children = await self.export_tile(tile)
+                async with cond:
+                    busy -= 1
+                    stack.extend(children)
+                    cond.notify_all()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+
+@router.get("/export/{layer_slug}/{view_slug}")
+async def export(
+        layer_slug: str,
+        view_slug: str,
+        version: str = Query(...),
+        minzoom: int = 0,
+        maxzoom: Optional[int] = None,
+        format: ArchiveFormat = ArchiveFormat.mbtiles,
+        config: Config = Depends(get_config),
+        settings: Settings = Depends(get_settings),
+        read_pool: PSQLReadPool = Depends(PSQLReadPool.get_pool),
+        scheduler: RenderScheduler = Depends(RenderScheduler.get),
+        redis_pool: RedisPool = Depends(RedisPool.get_pool),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
+        memory_store: MemoryLayerStore = Depends(MemoryLayerStore.get),
+):
+    layer = config.layers[layer_slug]
+    view = layer.views[view_slug]
+    if maxzoom is None:
+        maxzoom = settings.max_zoom
+    if not 0 <= minzoom <= maxzoom <= settings.max_zoom:
+        raise HTTPException(status_code=400, detail={
+            "details": f"Invalid zoom range, expected 0 <= minzoom <= maxzoom <= {settings.max_zoom}",
+        })
+    check_public_version(version)
+    await check_cache_generation(redis_pool.acquire(), layer, version)
+
+    metadata = {
+        "name": layer.name,
+        "description": layer.description or "",
+        "attribution": layer.attribution or "",
+        "version": version,
+        "format": "pbf",
+        "vector_layers": [{
+            "id": layer.name,
+            "fields": {
+                **{field.name: field.description for field in view.fields},
+                **{projection.name: projection.description for projection in view.json_projections},
+                **({CLUSTER_COUNT_FIELD: CLUSTER_COUNT_DESCRIPTION} if view.cluster_below_zoom is not None else {}),
+            },
+            "minzoom": minzoom,
+            "maxzoom": maxzoom,
+        }],
+    }
+    exporter = PyramidExporter(read_pool, scheduler, redis_pool, disk_cache, memory_store, layer, version, view)
+    try:
+        await exporter.open_writer(format.value, metadata, minzoom, maxzoom)
+        await exporter.run(settings.export_concurrency)
+        content = await exporter.finish()
+    except BaseException:
+        exporter.cleanup()
+        raise
+
+    writer = exporter.writer
+    assert writer is not None
+    file_name = f"{layer.name}_{view.name}_{version}.{writer.extension}"
+    # the background task also runs when the client disconnects before the end of the archive
+    return StreamingResponse(
+        content,
+        media_type=writer.media_type,
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{url_quote(file_name, safe='')}"},
+        background=BackgroundTask(exporter.cleanup),
+    )
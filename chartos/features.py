@@ -0,0 +1,203 @@
+from enum import Enum
+from typing import AsyncIterator, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from .config import Config, Field, GeomField, Layer, get_config
+from .psql import PSQLReadPool
+from .archive import WEB_MERCATOR_MAX_LAT
+from .generations import check_public_version
+
+
+router = APIRouter()
+
+
+# how many features are fetched by each query. connections are released between pages
+FETCH_PAGE_SIZE = 1000
+# the size of the chunks sent to the client
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+class FeatureFormat(str, Enum):
+    geojson = "geojson"
+    ndjson = "ndjson"
+
+
+def select_geojson(field: Field, projected_fields: List[Field]) -> str:
+    if not isinstance(field.type, GeomField):
+        return field.pg_name()
+    # use the generated EPSG:4326 column when there's one
+    if field in projected_fields:
+        return f"ST_AsGeoJSON({field.pg_4326_name()})::json"
+    return f"ST_AsGeoJSON(ST_Transform({field.pg_name()}, 4326))::json"
+
+
+def features_query(
+        layer: Layer,
+        version: str,
+        geom_field: Field,
+        fields: List[Field],
+        bbox: Optional[List[float]],
+        after: Optional[str],
+        limit: Optional[int],
+):
+    """Builds a query returning the ids of features and GeoJSON features, as text, ordered by id"""
+    id_field = layer.id_field
+    projected_fields = layer.get_projected_geom_fields()
+    # json_build_object takes at most 100 arguments, unlike a row, which also keeps the order of fields
+    properties_row = ", ".join(
+        f"{select_geojson(field, projected_fields)} AS {field.pg_name()}"
+        for field in fields
+    )
+    feature = (
+        "json_build_object("
+        "'type', 'Feature', "
+        f"'id', {id_field.pg_name()}, "
+        f"'geometry', {select_geojson(geom_field, projected_fields)}, "
+        f"'properties', (SELECT to_json(properties) FROM (SELECT {properties_row}) AS properties)"
+        ")::text"
+    )
+
+    args: list = []
+
+    def arg(value) -> str:
+        args.append(value)
+        return f"${len(args)}"
+
+    filters = [f"version = {arg(version)}"]
+    if bbox is not None:
+        min_x, min_y, max_x, max_y = (arg(coord) for coord in bbox)
+        filters.append(
+            f"{geom_field.pg_name()} && "
+            f"ST_Transform(ST_MakeEnvelope({min_x}, {min_y}, {max_x}, {max_y}, 4326), 3857)"
+        )
+    if after is not None:
+        # keyset pagination: resume after the last returned id
+        filters.append(f"{id_field.pg_name()} > {arg(after)}::text::{id_field.pg_type()}")
+
+    query = (
+        f"SELECT {id_field.pg_name()}::text, {feature} FROM {layer.pg_table_name()} "
+        f"WHERE {' AND '.join(filters)} "
+        f"ORDER BY {id_field.pg_name()}"
+    )
+    if limit is not None:
+        query += f" LIMIT {arg(limit)}"
+    return query, args
+
+
+def parse_bbox(bbox: Optional[str]) -> Optional[List[float]]:
+    if bbox is None:
+        return None
+    try:
+        coords = [float(coord) for coord in bbox.split(",")]
+    except ValueError:
+        coords = []
+    if len(coords) != 4:
+        raise HTTPException(status_code=400, detail={
+            "details": "bbox must be formatted as min_lon,min_lat,max_lon,max_lat",
+        })
+    # web mercator can't represent the poles
+    min_lon, min_lat, max_lon, max_lat = coords
+    return [
+        min_lon, max(min_lat, -WEB_MERCATOR_MAX_LAT),
+        max_lon, min(max_lat, WEB_MERCATOR_MAX_LAT),
+    ]
+
+
+def resolve_fields(layer: Layer, field_names: Optional[str]) -> List[Field]:
+    if field_names is None:
+        return list(layer.fields.values())
+    fields = []
+    for field_name in field_names.split(","):
+        field = layer.fields.get(field_name)
+        if field is None:
+            raise HTTPException(status_code=400, detail={
+                "details": f"Unknown field name `{field_name}`",
+                "choices": list(layer.fields.keys()),
+            })
+        fields.append(field)
+    return fields
+
+
+def resolve_geom_field(layer: Layer, field_name: Optional[str]) -> Field:
+    if field_name is None:
+        # default to the geometry of the first view
+        return next(iter(layer.views.values())).on_field
+    field = layer.fields.get(field_name)
+    if field is None or not isinstance(field.type, GeomField):
+        raise HTTPException(status_code=400, detail={
+            "details": f"Unknown geometry field `{field_name}`",
+            "choices": [name for name, field in layer.fields.items() if isinstance(field.type, GeomField)],
+        })
+    return field
+
+
+@router.get("/layer/{layer_slug}/features/")
+async def layer_features(
+        layer_slug: str,
+        version: str = Query(...),
+        bbox: Optional[str] = Query(None, description="min_lon,min_lat,max_lon,max_lat"),
+        fields: Optional[str] = Query(None, description="comma separated field names"),
+        geom_field: Optional[str] = None,
+        format: FeatureFormat = FeatureFormat.geojson,
+        after: Optional[str] = Query(None, description="only return features with a greater id"),
+        limit: Optional[int] = Query(None, gt=0),
+        config: Config = Depends(get_config),
+        read_pool: PSQLReadPool = Depends(PSQLReadPool.get_pool),
+):
+    """
+    Streams the features of a layer version, optionally inside a bounding box,
+    ordered by id. Pages are fetched by passing the id of the last feature as `after`.
+    Features are read by pages of FETCH_PAGE_SIZE, so that slow clients don't hold database
+    connections: writes committed while a response is streamed may show up in its next pages.
+    """
+    layer = config.layers[layer_slug]
+    check_public_version(version)
+    resolved_geom_field = resolve_geom_field(layer, geom_field)
+    resolved_fields = resolve_fields(layer, fields)
+    parsed_bbox = parse_bbox(bbox)
+
+    async def fetch_features() -> AsyncIterator[str]:
+        last_id = after
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = FETCH_PAGE_SIZE if remaining is None else min(remaining, FETCH_PAGE_SIZE)
+            query, args = features_query(
+                layer, version, resolved_geom_field, resolved_fields, parsed_bbox, last_id, page_size)
+            async with read_pool.acquire() as psql:
+                rows = await psql.fetch(query, *args)
+            for _, feature in rows:
+                yield feature
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    if format == FeatureFormat.geojson:
+        prefix, separator, suffix = '{"type":"FeatureCollection","features":[', ",", "]}"
+        media_type = "application/geo+json"
+    else:
+        prefix, separator, suffix = "", "\n", "\n"
+        media_type = "application/x-ndjson"
+
+    async def stream_features() -> AsyncIterator[str]:
+        chunk = [prefix]
+        chunk_size = len(prefix)
+        first = True
+        async for feature in fetch_features():
+            if not first:
+                chunk.append(separator)
+            first = False
+            chunk.append(feature)
+            chunk_size += len(feature) + 1
+            if chunk_size >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk.clear()
+                chunk_size = 0
+        if format == FeatureFormat.geojson or not first:
+            chunk.append(suffix)
+        yield "".join(chunk)
+
+    return StreamingResponse(stream_features(), media_type=media_type)
@@ -0,0 +1,93 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .config import Layer
+
+
+# when a staged version is published, the version moves to a new cache generation,
+# which switches readers to a new, empty cache namespace in a single step.
+# generations are counted in redis, and followed by workers through layer events
+GENERATION_KEY_PREFIX = "chartis.generation."
+# events may be delayed or lost, so workers also read the generation of the versions they
+# serve from redis, at most this often, in seconds. this bounds the time during which
+# workers may still serve the tiles of a previous generation after a publication
+GENERATION_CHECK_INTERVAL = 1.0
+# the prefix of hidden versions, which hold staged rows until they are published
+STAGING_VERSION_PREFIX = "__staging__."
+
+
+def get_generation_key(layer_name: str, version: str) -> str:
+    return f"{GENERATION_KEY_PREFIX}{layer_name}.version_{version}"
+
+
+def parse_generation_key(key: str) -> Optional[Tuple[str, str]]:
+    layer_name, sep, version = key[len(GENERATION_KEY_PREFIX):].partition(".version_")
+    if not sep:
+        return None
+    return layer_name, version
+
+
+def get_staging_version(version: str) -> str:
+    return f"{STAGING_VERSION_PREFIX}{version}"
+
+
+def check_public_version(version: str):
+    """Staged rows are only readable once published"""
+    if version.startswith(STAGING_VERSION_PREFIX):
+        raise HTTPException(status_code=404, detail={"details": f"Version `{version}` isn't published"})
+
+
+# the generations of layer versions known to this worker. versions which were never published are at 0
+cache_generations: Dict[Tuple[str, str], int] = {}
+# when the generation of layer versions was last read from redis, in monotonic seconds
+generation_checks: Dict[Tuple[str, str], float] = {}
+
+
+def get_cache_generation(layer: Layer, version: str) -> int:
+    return cache_generations.get((layer.name, version), 0)
+
+
+def set_cache_generation(layer_name: str, version: str, generation: int):
+    # generations only move forward, even if events and loads from redis race
+    key = (layer_name, version)
+    if generation > cache_generations.get(key, 0):
+        cache_generations[key] = generation
+
+
+async def load_cache_generations(redis):
+    """Loads the generations of all published versions from a redis node"""
+    keys = [key async for key in redis.scan_iter(match=f"{GENERATION_KEY_PREFIX}*")]
+    if not keys:
+        return
+    for key, generation in zip(keys, await redis.mget(keys)):
+        parsed_key = parse_generation_key(key.decode())
+        if parsed_key is not None and generation is not None:
+            set_cache_generation(*parsed_key, int(generation))
+
+
+async def read_cache_generation(redis, layer: Layer, version: str) -> int:
+    """
+    Reads the generation of a layer version from redis. Writes invalidate the tiles of this
+    generation, rather than the one known to the worker, which may lag behind a publication
+    """
+    generation = await redis.primary.get(get_generation_key(layer.name, version))
+    if generation is None:
+        return 0
+    set_cache_generation(layer.name, version, int(generation))
+    return int(generation)
+
+
+async def check_cache_generation(redis, layer: Layer, version: str):
+    """Reads the generation of a layer version from redis, unless it was read recently"""
+    key = (layer.name, version)
+    now = time.monotonic()
+    last_check = generation_checks.get(key)
+    if last_check is not None and now - last_check < GENERATION_CHECK_INTERVAL:
+        return
+    # concurrent requests use the known generation while this one is being read
+    generation_checks[key] = now
+    generation = await redis.primary.get(get_generation_key(layer.name, version))
+    if generation is not None:
+        set_cache_generation(layer.name, version, int(generation))
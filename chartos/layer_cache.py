@@ -1,21 +1,53 @@
+import asyncio
+import logging
+import struct
+import time
+from collections import defaultdict
 from dataclasses import dataclass
 from math import asinh, atan, degrees, floor, pi, radians, sinh, tan
-from typing import Collection, Dict, Iterable, Iterator, Optional, Set, Tuple
+from typing import Collection, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from fastapi.responses import JSONResponse
 from shapely.geometry import Polygon
 from shapely.prepared import prep
 
 from .config import Field, Layer, View
+from .events import publish_impacted_tiles
+from .generations import get_cache_generation, get_generation_key, set_cache_generation
 
 
-def get_layer_cache_prefix(layer, version):
-    return f"chartis.layer.{layer.name}.version_{version}"
+logger = logging.getLogger(__name__)
 
 
-def get_view_cache_prefix(layer, version, view):
-    layer_prefix = get_layer_cache_prefix(layer, version)
-    return f"{layer_prefix}.{view.name}"
+def get_layer_cache_prefix(layer, version, generation: Optional[int] = None):
+    if generation is None:
+        generation = get_cache_generation(layer, version)
+    if generation == 0:
+        return f"chartis.layer.{layer.name}.version_{version}"
+    # the generation comes before the version, so that the keys of a generation
+    # don't match the patterns used to invalidate another one
+    return f"chartis.layer.{layer.name}.generation_{generation}.version_{version}"
+
+
+def get_view_cache_prefix(layer, version, view, generation: Optional[int] = None):
+    layer_prefix = get_layer_cache_prefix(layer, version, generation)
+    # views which render differently after a configuration change get a new cache namespace
+    return f"{layer_prefix}.{view.name}.{view.fingerprint}"
+
+
+def get_write_position_key(layer, version):
+    # this key is outside of the layer cache prefix, so that it survives full layer invalidations
+    return f"chartis.write_position.{layer.name}.version_{version}"
+
+
+async def record_write_position(psql, redis, layer: Layer, version: str):
+    """
+    Records the WAL position of the primary after a write to a layer version,
+    so that tiles rendered on read replicas which didn't replay it yet don't get cached.
+    This must be called before the cache is invalidated.
+    """
+    write_position = await psql.fetchval("SELECT pg_current_wal_lsn()::text;")
+    await redis.set(get_write_position_key(layer, version), write_position)
 
 
 @dataclass(eq=True, frozen=True)
@@ -32,6 +64,186 @@ def get_cache_tile_key(view_prefix: str, tile: AffectedTile):
     return f"{view_prefix}.tile/{tile.z}/{tile.x}/{tile.y}"
 
 
+# fresh markers and refresh locks of stale-while-revalidate views are
+# stored on the same redis shard as the tile they are about
+def get_fresh_marker_key(cache_key: str):
+    return f"{cache_key}.fresh"
+
+
+def get_refresh_lock_key(cache_key: str):
+    return f"{cache_key}.refresh"
+
+
+# with the hashes tile cache layout, tiles are grouped in a redis hash per block of
+# 2^block_bits * 2^block_bits tiles. hash values start with a header holding the time
+# until which the tile is fresh, and the time at which it expires, as unix timestamps
+TILE_HEADER = struct.Struct(">II")
+
+
+def get_tile_block_key(view_prefix: str, tile: AffectedTile, block_bits: int) -> str:
+    return f"{view_prefix}.tiles/{tile.z}/{tile.x >> block_bits}/{tile.y >> block_bits}"
+
+
+def get_tile_block_field(tile: AffectedTile, block_bits: int) -> str:
+    mask = (1 << block_bits) - 1
+    return f"{tile.x & mask}/{tile.y & mask}"
+
+
+async def load_cached_tile(redis, view: View, view_prefix: str, tile: AffectedTile) -> Tuple[Optional[bytes], bool]:
+    """Returns the cached tile if any, and whether it is stale"""
+    block_bits = redis.tile_block_bits
+    if block_bits is not None:
+        block_key = get_tile_block_key(view_prefix, tile, block_bits)
+        value = await redis.shard_for(block_key).hget(block_key, get_tile_block_field(tile, block_bits))
+        if value is None:
+            return None, False
+        fresh_until, expires_at = TILE_HEADER.unpack_from(value)
+        now = time.time()
+        # expired tiles stay in the hash until they are overwritten or the whole block expires
+        if now >= expires_at:
+            return None, False
+        return value[TILE_HEADER.size:], now >= fresh_until
+
+    cache_key = get_cache_tile_key(view_prefix, tile)
+    if view.max_stale is None:
+        return await redis.get(cache_key), False
+
+    shard = redis.shard_for(cache_key)
+    tile_data, fresh_marker = await shard.mget(cache_key, get_fresh_marker_key(cache_key))
+    return tile_data, fresh_marker is None
+
+
+async def load_cached_tiles(
+        redis, view: View, view_prefix: str, tiles: List[AffectedTile],
+) -> List[Tuple[Optional[bytes], bool]]:
+    """Like load_cached_tile, with a single MGET per shard, or a HMGET per tile block"""
+    block_bits = redis.tile_block_bits
+    if block_bits is not None:
+        results: List[Tuple[Optional[bytes], bool]] = [(None, False)] * len(tiles)
+        block_indices: Dict[str, List[int]] = defaultdict(list)
+        for i, tile in enumerate(tiles):
+            block_indices[get_tile_block_key(view_prefix, tile, block_bits)].append(i)
+        now = time.time()
+
+        async def load_block(block_key: str, indices: List[int]):
+            fields = [get_tile_block_field(tiles[i], block_bits) for i in indices]
+            values = await redis.shard_for(block_key).hmget(block_key, fields)
+            for i, value in zip(indices, values):
+                if value is None:
+                    continue
+                fresh_until, expires_at = TILE_HEADER.unpack_from(value)
+                if now < expires_at:
+                    results[i] = (value[TILE_HEADER.size:], now >= fresh_until)
+
+        await asyncio.gather(*(load_block(block_key, indices) for block_key, indices in block_indices.items()))
+        return results
+
+    cache_keys = [get_cache_tile_key(view_prefix, tile) for tile in tiles]
+    if view.max_stale is None:
+        return [(tile_data, False) for tile_data in await redis.mget(cache_keys)]
+    # fresh markers are on the shard of their tile, rather than on the shard they hash to
+    stale_results: List[Tuple[Optional[bytes], bool]] = [(None, False)] * len(tiles)
+
+    async def shard_load(shard: int, indices: List[int]):
+        shard_keys = [cache_keys[i] for i in indices]
+        values = await redis.shards[shard].mget([*shard_keys, *map(get_fresh_marker_key, shard_keys)])
+        for j, i in enumerate(indices):
+            stale_results[i] = (values[j], values[len(indices) + j] is None)
+
+    groups = redis.group_by_shard(cache_keys)
+    await asyncio.gather(*(shard_load(shard, indices) for shard, indices in groups.items()))
+    return stale_results
+
+
+async def store_cached_tile(redis, view: View, view_prefix: str, tile: AffectedTile, tile_data: bytes):
+    block_bits = redis.tile_block_bits
+    if block_bits is not None:
+        block_key = get_tile_block_key(view_prefix, tile, block_bits)
+        max_stale = view.max_stale or 0
+        fresh_until = int(time.time()) + view.cache_duration
+        header = TILE_HEADER.pack(fresh_until, fresh_until + max_stale)
+        async with redis.shard_for(block_key).pipeline(transaction=True) as pipe:
+            pipe.hset(block_key, get_tile_block_field(tile, block_bits), header + tile_data)
+            # the block lives as long as its most recent tile
+            pipe.expire(block_key, view.cache_duration + max_stale)
+            await pipe.execute()
+        return
+
+    cache_key = get_cache_tile_key(view_prefix, tile)
+    if view.max_stale is None:
+        await redis.set(cache_key, tile_data, ex=view.cache_duration)
+        return
+
+    # the tile is fresh for cache_duration, and then stale for max_stale
+    shard = redis.shard_for(cache_key)
+    async with shard.pipeline(transaction=True) as pipe:
+        pipe.set(cache_key, tile_data, ex=view.cache_duration + view.max_stale)
+        pipe.set(get_fresh_marker_key(cache_key), b"", ex=view.cache_duration)
+        await pipe.execute()
+
+
+# marks tiles as stale, and makes sure they don't stay stale for longer than max_stale.
+# KEYS alternate tile keys and their fresh marker key, ARGV[1] is max_stale in milliseconds
+MARK_STALE_SCRIPT = """
+local max_stale = tonumber(ARGV[1])
+for i = 1, #KEYS, 2 do
+    redis.call('DEL', KEYS[i + 1])
+    local ttl = redis.call('PTTL', KEYS[i])
+    if ttl == -1 or ttl > max_stale then
+        redis.call('PEXPIRE', KEYS[i], max_stale)
+    end
+end
+"""
+
+
+# the hashes layout counterpart of MARK_STALE_SCRIPT. KEYS[1] is a tile block, ARGV[1] the
+# current time, ARGV[2] max_stale in seconds, and the other arguments are tile fields
+MARK_STALE_BLOCK_SCRIPT = """
+local stale_until = tonumber(ARGV[1]) + tonumber(ARGV[2])
+for i = 3, #ARGV do
+    local value = redis.call('HGET', KEYS[1], ARGV[i])
+    if value then
+        local fresh_until, expires_at = struct.unpack('>I4>I4', value)
+        if expires_at > stale_until then
+            expires_at = stale_until
+        end
+        redis.call('HSET', KEYS[1], ARGV[i], struct.pack('>I4>I4', 0, expires_at) .. string.sub(value, 9))
+    end
+end
+"""
+
+
+async def invalidate_tile_blocks(redis, view: View, view_prefix: str, tiles: Collection[AffectedTile]):
+    """Evicts tiles stored with the hashes layout, or marks them as stale"""
+    block_bits = redis.tile_block_bits
+    block_fields: Dict[str, List[str]] = defaultdict(list)
+    for tile in tiles:
+        block_key = get_tile_block_key(view_prefix, tile, block_bits)
+        block_fields[block_key].append(get_tile_block_field(tile, block_bits))
+
+    async def invalidate_block(block_key: str, fields: List[str]):
+        shard = redis.shard_for(block_key)
+        if view.max_stale is None:
+            await shard.hdel(block_key, *fields)
+            return
+        await shard.eval(MARK_STALE_BLOCK_SCRIPT, 1, block_key, int(time.time()), view.max_stale, *fields)
+
+    await asyncio.gather(*(invalidate_block(block_key, fields) for block_key, fields in block_fields.items()))
+
+
+async def mark_stale(redis, cache_keys: List[str], max_stale: int, batch_size: int = 500):
+    async def shard_mark_stale(shard: int, indices: List[int]):
+        for batch_start in range(0, len(indices), batch_size):
+            keys = []
+            for i in indices[batch_start:batch_start + batch_size]:
+                keys.append(cache_keys[i])
+                keys.append(get_fresh_marker_key(cache_keys[i]))
+            await redis.shards[shard].eval(MARK_STALE_SCRIPT, len(keys), *keys, max_stale * 1000)
+
+    groups = redis.group_by_shard(cache_keys)
+    await asyncio.gather(*(shard_mark_stale(shard, indices) for shard, indices in groups.items()))
+
+
 def get_xy(lat: float, lon: float, zoom: int) -> Tuple[int, int]:
     n = 2.0 ** zoom
     x = floor((lon + 180.) / 360. * n)
@@ -82,11 +294,16 @@ def find_affected_tiles(max_zoom, geom) -> Iterator[AffectedTile]:
 
 async def invalidate_cache(
         redis,
+        disk_cache,
         layer: Layer,
         version: str,
-        affected_tiles: Dict[Field, Set[AffectedTile]]
+        affected_tiles: Dict[Field, Set[AffectedTile]],
+        generation: int,
 ):
+    """Invalidates the tiles of a cache generation, which writers read from redis (see read_cache_generation)"""
     impacted_tiles_meta = {}
+    # the invalidations which aren't plain key deletions
+    stale_marking = []
 
     def build_evicted_keys() -> Iterable[str]:
         for view in layer.views.values():
@@ -94,27 +311,85 @@ async def invalidate_cache(
             if view_affected_tiles is None:
                 continue
             impacted_tiles_meta[view.name] = [tile.to_json() for tile in view_affected_tiles]
-            cache_location = get_view_cache_prefix(layer, version, view)
-            for tile in view_affected_tiles:
-                yield get_cache_tile_key(cache_location, tile)
+            cache_location = get_view_cache_prefix(layer, version, view, generation)
+            if redis.tile_block_bits is not None:
+                stale_marking.append(invalidate_tile_blocks(redis, view, cache_location, view_affected_tiles))
+                continue
+            view_keys = (get_cache_tile_key(cache_location, tile) for tile in view_affected_tiles)
+            # stale-while-revalidate views keep serving invalidated tiles for a while
+            if view.max_stale is not None:
+                stale_marking.append(mark_stale(redis, list(view_keys), view.max_stale))
+                continue
+            yield from view_keys
     evicted_keys = list(build_evicted_keys())
+
+    # evict the disk cache first, so that a redis miss can't be served from stale disk tiles
+    await asyncio.gather(*(
+        disk_cache.evict_tiles(layer, version, view, affected_tiles[view.on_field], generation)
+        for view in layer.views.values()
+        if view.on_field in affected_tiles
+    ))
     if evicted_keys:
         await redis.delete(*evicted_keys)
+    await asyncio.gather(*stale_marking)
+    await publish_impacted_tiles(redis, layer, version, impacted_tiles_meta)
     return JSONResponse(
         {"impacted_tiles": impacted_tiles_meta},
         status_code=201,
     )
 
 
-async def invalidate_full_layer_cache(redis, layer: Layer, version: str):
+async def invalidate_full_layer_cache(redis, disk_cache, layer: Layer, version: str, generation: int):
     """
     Invalidate cache for a whole layer
 
     Args:
-        layer_slug (str): The layer for which the cache has to be invalidated.
+        layer (Layer): The layer for which the cache has to be invalidated.
+        version (str): The version of the layer to invalidate.
+        generation (int): The cache generation of the version, as read from redis.
+    """
+    await disk_cache.clear_layer(layer, version, generation)
+
+    layer_prefix = get_layer_cache_prefix(layer, version, generation)
+    await redis.delete_matching(f"{layer_prefix}.*")
+    await publish_impacted_tiles(redis, layer, version, {view_name: ["*"] for view_name in layer.views})
+
+
+async def drop_cache_generation(redis, disk_cache, layer: Layer, version: str, generation: int):
+    await disk_cache.clear_layer(layer, version, generation)
+    layer_prefix = get_layer_cache_prefix(layer, version, generation)
+    await redis.delete_matching(f"{layer_prefix}.*")
+
+
+async def switch_cache_generation(redis, disk_cache, layer: Layer, version: str) -> int:
     """
-    layer_prefix = get_layer_cache_prefix(layer, version)
-    key_pattern = f"{layer_prefix}.*"
+    Moves a layer version to a new, empty cache namespace, and drops the previous one.
+    Other workers switch when they receive the layer event, or when they next read
+    the generation from redis. Returns the new generation.
+    """
+    generation = await redis.primary.incr(get_generation_key(layer.name, version))
+    set_cache_generation(layer.name, version, generation)
+    await publish_impacted_tiles(
+        redis, layer, version, {view_name: ["*"] for view_name in layer.views}, generation=generation)
+    await drop_cache_generation(redis, disk_cache, layer, version, generation - 1)
+    return generation
+
+
+async def drop_previous_cache_generation_later(
+        redis_pool, disk_cache, layer: Layer, version: str, generation: int, delay: float,
+):
+    """
+    Drops the generation preceding a switch again, after a delay. Until they switch, workers
+    keep storing tiles in the previous generation, which would otherwise stay there until they expire.
+    """
+    await asyncio.sleep(delay)
+    try:
+        await drop_cache_generation(redis_pool.acquire(), disk_cache, layer, version, generation - 1)
+    except Exception:
+        logger.exception("failed to drop the previous cache generation of %s version %s", layer.name, version)
+
 
-    delete_args = await redis.keys(key_pattern)
-    await redis.delete(*delete_args)
+async def drop_view_cache(redis, disk_cache, layer: Layer, view: View):
+    """Drops the cached tiles of a view definition, in all versions of a layer"""
+    await disk_cache.clear_view(layer, view)
+    await redis.delete_matching(f"chartis.layer.{layer.name}.*.{view.name}.{view.fingerprint}.*")
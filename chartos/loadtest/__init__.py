@@ -0,0 +1,4 @@
+"""
+Load testing harness, which replays map browsing and push traffic against a server.
+Run python -m chartos.loadtest --help for usage.
+"""
@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import json
+from dataclasses import replace
+
+from .report import LoadReport
+from .runner import LoadRunner, httpx
+from .scenarios import SCENARIOS, Scenario
+
+
+async def run_in_process(scenario: Scenario, seed: int) -> LoadReport:
+    """Runs the scenario against an app started in this process, using the environment settings"""
+    from asgi_lifespan import LifespanManager
+    from .. import make_app, get_env_settings
+
+    settings = get_env_settings().copy(update=scenario.settings)
+    app = make_app(settings)
+    async with LifespanManager(app):
+        async with httpx.AsyncClient(app=app, base_url=settings.root_url, timeout=None) as client:
+            return await LoadRunner(client, scenario, seed).run()
+
+
+async def run_remote(scenario: Scenario, seed: int, url: str) -> LoadReport:
+    limits = httpx.Limits(max_connections=4 * scenario.browsers)
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as client:
+        return await LoadRunner(client, scenario, seed).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m chartos.loadtest",
+        description="Replays realistic map traffic against chartos, and reports latencies",
+    )
+    parser.add_argument("scenario", choices=list(SCENARIOS))
+    parser.add_argument("--url", help="the url of a running server. by default, the app is started in process")
+    parser.add_argument("--duration", type=float, help="overrides the duration of the scenario, in seconds")
+    parser.add_argument("--browsers", type=int, help="overrides the number of users browsing the map")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+    if httpx is None:
+        parser.error("load tests need httpx, which comes with the loadtest extra")
+
+    scenario = SCENARIOS[args.scenario]
+    if args.duration is not None:
+        scenario = replace(scenario, duration=args.duration)
+    if args.browsers is not None:
+        scenario = replace(scenario, browsers=args.browsers)
+
+    if args.url is None:
+        report = asyncio.run(run_in_process(scenario, args.seed))
+    else:
+        if scenario.settings:
+            parser.error(f"the {scenario.name} scenario changes settings, and can only run in process")
+        report = asyncio.run(run_remote(scenario, args.seed, args.url))
+
+    if args.json:
+        print(json.dumps(report.to_json(), indent=2))
+    else:
+        print(report.format())
+
+
+if __name__ == "__main__":
+    main()
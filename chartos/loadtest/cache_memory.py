@@ -0,0 +1,79 @@
+"""
+Compares the redis memory usage of the tile cache layouts on a synthetic dataset.
+This flushes the target redis database.
+"""
+import argparse
+import asyncio
+import os
+import random
+
+import aioredis
+
+from ..layer_cache import (
+    TILE_HEADER,
+    AffectedTile,
+    get_cache_tile_key,
+    get_tile_block_field,
+    get_tile_block_key,
+)
+
+
+VIEW_PREFIX = "chartis.layer.osrd_track_section.version_1.geo"
+
+
+def synthetic_tiles(rng: random.Random, count: int, z: int, spread: float):
+    """Tiles clustered around a few areas, like the tiles of a railway network"""
+    n = 1 << z
+    tiles = set()
+    centers = [(rng.randrange(n), rng.randrange(n)) for _ in range(20)]
+    while len(tiles) < count:
+        cx, cy = rng.choice(centers)
+        tiles.add(AffectedTile(int(rng.gauss(cx, spread)) % n, min(max(int(rng.gauss(cy, spread)), 0), n - 1), z))
+    return list(tiles)
+
+
+async def fill(redis, layout: str, tiles, tile_size: int, block_bits: int, batch_size: int = 1000):
+    for batch_start in range(0, len(tiles), batch_size):
+        async with redis.pipeline(transaction=False) as pipe:
+            for tile in tiles[batch_start:batch_start + batch_size]:
+                tile_data = os.urandom(tile_size)
+                if layout == "keys":
+                    pipe.set(get_cache_tile_key(VIEW_PREFIX, tile), tile_data, ex=3600)
+                    continue
+                block_key = get_tile_block_key(VIEW_PREFIX, tile, block_bits)
+                header = TILE_HEADER.pack(0, 0)
+                pipe.hset(block_key, get_tile_block_field(tile, block_bits), header + tile_data)
+                pipe.expire(block_key, 3600)
+            await pipe.execute()
+
+
+async def measure(redis_url: str, tile_count: int, tile_size: int, block_bits: int, spread: float, seed: int):
+    redis = aioredis.from_url(redis_url)
+    tiles = synthetic_tiles(random.Random(seed), tile_count, 14, spread)
+    print(f"{tile_count} tiles of {tile_size} bytes, blocks of {1 << block_bits}x{1 << block_bits} tiles")
+    for layout in ("keys", "hashes"):
+        await redis.flushdb()
+        before = (await redis.info("memory"))["used_memory"]
+        await fill(redis, layout, tiles, tile_size, block_bits)
+        used = (await redis.info("memory"))["used_memory"] - before
+        key_count = await redis.dbsize()
+        print(f"{layout:>6}: {used / 2 ** 20:8.1f} MiB, {used / tile_count:6.1f} bytes per tile, {key_count} keys")
+    await redis.flushdb()
+    await redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m chartos.loadtest.cache_memory", description=__doc__)
+    parser.add_argument("--redis-url", default="redis://localhost")
+    parser.add_argument("--tiles", type=int, default=200_000)
+    parser.add_argument("--tile-size", type=int, default=200)
+    parser.add_argument("--block-bits", type=int, default=4)
+    # the standard deviation of the distance of tiles to the center of their cluster, in tiles
+    parser.add_argument("--spread", type=float, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(measure(args.redis_url, args.tiles, args.tile_size, args.block_bits, args.spread, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from ..utils.wait_stats import percentile
+
+
+class LoadReport:
+    """Latencies and cache statuses of requests, grouped by endpoint and zoom level"""
+
+    def __init__(self):
+        self.latencies: Dict[Tuple[str, Optional[int]], List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.cache_statuses: Counter = Counter()
+        self.duration = 0.
+
+    def record(
+            self,
+            endpoint: str,
+            zoom: Optional[int],
+            latency: float,
+            status_code: int,
+            cache_status: Optional[str] = None,
+    ):
+        self.latencies[endpoint, zoom].append(latency)
+        if status_code >= 400:
+            self.errors[endpoint, status_code] += 1
+        if cache_status is not None:
+            self.cache_statuses[cache_status] += 1
+
+    def rows(self):
+        sorted_latencies = sorted(self.latencies.items(), key=lambda item: (item[0][0], item[0][1] or 0))
+        for (endpoint, zoom), latencies in sorted_latencies:
+            latencies = sorted(latencies)
+            yield {
+                "endpoint": endpoint,
+                "zoom": zoom,
+                "requests": len(latencies),
+                "throughput": len(latencies) / self.duration if self.duration else 0.,
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+
+    def cache_hit_ratio(self) -> Optional[float]:
+        total = sum(self.cache_statuses.values())
+        if total == 0:
+            return None
+        return (total - self.cache_statuses["miss"]) / total
+
+    def to_json(self):
+        return {
+            "duration": self.duration,
+            "latencies": list(self.rows()),
+            "errors": [
+                {"endpoint": endpoint, "status_code": status_code, "count": count}
+                for (endpoint, status_code), count in self.errors.items()
+            ],
+            "cache_statuses": dict(self.cache_statuses),
+            "cache_hit_ratio": self.cache_hit_ratio(),
+        }
+
+    def format(self) -> str:
+        lines = [
+            f"{'endpoint':<10} {'zoom':>4} {'requests':>9} {'req/s':>8} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        ]
+        for row in self.rows():
+            zoom = "" if row["zoom"] is None else row["zoom"]
+            lines.append(
+                f"{row['endpoint']:<10} {zoom:>4} {row['requests']:>9} {row['throughput']:>8.1f} "
+                f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f}"
+            )
+        for (endpoint, status_code), count in sorted(self.errors.items()):
+            lines.append(f"{count} {endpoint} requests failed with status {status_code}")
+        hit_ratio = self.cache_hit_ratio()
+        if hit_ratio is not None:
+            statuses = ", ".join(f"{status}: {count}" for status, count in sorted(self.cache_statuses.items()))
+            lines.append(f"cache hit ratio: {hit_ratio:.1%} ({statuses})")
+        return "\n".join(lines)
@@ -0,0 +1,100 @@
+import asyncio
+import random
+import time
+from typing import Optional
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from ..layer_cache import AffectedTile
+from .report import LoadReport
+from .scenarios import Scenario
+from .traffic import PanningSession
+
+
+class LoadRunner:
+    """Replays the traffic of a scenario against a chartos server, through an http client"""
+
+    def __init__(self, client: "httpx.AsyncClient", scenario: Scenario, seed: int):
+        self.client = client
+        self.scenario = scenario
+        self.rng = random.Random(seed)
+        self.report = LoadReport()
+        self.deadline = 0.
+        self.next_entity_id = self.rng.randrange(1 << 30)
+
+    def running(self) -> bool:
+        return time.perf_counter() < self.deadline
+
+    async def request(self, endpoint: str, zoom: Optional[int], method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.report.record(endpoint, zoom, time.perf_counter() - start, 599)
+            return
+        latency = time.perf_counter() - start
+        cache_status = response.headers.get("X-Cache-Status") if endpoint == "tile" else None
+        self.report.record(endpoint, zoom, latency, response.status_code, cache_status)
+
+    async def fetch_tile(self, tile: AffectedTile):
+        scenario = self.scenario
+        await self.request(
+            "tile", tile.z, "GET",
+            f"/tile/{scenario.layer}/{scenario.view}/{tile.z}/{tile.x}/{tile.y}/",
+            params={"version": scenario.version},
+        )
+
+    async def browse(self, rng: random.Random):
+        scenario = self.scenario
+        session = PanningSession(rng, scenario.hotspots, scenario.zoom_weights)
+        for tiles in session:
+            if not self.running():
+                return
+            # maps fetch all the tiles of the viewport at once
+            await asyncio.gather(*map(self.fetch_tile, tiles))
+            await asyncio.sleep(rng.expovariate(1 / scenario.think_time))
+
+    async def insert(self, interval: float):
+        scenario = self.scenario
+        while True:
+            await asyncio.sleep(interval)
+            if not self.running():
+                return
+            rows = []
+            for _ in range(scenario.insert_batch_size):
+                hotspot = self.rng.choices(scenario.hotspots, [hotspot.weight for hotspot in scenario.hotspots])[0]
+                lon = hotspot.lon + self.rng.gauss(0, hotspot.spread)
+                lat = hotspot.lat + self.rng.gauss(0, hotspot.spread)
+                rows.append(scenario.make_row(self.next_entity_id, lon, lat))
+                self.next_entity_id += 1
+            await self.request(
+                "insert", None, "POST", f"/push/{scenario.layer}/insert/",
+                params={"version": scenario.version}, json=rows,
+            )
+
+    async def truncate(self, interval: float):
+        scenario = self.scenario
+        while True:
+            await asyncio.sleep(interval)
+            if not self.running():
+                return
+            await self.request(
+                "truncate", None, "POST", f"/push/{scenario.layer}/truncate/",
+                params={"version": scenario.version},
+            )
+
+    async def run(self) -> LoadReport:
+        scenario = self.scenario
+        start = time.perf_counter()
+        self.deadline = start + scenario.duration
+        tasks = [self.browse(random.Random(self.rng.random())) for _ in range(scenario.browsers)]
+        if scenario.insert_interval is not None:
+            tasks.append(self.insert(scenario.insert_interval))
+        if scenario.truncate_interval is not None:
+            tasks.append(self.truncate(scenario.truncate_interval))
+        await asyncio.gather(*tasks)
+        self.report.duration = time.perf_counter() - start
+        return self.report
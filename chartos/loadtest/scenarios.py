@@ -0,0 +1,79 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from .traffic import Hotspot
+
+
+def signal_row(entity_id: int, lon: float, lat: float) -> Dict[str, Any]:
+    point = {"type": "Point", "coordinates": [lon, lat]}
+    return {"entity_id": entity_id, "geom_geo": point, "geom_sch": point, "components": {}}
+
+
+# large french railway stations
+STATIONS = [
+    Hotspot(2.3553, 48.8809, weight=4.),  # Paris Nord
+    Hotspot(2.3735, 48.8443, weight=3.),  # Paris Gare de Lyon
+    Hotspot(4.8596, 45.7605, weight=2.),  # Lyon Part-Dieu
+    Hotspot(5.3801, 43.3027, weight=1.5),  # Marseille Saint-Charles
+    Hotspot(-0.5560, 44.8259, weight=1.),  # Bordeaux Saint-Jean
+    Hotspot(3.0707, 50.6390, weight=1.),  # Lille Flandres
+]
+
+# most users look at the network from mid zoom levels
+DEFAULT_ZOOM_WEIGHTS = {
+    5: 1., 6: 2., 7: 3., 8: 4., 9: 5., 10: 6., 11: 8., 12: 10.,
+    13: 12., 14: 12., 15: 8., 16: 5., 17: 2., 18: 1.,
+}
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    # how long the scenario runs, in seconds
+    duration: float = 60.
+    # how many users browse the map at once
+    browsers: int = 20
+    # the delay between two moves of a user, in seconds
+    think_time: float = 0.5
+    zoom_weights: Dict[int, float] = field(default_factory=lambda: dict(DEFAULT_ZOOM_WEIGHTS))
+    hotspots: List[Hotspot] = field(default_factory=lambda: list(STATIONS))
+    layer: str = "osrd_signal"
+    view: str = "geo"
+    version: str = "loadtest"
+    # the delay between two inserts, in seconds. None disables inserts
+    insert_interval: Optional[float] = None
+    insert_batch_size: int = 100
+    make_row: Callable[[int, float, float], Dict[str, Any]] = signal_row
+    # the delay between two truncations of the version. None disables truncations
+    truncate_interval: Optional[float] = None
+    # settings overrides of in-process servers, used to compare configurations
+    settings: Dict[str, Any] = field(default_factory=dict)
+
+
+SCENARIOS = {scenario.name: scenario for scenario in [
+    Scenario(
+        "browse",
+        "users panning around stations, with no writes",
+    ),
+    Scenario(
+        "mixed",
+        "users panning around stations while objects are pushed, and the version is sometimes reset",
+        insert_interval=1.,
+        truncate_interval=30.,
+    ),
+    Scenario(
+        "write_heavy",
+        "a few users, while large batches of objects are pushed continuously",
+        browsers=5,
+        insert_interval=0.1,
+        insert_batch_size=1000,
+    ),
+    Scenario(
+        "low_render_concurrency",
+        "the mixed scenario, with half the default render concurrency",
+        insert_interval=1.,
+        truncate_interval=30.,
+        settings={"render_concurrency": 4},
+    ),
+]}
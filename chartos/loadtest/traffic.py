@@ -0,0 +1,82 @@
+import random
+from dataclasses import dataclass
+from math import floor
+from typing import Dict, Iterator, List, Tuple
+
+from ..layer_cache import AffectedTile, get_xy
+
+
+@dataclass(frozen=True)
+class Hotspot:
+    """A place where users look at the map, such as a large station"""
+    lon: float
+    lat: float
+    weight: float = 1.
+    # how far from the center users wander, in degrees
+    spread: float = 0.05
+
+
+def weighted_choice(rng: random.Random, weights: Dict) -> object:
+    return rng.choices(list(weights.keys()), list(weights.values()))[0]
+
+
+def viewport_tiles(center: Tuple[float, float], z: int, width: int, height: int) -> List[AffectedTile]:
+    """The tiles a map of width x height tiles centered on a point displays"""
+    fx, fy = center
+    x0, y0 = floor(fx - width / 2), floor(fy - height / 2)
+    n = 1 << z
+    return [
+        AffectedTile(x % n, y, z)
+        for y in range(max(y0, 0), min(y0 + height + 1, n))
+        for x in range(x0, x0 + width + 1)
+    ]
+
+
+class PanningSession:
+    """
+    Mimics a user browsing the map: the session starts near a hotspot at some
+    zoom level, and then pans around, zooming in and out from time to time.
+    Each step yields the tiles of the viewport.
+    """
+
+    def __init__(
+            self,
+            rng: random.Random,
+            hotspots: List[Hotspot],
+            zoom_weights: Dict[int, float],
+            viewport: Tuple[int, int] = (4, 3),
+            zoom_change_probability: float = 0.2,
+    ):
+        self.rng = rng
+        self.viewport = viewport
+        self.zoom_change_probability = zoom_change_probability
+        self.min_zoom = min(zoom_weights)
+        self.max_zoom = max(zoom_weights)
+        hotspot = rng.choices(hotspots, [hotspot.weight for hotspot in hotspots])[0]
+        lon = hotspot.lon + rng.gauss(0, hotspot.spread)
+        lat = hotspot.lat + rng.gauss(0, hotspot.spread)
+        self.z: int = weighted_choice(rng, zoom_weights)  # type: ignore
+        x, y = get_xy(lat, lon, self.z)
+        # the center of the viewport, in fractional tile coordinates
+        self.center = (x + rng.random(), y + rng.random())
+
+    def step(self) -> List[AffectedTile]:
+        rng = self.rng
+        fx, fy = self.center
+        if rng.random() < self.zoom_change_probability:
+            new_z = min(max(self.z + rng.choice((-1, 1)), self.min_zoom), self.max_zoom)
+            scale = 2. ** (new_z - self.z)
+            fx, fy = fx * scale, fy * scale
+            self.z = new_z
+        else:
+            # pan by up to half a viewport
+            width, height = self.viewport
+            fx += rng.uniform(-width / 2, width / 2)
+            fy += rng.uniform(-height / 2, height / 2)
+        n = 1 << self.z
+        self.center = (fx % n, min(max(fy, 0.), n - 1e-9))
+        return viewport_tiles(self.center, self.z, *self.viewport)
+
+    def __iter__(self) -> Iterator[List[AffectedTile]]:
+        while True:
+            yield self.step()
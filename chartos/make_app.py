@@ -1,5 +1,4 @@
 import json
-import yaml
 import asyncpg
 import shapely.wkb
 import pyproj
@@ -9,21 +8,26 @@ from shapely.ops import transform
 from typing import Optional
 
 from .settings import Settings, get_settings, get_env_settings
-from .config import Config, get_config
-from .serialized_config import SerializedConfig
-from .psql import PSQLPool
+from .config import get_config
+from .psql import AdaptiveSizing, PSQLPool, PSQLReadPool
 from .dbinit import DBInit
 from .redis import RedisPool
+from .disk_cache import DiskTileCache
+from .render_scheduler import RenderScheduler, RenderUnavailable, render_unavailable_handler
+from .tile_refresher import TileRefresher
+from .reload import ConfigReloader, read_config
+from .memory_render import MemoryLayerStore
+from .popularity import PopularityTracker
 from .views import router as view_router
 from .truncate import router as truncate_router
 from .modify import router as modify_router
-
-
-def read_config(settings: Settings) -> Config:
-    with open(settings.config_path) as f:
-        config_data = yaml.safe_load(f)
-        raw_config = SerializedConfig.parse_obj(config_data)
-        return Config.parse(raw_config)
+from .export import router as export_router
+from .features import router as features_router
+from .events import router as events_router, EventBroker
+from .tile_stats import router as tile_stats_router, TileStatsFlusher
+from .admin import router as admin_router
+from .batch import router as batch_router
+from .tracing import TracingMiddleware, make_exporter
 
 
 pseudo_mercator = pyproj.CRS('EPSG:3857')
@@ -70,6 +74,12 @@ def make_app(settings: Optional[Settings] = None) -> FastAPI:
     app.include_router(view_router)
     app.include_router(truncate_router)
     app.include_router(modify_router)
+    app.include_router(export_router)
+    app.include_router(features_router)
+    app.include_router(events_router)
+    app.include_router(tile_stats_router)
+    app.include_router(admin_router)
+    app.include_router(batch_router)
 
     # setup CORS
     app.add_middleware(
@@ -79,21 +89,91 @@ def make_app(settings: Optional[Settings] = None) -> FastAPI:
         allow_headers=["*"],
     )
 
+    # setup request tracing
+    if settings.trace_sample_rate > 0 or settings.trace_server_timing:
+        app.add_middleware(
+            TracingMiddleware,
+            exporter=make_exporter(settings.trace_exporter),
+            sample_rate=settings.trace_sample_rate,
+            server_timing=settings.trace_server_timing,
+        )
+
+    app.add_exception_handler(RenderUnavailable, render_unavailable_handler)
+
     # parse the configuration and setup dep injection
     config = read_config(settings)
     get_config.setup(app, config)
     get_settings.setup(app, settings)
 
     # setup the redis pool process
-    RedisPool.setup(app, settings.redis_url)
+    redis_pool = RedisPool.setup(
+        app, settings.redis_urls(), settings.redis_max_conns, settings.tile_block_bits())
+
+    # send the stats of tile renders to redis in the background
+    TileStatsFlusher.setup(app, redis_pool)
+
+    # setup the on-disk tile cache, which does nothing unless a path is configured
+    disk_cache = DiskTileCache.setup(
+        app,
+        settings.disk_cache_path,
+        settings.disk_cache_mmap_size,
+        settings.disk_cache_max_open_files,
+        max_size=settings.disk_cache_max_size,
+        purge_interval=settings.disk_cache_purge_interval,
+    )
 
     # setup the postgresql pool process
+    psql_adaptive_sizing = AdaptiveSizing(settings.psql_target_wait) if settings.psql_adaptive_pool else None
     psql_settings = {
         **settings.psql_settings(),
         "init": init_psql_conn,
     }
-    psql_pool = PSQLPool.setup(app, psql_settings)
+    psql_pool = PSQLPool.setup(app, psql_settings, psql_adaptive_sizing)
+
+    # setup the pools of read replicas used for rendering tiles
+    replica_settings = [
+        {**replica, "init": init_psql_conn}
+        for replica in settings.psql_replica_settings()
+    ]
+    read_pool = PSQLReadPool.setup(app, replica_settings, psql_pool, psql_adaptive_sizing)
+
+    # setup the tile rendering admission control
+    scheduler = RenderScheduler.setup(
+        app,
+        settings.render_concurrency,
+        settings.render_queue_size,
+        settings.render_timeout,
+        settings.render_retry_after,
+        settings.render_background_concurrency,
+        settings.render_background_queue_size,
+    )
+
+    # setup the layer events dispatcher
+    broker = EventBroker.setup(app, redis_pool, settings.events_buffer_size)
+
+    # keep the layers rendered in memory
+    memory_store = MemoryLayerStore.setup(app, psql_pool, broker, settings.memory_render_max_versions)
+
+    # track tile popularity, to regenerate the most popular tiles after changes
+    popularity = PopularityTracker.setup(
+        app, redis_pool, settings.popularity_sample_rate, settings.popularity_half_life)
+
+    # setup the background tile renderer
+    TileRefresher.setup(
+        app,
+        read_pool,
+        scheduler,
+        redis_pool,
+        disk_cache,
+        popularity,
+        memory_store,
+        settings.regeneration_count,
+        settings.regeneration_concurrency,
+    )
 
     # initialize the database initialization process
-    DBInit.setup(app, config, psql_pool)
+    dbinit = DBInit.setup(app, config, psql_pool)
+
+    # reload the configuration on SIGHUP, or on all workers through the admin endpoint
+    ConfigReloader.setup(app, app, settings, config, dbinit, redis_pool, disk_cache)
     return app
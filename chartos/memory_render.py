@@ -0,0 +1,262 @@
+import struct
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from decimal import Decimal, localcontext
+from typing import Any, Dict, List, Optional, Tuple
+
+from shapely.geometry import Point, box
+from shapely.strtree import STRtree
+
+from .config import (
+    BigIntField,
+    BoolField,
+    CharField,
+    DoubleField,
+    Field,
+    GeomField,
+    IntField,
+    Layer,
+    StringField,
+    TextField,
+    View,
+)
+from .events import EventBroker
+from .layer_cache import AffectedTile
+from .mvt import MVT_EXTENT, MVTLayerEncoder, mvt_point
+from .psql import PSQLPool
+from .utils import AsyncProcess, process_dependable
+
+
+logger = logging.getLogger(__name__)
+
+
+# the types which ST_AsMVT encodes natively. other values are sent as their postgresql text output
+NATIVE_MVT_TYPES = (TextField, StringField, CharField, IntField, BigIntField, BoolField, DoubleField)
+# the half size of the world in EPSG:3857, as used by the TileBBox function
+WORLD_HALF_SIZE = Decimal("20037508.34")
+
+FLOAT32 = struct.Struct("<f")
+INT32 = struct.Struct("<i")
+FLOAT32_MIN = 1.401298464324817e-45
+
+
+def tile_bounds(tile: AffectedTile) -> Tuple[float, float, float, float]:
+    """
+    Computes the bounds of a tile like the TileBBox function: the tile size is a double rounded
+    to 15 significant digits, as stored in a numeric variable, and bounds are computed in numeric
+    """
+    tile_size = Decimal(f"{float(WORLD_HALF_SIZE * 2) / 2.0 ** tile.z:.15g}")
+    with localcontext() as ctx:
+        ctx.prec = 60
+        min_x = -WORLD_HALF_SIZE + tile.x * tile_size
+        max_y = WORLD_HALF_SIZE - tile.y * tile_size
+        return float(min_x), float(max_y - tile_size), float(min_x + tile_size), float(max_y)
+
+
+def float32_step(value: float, up: bool) -> float:
+    """Returns the next single precision float above or below a single precision float"""
+    if value == 0:
+        return FLOAT32_MIN if up else -FLOAT32_MIN
+    bits = INT32.unpack(FLOAT32.pack(value))[0]
+    bits += 1 if (value > 0) == up else -1
+    return FLOAT32.unpack(INT32.pack(bits))[0]
+
+
+def float32_down(value: float) -> float:
+    rounded = FLOAT32.unpack(FLOAT32.pack(value))[0]
+    return rounded if rounded <= value else float32_step(rounded, up=False)
+
+
+def float32_up(value: float) -> float:
+    rounded = FLOAT32.unpack(FLOAT32.pack(value))[0]
+    return rounded if rounded >= value else float32_step(rounded, up=True)
+
+
+def index_box(bounds: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+    """The single precision box postgis compares with &&, which contains the exact bounds"""
+    min_x, min_y, max_x, max_y = bounds
+    return float32_down(min_x), float32_down(min_y), float32_up(max_x), float32_up(max_y)
+
+
+def parse_lsn(lsn: str) -> int:
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+def select_attribute(view_field: Field) -> str:
+    field_name = view_field.pg_name()
+    if isinstance(view_field.type, NATIVE_MVT_TYPES):
+        return field_name
+    # geometry attributes are sent in EPSG:4326, like tile queries do
+    if isinstance(view_field.type, GeomField):
+        return f"{view_field.pg_4326_name()}::text AS {field_name}"
+    return f"{field_name}::text"
+
+
+def view_snapshot_query(layer: Layer, view: View) -> str:
+    """Selects the features of a view, with attributes as ST_AsMVT encodes them"""
+    attributes = [
+        *map(select_attribute, view.fields),
+        *(
+            projection.pg_select() if isinstance(projection.type, NATIVE_MVT_TYPES)
+            else f"{projection.pg_value()}::text AS {projection.pg_name()}"
+            for projection in view.json_projections
+        ),
+    ]
+    on_field_name = view.on_field.pg_name()
+    return (
+        f"SELECT {', '.join([f'ST_X({on_field_name})', f'ST_Y({on_field_name})', *attributes])} "
+        f"FROM {layer.pg_table_name()} "
+        f"WHERE version = $1 AND {on_field_name} IS NOT NULL "
+        f"AND NOT {view.on_field.pg_is_collection_name()} "
+        # tile queries of layers rendered in memory use the same order
+        f"ORDER BY {layer.id_field.pg_name()}"
+    )
+
+
+def view_attribute_names(view: View) -> List[str]:
+    return [
+        *(view_field.name for view_field in view.fields),
+        *(projection.name for projection in view.json_projections),
+    ]
+
+
+class ViewSnapshot:
+    """The points of a view, in the order of tile queries, indexed by an STRtree"""
+
+    def __init__(
+            self,
+            layer_name: str,
+            fingerprint: str,
+            attribute_names: List[str],
+            coords: List[Tuple[float, float]],
+            attributes: List[Tuple],
+    ):
+        self.layer_name = layer_name
+        self.fingerprint = fingerprint
+        self.attribute_names = attribute_names
+        self.coords = coords
+        self.attributes = attributes
+        # the boxes postgis compares with the tile when filtering features with &&
+        self.boxes = [index_box((x, y, x, y)) for x, y in coords]
+        points = [Point(x, y) for x, y in coords]
+        self.tree = STRtree(points)
+        # the STRtree returns geometries, which are mapped back to their features
+        self.feature_indexes = {id(point): i for i, point in enumerate(points)}
+
+    def render(self, tile: AffectedTile) -> Tuple[bytes, int]:
+        """Renders a tile like mvt_query, and counts the features it contains"""
+        bounds = tile_bounds(tile)
+        min_x, min_y, max_x, max_y = index_box(bounds)
+        # the index boxes of points may overlap the tile box when the points are just outside
+        query_box = box(
+            float32_step(min_x, up=False), float32_step(min_y, up=False),
+            float32_step(max_x, up=True), float32_step(max_y, up=True),
+        )
+        feature_indexes = []
+        for point in self.tree.query(query_box):
+            feature_index = self.feature_indexes[id(point)]
+            box_min_x, box_min_y, box_max_x, box_max_y = self.boxes[feature_index]
+            if box_min_x <= max_x and box_max_x >= min_x and box_min_y <= max_y and box_max_y >= min_y:
+                feature_indexes.append(feature_index)
+        feature_indexes.sort()
+
+        encoder = MVTLayerEncoder(self.layer_name, self.attribute_names)
+        for feature_index in feature_indexes:
+            x, y = self.coords[feature_index]
+            tile_coords = mvt_point(x, y, bounds, MVT_EXTENT)
+            if tile_coords is not None:
+                encoder.add_point(*tile_coords, self.attributes[feature_index])
+        return encoder.encode(), len(feature_indexes)
+
+
+@dataclass
+class LayerSnapshot:
+    # the WAL position of the primary when the snapshot was taken
+    position: int
+    views: Dict[str, ViewSnapshot]
+
+    def matches(self, layer: Layer) -> bool:
+        """Whether the views of the layer didn't change since the snapshot, as they may after a reload"""
+        return layer.views.keys() == self.views.keys() and all(
+            view.fingerprint == self.views[view.name].fingerprint
+            for view in layer.views.values()
+        )
+
+
+class MemoryLayerStore(AsyncProcess):
+    """
+    Keeps the versions of layers rendered in memory, and renders their tiles without postgis.
+    Versions are loaded from the primary on their first render, and loaded again when they change.
+    """
+
+    def __init__(self, psql_pool: PSQLPool, broker: EventBroker, max_versions: int):
+        self.psql_pool = psql_pool
+        self.max_versions = max_versions
+        # the least recently used versions come first
+        self.snapshots: "OrderedDict[Tuple[str, str], LayerSnapshot]" = OrderedDict()
+        self.load_locks: Dict[Tuple[str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+        broker.listeners.append(self.on_event)
+
+    async def on_startup(self):
+        pass
+
+    async def on_shutdown(self):
+        self.snapshots.clear()
+
+    @process_dependable
+    async def get(self) -> "MemoryLayerStore":
+        yield self
+
+    def on_event(self, event: Dict[str, Any]):
+        # changed versions are loaded again on their next render
+        self.snapshots.pop((event["layer"], event["version"]), None)
+
+    async def render(
+            self,
+            layer: Layer,
+            version: str,
+            view: View,
+            tile: AffectedTile,
+            write_position: Optional[bytes],
+    ) -> Tuple[bytes, int]:
+        snapshot = await self.get_snapshot(layer, version, write_position)
+        view_snapshot = snapshot.views[view.name]
+        # rendering is cpu bound, and would otherwise block the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, view_snapshot.render, tile)
+
+    async def get_snapshot(self, layer: Layer, version: str, write_position: Optional[bytes]) -> LayerSnapshot:
+        key = (layer.name, version)
+        min_position = 0 if write_position is None else parse_lsn(write_position.decode())
+        snapshot = self.snapshots.get(key)
+        if snapshot is None or snapshot.position < min_position or not snapshot.matches(layer):
+            async with self.load_locks[key]:
+                # the version may have been loaded while waiting for the lock
+                snapshot = self.snapshots.get(key)
+                if snapshot is None or snapshot.position < min_position or not snapshot.matches(layer):
+                    snapshot = await self.load(layer, version)
+                    self.snapshots[key] = snapshot
+        self.snapshots.move_to_end(key)
+        while len(self.snapshots) > self.max_versions:
+            self.snapshots.popitem(last=False)
+        return snapshot
+
+    async def load(self, layer: Layer, version: str) -> LayerSnapshot:
+        async with self.psql_pool.acquire() as con:
+            # all views see the same rows, which include all writes up to the recorded position
+            async with con.transaction(isolation="repeatable_read", readonly=True):
+                position = parse_lsn(await con.fetchval("SELECT pg_current_wal_lsn()::text;"))
+                views = {}
+                for view in layer.views.values():
+                    rows = await con.fetch(view_snapshot_query(layer, view), version)
+                    views[view.name] = ViewSnapshot(
+                        layer.name,
+                        view.fingerprint,
+                        view_attribute_names(view),
+                        [(row[0], row[1]) for row in rows],
+                        [tuple(row)[2:] for row in rows],
+                    )
+        logger.info("loaded %s version %s in memory", layer.name, version)
+        return LayerSnapshot(position, views)
@@ -1,63 +1,199 @@
-from enum import Enum
 from collections import defaultdict
-from typing import Set, List, Dict, Any, Optional
-from fastapi import APIRouter, Depends, HTTPException, Body, Query
-from fastapi.responses import Response
-from .config import Config, get_config, Layer, Field, View
+from typing import Set, List, Dict, Any, AsyncIterator, Tuple
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
+from starlette.background import BackgroundTask
+from .config import Config, get_config, Field, Layer, View, PayloadError
 from .settings import Settings, get_settings
 from .psql import PSQLPool
 from .redis import RedisPool
+from .disk_cache import DiskTileCache
+from .tracing import span
+from .tile_refresher import TileRefresher
+from .arrow_ingest import ARROW_STREAM_CONTENT_TYPE, insert_arrow_payload
+from .tile_index import find_indexed_affected_tiles, find_indexed_tiles, insert_tile_index_rows
+from .generations import GENERATION_CHECK_INTERVAL, get_staging_version, read_cache_generation
+from .truncate import delete_version_rows
 from .layer_cache import (
     invalidate_cache,
     invalidate_full_layer_cache,
+    record_write_position,
+    drop_previous_cache_generation_later,
+    switch_cache_generation,
     find_affected_tiles,
     AffectedTile,
 )
 
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
 router = APIRouter()
 
 
-def validate_payload(
-        layer: Layer,
-        payload: List[Dict[str, Any]],
-        mandatory_fields: Optional[Set[Field]] = None
-):
-    if mandatory_fields is None:
-        mandatory_fields = set()
-    mandatory_fields.add(layer.id_field)
+# the number of rows validated and sent to the database at once
+INSERT_BATCH_SIZE = 5000
+NDJSON_CONTENT_TYPES = {"application/x-ndjson", "application/jsonlines"}
+
+
+def raise_payload_error(error: PayloadError):
+    detail = {"details": error.details, "row": error.row_index}
+    if error.choices is not None:
+        detail["choices"] = error.choices
+    raise HTTPException(status_code=400, detail=detail)
+
+
+def parse_json(data: bytes):
+    try:
+        return json_loads(data)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail={"details": f"Invalid JSON: {err}"})
 
-    valid_fields = layer.fields.keys()
 
-    # check each entry
-    for row in payload:
-        for field_name in row.keys():
-            if field_name not in valid_fields:
-                raise HTTPException(status_code=400, detail={
-                    "details": f"Unknown field name `{field_name}`",
-                    "choices": list(valid_fields)
-                })
+def get_content_type(request: Request) -> str:
+    """The media type of the request body, without its parameters"""
+    return request.headers.get("content-type", "application/json").split(";")[0].strip()
 
-        for mandatory_field in mandatory_fields:
-            if mandatory_field.name not in row.keys():
-                raise HTTPException(status_code=400, detail={
-                    "details": f"Field `{mandatory_field}` is mandatory.",
-                    "choices": list(row.keys())
-                })
+
+async def read_payload_batches(request: Request, batch_size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Reads rows from the request body, either as a JSON array or as newline
+    delimited JSON objects, which are parsed as the body is received.
+    JSON arrays are parsed once the whole body is received.
+    """
+    if get_content_type(request) not in NDJSON_CONTENT_TYPES:
+        body = await request.body()
+        with span("insert.parse"):
+            rows = parse_json(body)
+        if type(rows) is not list:
+            raise HTTPException(status_code=400, detail={"details": "The payload must be a list of rows"})
+        for batch_start in range(0, len(rows), batch_size):
+            yield rows[batch_start:batch_start + batch_size]
+        return
+
+    batch: List[Dict[str, Any]] = []
+    remainder = b""
+    async for chunk in request.stream():
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line.strip():
+                batch.append(parse_json(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if remainder.strip():
+        batch.append(parse_json(remainder))
+    if batch:
+        yield batch
 
 
 @router.post('/push/{layer_slug}/insert/')
 async def insert(
         layer_slug: str,
+        request: Request,
         version: str = Query(...),
-        payload: List[Dict[str, Any]] = Body(...),
         config: Config = Depends(get_config),
         settings: Settings = Depends(get_settings),
         psql=Depends(PSQLPool.get),
         redis=Depends(RedisPool.get),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
+        refresher: TileRefresher = Depends(TileRefresher.get),
 ):
+    """
+    Inserts rows into a layer version. The body is either a JSON array of rows,
+    newline delimited JSON rows (with an application/x-ndjson content type),
+    or an Arrow IPC stream (application/vnd.apache.arrow.stream) with WKB geometries.
+    """
     layer = config.layers[layer_slug]
-    validate_payload(layer, payload, {view.on_field for view in layer.views.values()})
+    async with psql.transaction():
+        affected_tiles = await insert_payload(psql, request, layer, version, settings.max_zoom)
+    await record_write_position(psql, redis, layer, version)
+    generation = await read_cache_generation(redis, layer, version)
+    with span("insert.invalidate_cache"):
+        response = await invalidate_cache(redis, disk_cache, layer, version, affected_tiles, generation)
+    refresher.regenerate_popular(layer, version, affected_tiles)
+    return response
+
+
+@router.post('/push/{layer_slug}/stage/')
+async def stage(
+        layer_slug: str,
+        request: Request,
+        version: str = Query(...),
+        reset: bool = Query(False, description="drop the rows staged so far"),
+        config: Config = Depends(get_config),
+        settings: Settings = Depends(get_settings),
+        psql=Depends(PSQLPool.get),
+):
+    """
+    Inserts rows into the staging area of a layer version, with the same payloads as insert.
+    Staged rows are hidden until the version is published.
+    """
+    layer = config.layers[layer_slug]
+    staging_version = get_staging_version(version)
+    async with psql.transaction():
+        if reset:
+            await delete_version_rows(psql, layer, staging_version)
+        await insert_payload(psql, request, layer, staging_version, settings.max_zoom)
+    return JSONResponse(status_code=201, content={})
+
+
+@router.post('/push/{layer_slug}/publish/')
+async def publish(
+        layer_slug: str,
+        version: str = Query(...),
+        config: Config = Depends(get_config),
+        settings: Settings = Depends(get_settings),
+        psql=Depends(PSQLPool.get),
+        redis=Depends(RedisPool.get),
+        redis_pool: RedisPool = Depends(RedisPool.get_pool),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
+):
+    """
+    Atomically replaces the rows of a layer version with its staged rows.
+    The version then moves to a new cache namespace, so that readers
+    switch from the previous tiles to the new ones in a single step.
+    """
+    layer = config.layers[layer_slug]
+    staging_version = get_staging_version(version)
+    async with psql.transaction():
+        # concurrent publications of a version wait for each other
+        await psql.execute(
+            "SELECT pg_advisory_xact_lock(hashtext($1));", f"chartos.publish.{layer.name}.{version}")
+        has_staged_rows = await psql.fetchval(
+            f"SELECT EXISTS (SELECT 1 FROM {layer.pg_table_name()} WHERE version = $1);", staging_version)
+        if not has_staged_rows:
+            raise HTTPException(status_code=404, detail={"details": f"Version `{version}` has no staged rows"})
+        await delete_version_rows(psql, layer, version)
+        await psql.execute(
+            f"UPDATE {layer.pg_table_name()} SET version = $1 WHERE version = $2;", version, staging_version)
+        if layer.tile_index_zoom is not None:
+            await psql.execute(
+                f"UPDATE {layer.pg_tile_index_table_name()} SET version = $1 WHERE version = $2;",
+                version, staging_version,
+            )
+    await record_write_position(psql, redis, layer, version)
+    generation = await switch_cache_generation(redis, disk_cache, layer, version)
+    impacted_tiles = {view_name: ['*'] for view_name in layer.views}
+    # workers may take up to GENERATION_CHECK_INTERVAL to switch, and finish the renders they started before
+    drop_delay = GENERATION_CHECK_INTERVAL + settings.render_timeout
+    return JSONResponse(
+        status_code=201,
+        content={'impacted_tiles': impacted_tiles},
+        background=BackgroundTask(
+            drop_previous_cache_generation_later, redis_pool, disk_cache, layer, version, generation, drop_delay),
+    )
+
+
+async def insert_payload(psql, request: Request, layer: Layer, version: str, max_zoom: int):
+    """Inserts the rows of a push payload, and returns the affected tiles. This must run inside a transaction."""
+    if get_content_type(request) == ARROW_STREAM_CONTENT_TYPE:
+        with span("insert.arrow"):
+            return await insert_arrow_payload(psql, layer, version, await request.body(), max_zoom)
 
     # get which fields are indexed by views
     viewed_fields: Dict[Field, View] = layer.get_viewed_fields()
@@ -73,19 +209,120 @@ async def insert(
                 yield None
                 continue
             # convert it for insertion in the database
-            field_data = layer_field.from_json(json_field)
-            # if this field has an impact on views, find affected tiles
-            if layer_field in viewed_fields:
-                affected_tiles[layer_field].update(
-                    find_affected_tiles(settings.max_zoom, field_data))
-            yield field_data
-
-    records = [tuple(build_pg_record(data)) for data in payload]
+            yield layer_field.from_json(json_field)
+
+    def find_records_affected_tiles(records) -> List[Tuple]:
+        """
+        Finds the tiles affected by the fields which have an impact on views,
+        and returns the tile index rows of the records, if the layer has one
+        """
+        index_rows = []
+        id_index = layer.get_pg_field_index(layer.id_field)
+        for viewed_field in viewed_fields:
+            field_index = layer.get_pg_field_index(viewed_field)
+            field_affected_tiles = affected_tiles[viewed_field]
+            for record in records:
+                field_data = record[field_index]
+                if field_data is None:
+                    continue
+                if layer.tile_index_zoom is None:
+                    field_affected_tiles.update(find_affected_tiles(max_zoom, field_data))
+                    continue
+                tiles, quadkeys = find_indexed_tiles(max_zoom, layer.tile_index_zoom, field_data)
+                field_affected_tiles.update(tiles)
+                index_rows.extend((version, record[id_index], viewed_field.name, quadkey) for quadkey in quadkeys)
+        return index_rows
+
     field_names = list(layer.pg_field_names())
     field_placeholder = ", ".join(f"${i + 1}" for i in range(len(field_names)))
     query = (
         f"insert into {layer.pg_table_name()} ({', '.join(field_names)}) "
         f"values ({field_placeholder})"
     )
-    await psql.executemany(query, records)
-    return await invalidate_cache(redis, layer, version, affected_tiles)
+
+    # batches are inserted as they are received, but either all or none are committed
+    row_count = 0
+    async for rows in read_payload_batches(request, INSERT_BATCH_SIZE):
+        try:
+            with span("insert.validate"):
+                layer.validator.validate(rows, row_count)
+        except PayloadError as err:
+            raise_payload_error(err)
+        row_count += len(rows)
+        with span("insert.build_records"):
+            records = [tuple(build_pg_record(data)) for data in rows]
+        with span("insert.find_affected_tiles"):
+            index_rows = find_records_affected_tiles(records)
+        with span("insert.executemany"):
+            await psql.executemany(query, records)
+        if index_rows:
+            with span("insert.tile_index"):
+                await insert_tile_index_rows(psql, layer, index_rows)
+    return affected_tiles
+
+
+@router.post('/push/{layer_slug}/delete/')
+async def delete(
+        layer_slug: str,
+        version: str = Query(...),
+        feature_ids: List[Any] = Body(..., description="the ids of the features to delete"),
+        config: Config = Depends(get_config),
+        settings: Settings = Depends(get_settings),
+        psql=Depends(PSQLPool.get),
+        redis=Depends(RedisPool.get),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
+        refresher: TileRefresher = Depends(TileRefresher.get),
+):
+    """Deletes features from a layer version, given their ids"""
+    layer = config.layers[layer_slug]
+    id_field = layer.id_field
+    id_json_types = layer.validator.field_json_types.get(id_field.name)
+    for row_index, feature_id in enumerate(feature_ids):
+        if feature_id is None or (id_json_types is not None and type(feature_id) not in id_json_types):
+            raise_payload_error(PayloadError(row_index, f"Invalid feature id {feature_id!r}"))
+
+    viewed_fields = list(layer.get_viewed_fields())
+    returned_fields = ", ".join(field.pg_name() for field in [id_field, *viewed_fields])
+    feature_ids_param = f"$2::{id_field.pg_type()}[]"
+    index_rows = []
+    async with psql.transaction():
+        with span("delete.execute"):
+            deleted_rows = await psql.fetch(
+                f"DELETE FROM {layer.pg_table_name()} "
+                f"WHERE version = $1 AND {id_field.pg_name()} = ANY({feature_ids_param}) "
+                f"RETURNING {returned_fields}",
+                version, feature_ids,
+            )
+            if layer.tile_index_zoom is not None:
+                index_rows = await psql.fetch(
+                    f"DELETE FROM {layer.pg_tile_index_table_name()} "
+                    f"WHERE version = $1 AND feature_id = ANY({feature_ids_param}) "
+                    "RETURNING feature_id, field, quadkey",
+                    version, feature_ids,
+                )
+
+    # with a tile index, only tiles deeper than the index zoom need to be searched
+    feature_quadkeys: Dict[Tuple[Any, str], List[int]] = defaultdict(list)
+    for feature_id, field_name, quadkey in index_rows:
+        feature_quadkeys[feature_id, field_name].append(quadkey)
+
+    affected_tiles: Dict[Field, Set[AffectedTile]] = defaultdict(set)
+    with span("delete.find_affected_tiles"):
+        for row in deleted_rows:
+            for field_index, viewed_field in enumerate(viewed_fields, 1):
+                geom = row[field_index]
+                if geom is None:
+                    continue
+                if layer.tile_index_zoom is None:
+                    tiles = find_affected_tiles(settings.max_zoom, geom)
+                else:
+                    quadkeys = feature_quadkeys[row[0], viewed_field.name]
+                    tiles = find_indexed_affected_tiles(settings.max_zoom, geom, quadkeys, layer.tile_index_zoom)
+                affected_tiles[viewed_field].update(tiles)
+
+    await record_write_position(psql, redis, layer, version)
+    generation = await read_cache_generation(redis, layer, version)
+    with span("delete.invalidate_cache"):
+        response = await invalidate_cache(redis, disk_cache, layer, version, affected_tiles, generation)
+    refresher.regenerate_popular(layer, version, affected_tiles)
+    return response
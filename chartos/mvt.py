@@ -0,0 +1,158 @@
+import struct
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+# a python implementation of ST_AsMVTGeom and ST_AsMVT for points, for tiles rendered without postgis.
+# see https://github.com/mapbox/vector-tile-spec/tree/master/2.1 for the format
+
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+
+GEOM_POINT = 1
+
+CMD_MOVE_TO = 1
+
+# protobuf wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+
+DOUBLE = struct.Struct("<d")
+
+
+def mvt_point(
+        x: float,
+        y: float,
+        bounds: Tuple[float, float, float, float],
+        extent: int = MVT_EXTENT,
+        buffer: int = MVT_BUFFER,
+) -> Optional[Tuple[int, int]]:
+    """
+    Converts a point to the integer coordinates of a tile, like ST_AsMVTGeom: the point
+    is transformed with the same floating point operations, snapped to the tile grid,
+    and dropped when it isn't inside the tile and its buffer.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    scale_x = extent / (max_x - min_x)
+    scale_y = -extent / (max_y - min_y)
+    # tile coordinates have their origin at the top left corner.
+    # like rint, round rounds halves to even
+    tile_x = int(round(scale_x * x + -min_x * scale_x))
+    tile_y = int(round(scale_y * y + -max_y * scale_y))
+    if not (-buffer <= tile_x <= extent + buffer and -buffer <= tile_y <= extent + buffer):
+        return None
+    return tile_x, tile_y
+
+
+def zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def encode_varint(value: int, out: bytearray):
+    # negative numbers are encoded as 64 bits two's complement
+    value &= 0xFFFFFFFFFFFFFFFF
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_key(field_number: int, wire_type: int, out: bytearray):
+    encode_varint((field_number << 3) | wire_type, out)
+
+
+def encode_bytes(field_number: int, data: bytes, out: bytearray):
+    encode_key(field_number, WIRE_LENGTH_DELIMITED, out)
+    encode_varint(len(data), out)
+    out += data
+
+
+def encode_packed(field_number: int, values: Iterable[int], out: bytearray):
+    packed = bytearray()
+    for value in values:
+        encode_varint(value, packed)
+    encode_bytes(field_number, packed, out)
+
+
+def encode_value(value: Any) -> bytes:
+    """Encodes an attribute value, with the types ST_AsMVT uses for postgresql values"""
+    out = bytearray()
+    if isinstance(value, str):
+        encode_bytes(1, value.encode(), out)
+    elif isinstance(value, bool):
+        encode_key(7, WIRE_VARINT, out)
+        encode_varint(int(value), out)
+    elif isinstance(value, int):
+        if value >= 0:
+            encode_key(5, WIRE_VARINT, out)
+            encode_varint(value, out)
+        else:
+            encode_key(6, WIRE_VARINT, out)
+            encode_varint(zigzag(value), out)
+    elif isinstance(value, float):
+        encode_key(3, WIRE_FIXED64, out)
+        out += DOUBLE.pack(value)
+    else:
+        raise TypeError(f"unsupported attribute type: {type(value).__name__}")
+    return bytes(out)
+
+
+class MVTLayerEncoder:
+    """
+    Builds a tile with a single layer of points. Like ST_AsMVT, values are shared by
+    features in order of appearance, and fields are written in field number order.
+    """
+
+    def __init__(self, name: str, key_names: Sequence[str], extent: int = MVT_EXTENT):
+        self.name = name
+        self.extent = extent
+        # like ST_AsMVT, all attribute columns are keys, even when all their values are null
+        self.key_names = list(key_names)
+        self.values: Dict[Tuple[type, Any], int] = {}
+        self.encoded_values: List[bytes] = []
+        self.features: List[bytes] = []
+
+    def value_index(self, value: Any) -> int:
+        # 1 and True, or 1 and 1.0 are distinct values. ST_AsMVT compares doubles by their bytes
+        value_key = (type(value), DOUBLE.pack(value) if isinstance(value, float) else value)
+        index = self.values.get(value_key)
+        if index is None:
+            index = self.values[value_key] = len(self.encoded_values)
+            self.encoded_values.append(encode_value(value))
+        return index
+
+    def add_point(self, x: int, y: int, attributes: Sequence[Any]):
+        """Adds a point in tile coordinates, with attribute values in the order of keys"""
+        tags = []
+        for key_index, value in enumerate(attributes):
+            if value is None:
+                continue
+            tags.append(key_index)
+            tags.append(self.value_index(value))
+        feature = bytearray()
+        if tags:
+            encode_packed(2, tags, feature)
+        encode_key(3, WIRE_VARINT, feature)
+        encode_varint(GEOM_POINT, feature)
+        encode_packed(4, [(1 << 3) | CMD_MOVE_TO, zigzag(x), zigzag(y)], feature)
+        self.features.append(bytes(feature))
+
+    def encode(self) -> bytes:
+        # like ST_AsMVT, tiles without features are empty
+        if not self.features:
+            return b""
+        layer = bytearray()
+        encode_bytes(1, self.name.encode(), layer)
+        for feature in self.features:
+            encode_bytes(2, feature, layer)
+        for key_name in self.key_names:
+            encode_bytes(3, key_name.encode(), layer)
+        for encoded_value in self.encoded_values:
+            encode_bytes(4, encoded_value, layer)
+        encode_key(5, WIRE_VARINT, layer)
+        encode_varint(self.extent, layer)
+        encode_key(15, WIRE_VARINT, layer)
+        encode_varint(2, layer)
+        tile = bytearray()
+        encode_bytes(3, layer, tile)
+        return bytes(tile)
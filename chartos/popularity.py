@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import random
+from typing import List, Optional
+
+from .config import Layer, View
+from .redis import RedisPool
+from .layer_cache import AffectedTile
+from .utils import AsyncProcess, process_dependable
+
+
+logger = logging.getLogger(__name__)
+
+
+POPULARITY_PREFIX = "chartis.popularity."
+# held by the worker decaying popularity scores
+DECAY_LOCK_KEY = "chartis.popularity_decay"
+# the number of tiles kept per view after each decay
+POPULARITY_MAX_TILES = 10000
+# the scores of versions which aren't viewed anymore expire after this many half lives
+POPULARITY_TTL_HALF_LIVES = 8
+
+
+def get_popularity_key(layer: Layer, version: str, view: View) -> str:
+    return f"{POPULARITY_PREFIX}{layer.name}.version_{version}.{view.name}"
+
+
+class PopularityTracker(AsyncProcess):
+    """
+    Counts tile accesses per view in redis sorted sets, on the first redis node.
+    Only a sample of accesses are counted, and scores are halved every half life,
+    so that they track recent traffic.
+    """
+
+    def __init__(self, redis_pool: RedisPool, sample_rate: float, half_life: int):
+        self.redis_pool = redis_pool
+        self.sample_rate = sample_rate
+        self.half_life = half_life
+        self.decay_task: Optional[asyncio.Task] = None
+
+    async def on_startup(self):
+        if self.sample_rate > 0:
+            self.decay_task = asyncio.create_task(self.decay_loop())
+
+    async def on_shutdown(self):
+        if self.decay_task is None:
+            return
+        self.decay_task.cancel()
+        await asyncio.gather(self.decay_task, return_exceptions=True)
+        self.decay_task = None
+
+    @process_dependable
+    async def get(self) -> "PopularityTracker":
+        yield self
+
+    async def record(self, redis, layer: Layer, version: str, view: View, tile: AffectedTile):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return
+        member = f"{tile.z}/{tile.x}/{tile.y}"
+        key = get_popularity_key(layer, version, view)
+        async with redis.primary.pipeline(transaction=False) as pipe:
+            pipe.zincrby(key, 1 / self.sample_rate, member)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    @property
+    def ttl(self) -> int:
+        return self.half_life * POPULARITY_TTL_HALF_LIVES
+
+    async def most_popular(self, redis, layer: Layer, version: str, view: View, count: int) -> List[AffectedTile]:
+        members = await redis.primary.zrevrange(get_popularity_key(layer, version, view), 0, count - 1)
+        tiles = []
+        for member in members:
+            z, x, y = map(int, member.split(b"/"))
+            tiles.append(AffectedTile(x, y, z))
+        return tiles
+
+    async def decay_loop(self):
+        while True:
+            # check a few times per half life, in case the worker holding the lock dies
+            await asyncio.sleep(self.half_life / 4)
+            try:
+                await self.decay()
+            except Exception:
+                logger.exception("failed to decay tile popularity")
+
+    async def decay(self):
+        redis = self.redis_pool.acquire().primary
+        # only one worker decays scores per half life
+        if not await redis.set(DECAY_LOCK_KEY, b"", nx=True, ex=self.half_life):
+            return
+        async for key in redis.scan_iter(match=f"{POPULARITY_PREFIX}*"):
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.zunionstore(key, {key: 0.5})
+                # forget tiles which weren't accessed recently, and keep the most popular ones
+                pipe.zremrangebyscore(key, "-inf", "(1")
+                pipe.zremrangebyrank(key, 0, -POPULARITY_MAX_TILES - 1)
+                # ZUNIONSTORE drops the expiration of the key
+                pipe.expire(key, self.ttl)
+                await pipe.execute()
@@ -1,18 +1,127 @@
+import asyncio
+import logging
+import math
+import time
 import asyncpg
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
 from fastapi import FastAPI
-from .utils import AsyncProcess, process_dependable
+from .utils import AsyncProcess, PriorityLimiter, WaitStats, process_dependable
+from .tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AdaptiveSizing:
+    """
+    Adaptive pools start with min_size usable connections, and allow one more connection
+    when the 95th percentile of acquisition waits of the last interval is above target_wait.
+    When connections are barely waited for, they allow one less, down to min_size.
+    """
+    target_wait: float
+    interval: float = 5
+
+
+class MonitoredPool:
+    """An asyncpg pool which measures how long connections are waited for"""
+
+    def __init__(self, name: str, pool: asyncpg.Pool, adaptive: Optional[AdaptiveSizing] = None):
+        self.name = name
+        self.pool = pool
+        self.adaptive = adaptive
+        self.waits = WaitStats()
+        self.interval_waits: List[float] = []
+        # adaptive pools limit how many of the connections of the asyncpg pool can be used.
+        # connections above the limit end up idle, and get closed by asyncpg after a while
+        self.limiter: Optional[PriorityLimiter] = None
+        if adaptive is not None:
+            self.limiter = PriorityLimiter(pool.get_min_size(), math.inf)
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        with span("psql.acquire"):
+            if self.limiter is not None:
+                await self.limiter.acquire(0)
+            try:
+                con = await self.pool.acquire()
+            except BaseException:
+                if self.limiter is not None:
+                    self.limiter.release()
+                raise
+        wait = time.perf_counter() - start
+        self.waits.record(wait)
+        self.interval_waits.append(wait)
+        try:
+            yield con
+        finally:
+            await self.pool.release(con)
+            if self.limiter is not None:
+                self.limiter.release()
+
+    def resize(self):
+        """Adjusts the connection limit of adaptive pools, using the waits since the last call"""
+        assert self.adaptive is not None and self.limiter is not None
+        interval_waits = sorted(self.interval_waits)
+        self.interval_waits.clear()
+        if not interval_waits:
+            return
+        p95_wait = interval_waits[math.ceil(0.95 * len(interval_waits)) - 1]
+        limit = self.limiter.concurrency
+        if p95_wait > self.adaptive.target_wait and limit < self.pool.get_max_size():
+            limit += 1
+        elif p95_wait < self.adaptive.target_wait / 10 and limit > self.pool.get_min_size():
+            limit -= 1
+        if limit != self.limiter.concurrency:
+            logger.info("resizing the %s postgresql pool to %d connections", self.name, limit)
+            self.limiter.set_concurrency(limit)
+
+    async def resize_loop(self):
+        assert self.adaptive is not None
+        while True:
+            await asyncio.sleep(self.adaptive.interval)
+            self.resize()
+
+    def stats(self) -> Dict[str, Any]:
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "name": self.name,
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "limit": self.limiter.concurrency if self.limiter is not None else None,
+            "waiting": self.limiter.queued if self.limiter is not None else None,
+            "wait": self.waits.percentiles(),
+        }
+
+
+async def create_monitored_pool(name: str, settings: Dict[str, Any], adaptive: Optional[AdaptiveSizing]):
+    return MonitoredPool(name, await asyncpg.create_pool(**settings), adaptive)
 
 
 class PSQLPool(AsyncProcess):
-    def __init__(self, settings):
-        self.pool = None
+    def __init__(self, settings, adaptive: Optional[AdaptiveSizing] = None):
+        self.pool: Optional[MonitoredPool] = None
         self.settings = settings
+        self.adaptive = adaptive
+        self.resize_task: Optional[asyncio.Task] = None
 
     async def on_startup(self):
-        self.pool = await asyncpg.create_pool(**self.settings)
+        self.pool = await create_monitored_pool("primary", self.settings, self.adaptive)
+        if self.adaptive is not None:
+            self.resize_task = asyncio.create_task(self.pool.resize_loop())
 
     async def on_shutdown(self):
-        await self.pool.close()
+        if self.resize_task is not None:
+            self.resize_task.cancel()
+            await asyncio.gather(self.resize_task, return_exceptions=True)
+        await self.pool.pool.close()
 
     def acquire(self):
         return self.pool.acquire()
@@ -21,3 +130,84 @@ class PSQLPool(AsyncProcess):
     async def get(self) -> asyncpg.Connection:
         async with self.acquire() as con:
             yield con
+
+    @process_dependable
+    async def get_pool(self) -> "PSQLPool":
+        yield self
+
+
+class PSQLReadPool(AsyncProcess):
+    """
+    Connections used to render tiles. When read replicas are configured,
+    each render goes to the least busy replica, and to the primary otherwise.
+    """
+
+    def __init__(
+            self,
+            replica_settings: List[Dict[str, Any]],
+            primary: PSQLPool,
+            adaptive: Optional[AdaptiveSizing] = None,
+    ):
+        self.replica_settings = replica_settings
+        self.primary = primary
+        self.adaptive = adaptive
+        self.pools: List[MonitoredPool] = []
+        self.in_use: List[int] = []
+        self.next_pool = 0
+        self.resize_tasks: List[asyncio.Task] = []
+
+    async def on_startup(self):
+        self.pools = list(await asyncio.gather(*(
+            create_monitored_pool(f"replica_{i}", settings, self.adaptive)
+            for i, settings in enumerate(self.replica_settings)
+        )))
+        self.in_use = [0] * len(self.pools)
+        if self.adaptive is not None:
+            self.resize_tasks = [asyncio.create_task(pool.resize_loop()) for pool in self.pools]
+
+    async def on_shutdown(self):
+        for task in self.resize_tasks:
+            task.cancel()
+        await asyncio.gather(*self.resize_tasks, return_exceptions=True)
+        await asyncio.gather(*(pool.pool.close() for pool in self.pools))
+
+    @property
+    def has_replicas(self) -> bool:
+        return bool(self.pools)
+
+    def pick_replica(self) -> int:
+        # start at a different replica every time, so that ties are broken round robin
+        pool_count = len(self.pools)
+        start = self.next_pool
+        self.next_pool = (start + 1) % pool_count
+        candidates = ((start + i) % pool_count for i in range(pool_count))
+        return min(candidates, key=lambda i: self.in_use[i])
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.pools:
+            async with self.primary.acquire() as con:
+                yield con
+            return
+
+        replica = self.pick_replica()
+        self.in_use[replica] += 1
+        try:
+            async with self.pools[replica].acquire() as con:
+                yield con
+        finally:
+            self.in_use[replica] -= 1
+
+    async def is_caught_up(self, con: asyncpg.Connection, write_position: Optional[bytes]) -> bool:
+        """Checks whether a connection sees all writes up to a given WAL position"""
+        if not self.pools or write_position is None:
+            return True
+        # pg_last_wal_replay_lsn is null on the primary, which is always up to date
+        return await con.fetchval(
+            "SELECT coalesce(pg_last_wal_replay_lsn() >= $1::pg_lsn, true);",
+            write_position.decode(),
+        )
+
+    @process_dependable
+    async def get_pool(self) -> "PSQLReadPool":
+        yield self
@@ -1,11 +1,145 @@
-from aioredis import Redis, ConnectionPool
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+from aioredis import Redis, BlockingConnectionPool
 from fastapi import FastAPI
-from .utils import AsyncProcess, process_dependable
+from .utils import AsyncProcess, HashRing, WaitStats, process_dependable
+
+
+class MonitoredConnectionPool(BlockingConnectionPool):
+    """A connection pool which measures how long connections are waited for"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = WaitStats()
+
+    async def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        connection = await super().get_connection(command_name, *keys, **options)
+        self.waits.record(time.perf_counter() - start)
+        return connection
+
+    def stats(self) -> Dict[str, Any]:
+        # the queue holds idle connections, and placeholders for connections which weren't opened yet
+        in_use = self.max_connections - self.pool.qsize()
+        size = len(self._connections)
+        return {
+            "size": size,
+            "in_use": in_use,
+            "idle": size - in_use,
+            "max_size": self.max_connections,
+            "wait": self.waits.percentiles(),
+        }
+
+
+class ShardedRedis:
+    """
+    A redis client which spreads keys over several redis nodes.
+    Single key commands are routed to the node which owns the key,
+    multi-key commands are split by node and run in parallel, and
+    all other commands run on the first node.
+    """
+    __slots__ = ("ring", "shards", "tile_block_bits")
+
+    def __init__(self, ring: HashRing[int], shards: List[Redis], tile_block_bits: Optional[int] = None):
+        self.ring = ring
+        self.shards = shards
+        # when set, tiles are grouped in hashes (see layer_cache.get_tile_block_key)
+        self.tile_block_bits = tile_block_bits
+
+    @property
+    def primary(self) -> Redis:
+        return self.shards[0]
+
+    def shard_for(self, key: str) -> Redis:
+        if len(self.shards) == 1:
+            return self.primary
+        return self.shards[self.ring.get_node(key)]
+
+    def group_by_shard(self, keys: Sequence[str]) -> Dict[int, List[int]]:
+        """Returns, for each shard, the indices of the keys it owns"""
+        if len(self.shards) == 1:
+            return {0: list(range(len(keys)))}
+        groups: Dict[int, List[int]] = defaultdict(list)
+        for i, key in enumerate(keys):
+            groups[self.ring.get_node(key)].append(i)
+        return groups
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.shard_for(key).get(key)
+
+    async def set(self, key: str, value, **kwargs):
+        return await self.shard_for(key).set(key, value, **kwargs)
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        groups = self.group_by_shard(keys)
+        results: List[Optional[bytes]] = [None] * len(keys)
+
+        async def shard_mget(shard: int, indices: List[int]):
+            values = await self.shards[shard].mget([keys[i] for i in indices])
+            for i, value in zip(indices, values):
+                results[i] = value
+        await asyncio.gather(*(shard_mget(shard, indices) for shard, indices in groups.items()))
+        return results
+
+    async def delete(self, *keys: str) -> int:
+        if not keys:
+            return 0
+        groups = self.group_by_shard(keys)
+        deleted = await asyncio.gather(*(
+            self.shards[shard].delete(*(keys[i] for i in indices))
+            for shard, indices in groups.items()
+        ))
+        return sum(deleted)
+
+    async def delete_matching(self, pattern: str, batch_size: int = 1000):
+        """Deletes all keys matching a pattern, on all shards in parallel"""
+        async def shard_delete(shard: Redis):
+            batch = []
+            async for key in shard.scan_iter(match=pattern, count=batch_size):
+                batch.append(key)
+                if len(batch) == batch_size:
+                    await shard.delete(*batch)
+                    batch.clear()
+            if batch:
+                await shard.delete(*batch)
+        await asyncio.gather(*map(shard_delete, self.shards))
+
+    async def ping(self):
+        await asyncio.gather(*(shard.ping() for shard in self.shards))
+        return True
+
+    async def flushdb(self):
+        await asyncio.gather(*(shard.flushdb() for shard in self.shards))
+
+    async def close(self):
+        await asyncio.gather(*(shard.close() for shard in self.shards))
+
+    async def __aenter__(self) -> "ShardedRedis":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
 
 
 class RedisPool(AsyncProcess):
-    def __init__(self, url, max_conns=10):
-        self.pool = ConnectionPool.from_url(url, max_connections=max_conns)
+    def __init__(self, urls: List[str], max_conns=10, tile_block_bits: Optional[int] = None):
+        self.tile_block_bits = tile_block_bits
+        # remove duplicates, keeping the order
+        urls = list(dict.fromkeys(urls))
+        self.pools = [
+            MonitoredConnectionPool.from_url(url, max_connections=max_conns)
+            for url in urls
+        ]
+        # shards are named after their url, so that the key distribution
+        # doesn't depend on the order of the configuration
+        self.ring = HashRing([(url, i) for i, url in enumerate(urls)])
 
     async def on_startup(self):
         # the pool is lasily created on the first request,
@@ -13,15 +147,24 @@ class RedisPool(AsyncProcess):
         pass
 
     async def on_shutdown(self):
-        await self.pool.disconnect()
+        await asyncio.gather(*(pool.disconnect() for pool in self.pools))
 
-    def acquire(self):
-        return Redis(
-            connection_pool=self.pool,
-            single_connection_client=True
-        )
+    def acquire(self) -> ShardedRedis:
+        """
+        Returns a client which acquires a connection per command,
+        and can thus be used concurrently
+        """
+        return ShardedRedis(self.ring, [Redis(connection_pool=pool) for pool in self.pools], self.tile_block_bits)
 
     @process_dependable
-    async def get(self) -> Redis:
+    async def get(self) -> ShardedRedis:
         async with self.acquire() as conn:
             yield conn
+
+    @process_dependable
+    async def get_pool(self) -> "RedisPool":
+        yield self
+
+    def stats(self) -> List[Dict[str, Any]]:
+        # nodes are numbered rather than named after their url, which may hold credentials
+        return [{"name": f"node_{i}", **pool.stats()} for i, pool in enumerate(self.pools)]
@@ -0,0 +1,152 @@
+import signal
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+import yaml
+from aioredis import Redis
+from fastapi import FastAPI
+
+from .config import Config, Layer, View, get_config
+from .dbinit import DBInit
+from .disk_cache import DiskTileCache
+from .layer_cache import drop_view_cache
+from .redis import RedisPool
+from .serialized_config import SerializedConfig
+from .settings import Settings
+from .utils import AsyncProcess, process_dependable
+
+
+logger = logging.getLogger(__name__)
+
+
+# reloads started with the admin endpoint are announced to other workers on this channel
+CONFIG_RELOAD_CHANNEL = "chartis.config_reload"
+
+
+def read_config(settings: Settings) -> Config:
+    with open(settings.config_path) as f:
+        config_data = yaml.safe_load(f)
+        raw_config = SerializedConfig.parse_obj(config_data)
+        return Config.parse(raw_config)
+
+
+def changed_views(old_config: Config, new_config: Config) -> List[Tuple[Layer, View]]:
+    """Returns the views of the old configuration which are gone or render differently in the new one"""
+    changed = []
+    for layer in old_config.layers.values():
+        new_layer = new_config.layers.get(layer.name)
+        for view in layer.views.values():
+            new_view = None if new_layer is None else new_layer.views.get(view.name)
+            if new_view is None or new_view.fingerprint != view.fingerprint:
+                changed.append((layer, view))
+    return changed
+
+
+class ConfigReloader(AsyncProcess):
+    """
+    Reloads the layer configuration without restarting workers. Only the schema objects
+    and the cached tiles of views whose definition changed are affected.
+    """
+
+    def __init__(
+            self,
+            app: FastAPI,
+            settings: Settings,
+            config: Config,
+            dbinit: DBInit,
+            redis_pool: RedisPool,
+            disk_cache: DiskTileCache,
+    ):
+        self.app = app
+        self.settings = settings
+        self.config = config
+        self.dbinit = dbinit
+        self.redis_pool = redis_pool
+        self.disk_cache = disk_cache
+        # tells the reloads of this worker apart from the ones of others
+        self.worker_id = uuid4().hex
+        self.lock: Optional[asyncio.Lock] = None
+        self.listener: Optional[asyncio.Task] = None
+        self.signal_reload: Optional[asyncio.Task] = None
+
+    async def on_startup(self):
+        self.lock = asyncio.Lock()
+        self.listener = asyncio.create_task(self.listen())
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.on_sighup)
+        except (NotImplementedError, RuntimeError, ValueError, AttributeError):
+            logger.warning("configuration reloads on SIGHUP aren't supported here")
+
+    async def on_shutdown(self):
+        try:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        except (NotImplementedError, RuntimeError, ValueError, AttributeError):
+            pass
+        tasks = [task for task in (self.listener, self.signal_reload) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.listener = None
+        self.signal_reload = None
+
+    @process_dependable
+    async def get(self) -> "ConfigReloader":
+        yield self
+
+    def on_sighup(self):
+        logger.info("reloading the configuration on SIGHUP")
+        self.signal_reload = asyncio.create_task(self.reload_logged())
+
+    async def reload_logged(self):
+        try:
+            await self.reload()
+        except Exception:
+            logger.exception("failed to reload the configuration")
+
+    async def reload(self, publish: bool = False) -> List[Tuple[Layer, View]]:
+        """
+        Reloads the configuration of this worker, and returns the views whose definition changed.
+        When publish is set, outdated tiles are dropped from redis, and other workers reload too.
+        When the configuration is invalid, an exception is raised and the current configuration stays.
+        """
+        assert self.lock is not None
+        async with self.lock:
+            new_config = read_config(self.settings)
+            # new layers, fields and views may need new tables, columns and indexes
+            await self.dbinit.apply(new_config)
+            changed = changed_views(self.config, new_config)
+            # requests started before the swap finish with the previous configuration
+            get_config.setup(self.app, new_config)
+            self.config = new_config
+
+        # outdated tiles aren't served anymore, as changed views have a new cache namespace
+        async with self.redis_pool.acquire() as redis:
+            for layer, view in changed:
+                logger.info("the definition of view %s of layer %s changed", view.name, layer.name)
+                if publish:
+                    await drop_view_cache(redis, self.disk_cache, layer, view)
+                else:
+                    await self.disk_cache.clear_view(layer, view)
+            if publish:
+                await redis.publish(CONFIG_RELOAD_CHANNEL, self.worker_id)
+        return changed
+
+    async def listen(self):
+        while True:
+            try:
+                # pub/sub messages aren't sharded, they all go through the first node
+                redis = Redis(connection_pool=self.redis_pool.pools[0])
+                async with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(CONFIG_RELOAD_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message is None or message["type"] != "message":
+                            continue
+                        if message["data"].decode() != self.worker_id:
+                            await self.reload_logged()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("configuration reload listener failed, reconnecting")
+                await asyncio.sleep(1)
@@ -0,0 +1,167 @@
+import time
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from .config import Field, GeomField, JsonField
+from .psql import PSQLReadPool
+from .render_scheduler import RenderScheduler
+from .layer_cache import get_write_position_key, AffectedTile
+from .tile_stats import record_tile_stats
+from .tracing import span
+from .tile_index import has_tile_index, tile_index_filter
+
+if TYPE_CHECKING:
+    from .memory_render import MemoryLayerStore
+
+
+# the attribute holding the number of features of clusters
+CLUSTER_COUNT_FIELD = "point_count"
+CLUSTER_COUNT_DESCRIPTION = "the number of features of the cluster"
+
+
+async def render_tile(
+        read_pool: PSQLReadPool,
+        scheduler: RenderScheduler,
+        redis,
+        layer, version, view,
+        tile: AffectedTile,
+        priority: Optional[int] = None,
+        memory_store: Optional["MemoryLayerStore"] = None,
+        background: bool = False,
+) -> bytes:
+    """
+    Renders a tile on a read replica, unless it is behind the last write to the layer.
+    Renders waiting for their turn start by increasing priority, which defaults to the zoom level.
+    Background renders, which no user is waiting for, are admitted separately (see RenderScheduler).
+    Layers rendered in memory are rendered by the memory store, unless the view clusters the tile.
+    """
+    if priority is None:
+        priority = tile.z
+    in_memory = memory_store is not None and layer.render_in_memory and not view.is_clustered(tile.z)
+
+    async def load_write_position() -> Optional[bytes]:
+        # the position is read once the render got its slot, as writes may happen while it waits
+        if not read_pool.has_replicas and not in_memory:
+            return None
+        return await redis.get(get_write_position_key(layer, version))
+
+    if in_memory:
+        assert memory_store is not None
+        async with scheduler.slot(priority, background):
+            write_position = await load_write_position()
+            start = time.perf_counter()
+            with span("memory_render"):
+                tile_data, feature_count = await memory_store.render(layer, version, view, tile, write_position)
+            render_time = time.perf_counter() - start
+        record_tile_stats(layer, version, view, tile, len(tile_data), feature_count, render_time)
+        return tile_data
+
+    async def timed_query(psql) -> Tuple[bytes, int, float]:
+        async with scheduler.statement_timeout(psql):
+            start = time.perf_counter()
+            with span("mvt_query"):
+                tile_data, feature_count = await mvt_query_with_count(
+                    psql, layer, version, view, tile.z, tile.x, tile.y)
+            return tile_data, feature_count, time.perf_counter() - start
+
+    async with scheduler.slot(priority, background):
+        async with read_pool.acquire() as psql:
+            write_position = await load_write_position()
+            # the replica position is checked before rendering, as the render
+            # could otherwise use a snapshot older than the position
+            if await read_pool.is_caught_up(psql, write_position):
+                result = await timed_query(psql)
+            else:
+                result = None
+
+        if result is None:
+            async with read_pool.primary.acquire() as psql:
+                result = await timed_query(psql)
+
+    tile_data, feature_count, render_time = result
+    record_tile_stats(layer, version, view, tile, len(tile_data), feature_count, render_time)
+    return tile_data
+
+
+def select_field(field: Field) -> str:
+    field_name = field.pg_name()
+    if isinstance(field.type, GeomField):
+        return f"{field.pg_4326_name()} AS {field_name}"
+    if isinstance(field.type, JsonField):
+        return f"{field_name}::text"
+    return field_name
+
+
+async def mvt_query(psql, layer, version, view, z, x, y) -> bytes:
+    tile_data, _ = await mvt_query_with_count(psql, layer, version, view, z, x, y)
+    return tile_data
+
+
+async def mvt_query_with_count(psql, layer, version, view, z, x, y) -> Tuple[bytes, int]:
+    """Renders a tile, and counts the features it contains"""
+    view_field_names = ", ".join([
+        *map(select_field, view.fields),
+        *(projection.pg_select() for projection in view.json_projections),
+    ])
+    on_field_name = view.on_field.pg_name()
+    mvt_layer_name = f"'{layer.name}'"
+    # we only want objects which are inside the tile BBox
+    tile_filter = f"{on_field_name} && bbox.geom"
+    if layer.tile_index_zoom is not None and await has_tile_index(psql, layer, version):
+        index_filter = tile_index_filter(layer, view.on_field.name, AffectedTile(x, y, z), "$4")
+        # the index narrows down the candidate features, and the bbox filter still decides
+        # which are rendered, so that tiles don't depend on how features were indexed
+        tile_filter = f"{index_filter} AND {tile_filter}"
+    tile_content_subquery = (
+        "SELECT "
+        # the geometry the view is based on, converted to MVT. this field must
+        # come first for ST_AsMVT to index the tile on the correct geometry
+        f"ST_AsMVTGeom({on_field_name}, bbox.geom, 4096, 64) AS MVTGeom, "
+        # select all the fields and json projections the user requested
+        f"{view_field_names} "
+        # read from the table corresponding to the layer, as well as the bbox
+        # the bbox table is built by the WITH clause of the top-level query
+        f"FROM {layer.pg_table_name()}, bbox "
+        # filter by version
+        "WHERE version = $4 "
+        f"AND {tile_filter} "
+        # exclude geometry collections
+        f"AND NOT {view.on_field.pg_is_collection_name()}"
+    )
+    if layer.render_in_memory:
+        # features come in the same order as in tiles rendered in memory
+        tile_content_subquery += f" ORDER BY {layer.id_field.pg_name()}"
+    if view.is_clustered(z):
+        tile_content_subquery = cluster_subquery(view, tile_content_subquery)
+    query = (
+        # prepare the bbox of the tile for use in the tile content subquery
+        "WITH bbox AS (SELECT TileBBox($1, $2, $3, 3857) AS geom), "
+        # find all objects in the tile
+        f"tile_content AS ({tile_content_subquery}) "
+        # package those inside an MVT tile
+        f"SELECT ST_AsMVT(tile_content, {mvt_layer_name}), count(*) FROM tile_content"
+    )
+    (record,) = await psql.fetch(query, z, x, y, version)
+    return record.get("st_asmvt"), record.get("count")
+
+
+def cluster_subquery(view, tile_content_subquery: str) -> str:
+    """Groups the features of a tile into clusters, by snapping them to a grid in tile coordinates"""
+    attribute_names = [
+        *(view_field.pg_name() for view_field in view.fields),
+        *(projection.pg_name() for projection in view.json_projections),
+    ]
+    # clusters take the attributes of an arbitrary feature
+    representative_attributes = "".join(
+        f", (array_agg({attribute_name}))[1] AS {attribute_name}"
+        for attribute_name in attribute_names
+    )
+    return (
+        "SELECT "
+        # the geometry must come first, as in the features subquery
+        "ST_Centroid(ST_Collect(MVTGeom)) AS MVTGeom, "
+        f"count(*) AS {CLUSTER_COUNT_FIELD}"
+        f"{representative_attributes} "
+        f"FROM ({tile_content_subquery}) AS features "
+        "WHERE MVTGeom IS NOT NULL "
+        f"GROUP BY ST_SnapToGrid(ST_Centroid(MVTGeom), {view.cluster_grid_size})"
+    )
@@ -0,0 +1,101 @@
+import asyncpg
+from contextlib import asynccontextmanager
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from .utils import AsyncProcess, PriorityLimiter, QueueFull, process_dependable
+from .tracing import span
+
+
+class RenderUnavailable(Exception):
+    """Raised when a tile can't be rendered right now, and the client should retry later"""
+
+    def __init__(self, details: str, retry_after: int):
+        super().__init__(details)
+        self.details = details
+        self.retry_after = retry_after
+
+
+async def render_unavailable_handler(request: Request, exc: RenderUnavailable):
+    return JSONResponse(
+        {"detail": exc.details},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+class RenderScheduler(AsyncProcess):
+    """
+    Admission control for tile renders. Only a limited number of renders run at
+    once, so that they can't use up all database connections. Other renders wait
+    in a bounded queue, where low zoom tiles go first, as more users share them.
+    Background renders, such as regenerations and exports, first wait in a queue of
+    their own, so that only a few of them take places in the queue of user renders.
+    """
+
+    def __init__(
+            self,
+            concurrency: int,
+            queue_size: int,
+            timeout: float,
+            retry_after: int,
+            background_concurrency: int = 2,
+            background_queue_size: int = 256,
+    ):
+        self.limiter = PriorityLimiter(concurrency, queue_size)
+        self.background_limiter = PriorityLimiter(background_concurrency, background_queue_size)
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+    async def on_startup(self):
+        pass
+
+    async def on_shutdown(self):
+        pass
+
+    @asynccontextmanager
+    async def slot(self, priority: int, background: bool = False):
+        if not background:
+            async with self.render_slot(priority):
+                yield
+            return
+
+        try:
+            with span("render.background_queue"):
+                await self.background_limiter.acquire(priority)
+        except QueueFull:
+            raise RenderUnavailable("too many pending background tile renders", self.retry_after)
+        try:
+            async with self.render_slot(priority):
+                yield
+        finally:
+            self.background_limiter.release()
+
+    @asynccontextmanager
+    async def render_slot(self, priority: int):
+        try:
+            with span("render.queue"):
+                await self.limiter.acquire(priority)
+        except QueueFull:
+            raise RenderUnavailable("too many pending tile renders", self.retry_after)
+        try:
+            yield
+        finally:
+            self.limiter.release()
+
+    @asynccontextmanager
+    async def statement_timeout(self, con: asyncpg.Connection):
+        """Runs the queries of the block in a transaction, with the render timeout"""
+        if self.timeout <= 0:
+            yield con
+            return
+
+        try:
+            async with con.transaction():
+                await con.execute(f"SET LOCAL statement_timeout = {int(self.timeout * 1000)};")
+                yield con
+        except asyncpg.exceptions.QueryCanceledError:
+            raise RenderUnavailable("the tile took too long to render", self.retry_after)
+
+    @process_dependable
+    async def get(self) -> "RenderScheduler":
+        yield self
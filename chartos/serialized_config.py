@@ -8,13 +8,34 @@ class SerializedField(BaseModel):
     type: str
 
 
+class SerializedJsonProjection(BaseModel):
+    # the path of the projected value, starting with the json field name,
+    # such as components.signaling_type
+    path: str
+    # the name of the tile attribute, defaults to the path
+    name: Optional[str] = None
+    type: str = "text"
+    description: str = ""
+
+
 class SerializedView(BaseModel):
     name: str
     on_field: str
     fields: Optional[List[str]] = None
     exclude_fields: Optional[List[str]] = None
+    # values extracted from json fields. unless explicitly listed in fields,
+    # the json fields values are projected from are excluded from the view
+    json_projections: List[SerializedJsonProjection] = []
     # defaults to 1 hour
     cache_duration: Optional[int] = None
+    # when set, invalidated and expired tiles are served for up to max_stale
+    # seconds while they are rendered again in the background
+    max_stale: Optional[int] = None
+    # when set, tiles below this zoom level hold clusters of features snapped
+    # to a grid, with a point_count attribute and the attributes of one feature
+    cluster_below_zoom: Optional[int] = None
+    # the size of the cells of the clustering grid, out of a 4096 tile extent
+    cluster_grid_size: int = 256
 
 
 class SerializedLayer(BaseModel):
@@ -24,6 +45,13 @@ class SerializedLayer(BaseModel):
     views: List[SerializedView]
     description: Optional[str] = None
     attribution: Optional[str] = None
+    # when set, the tiles touched by each feature at this zoom level are stored
+    # in a side table at ingestion, which speeds up tile queries and invalidations
+    tile_index_zoom: Optional[int] = None
+    # when set, workers load the layer versions in memory and render their tiles
+    # without postgis, with the same content. this is meant for small layers of points,
+    # and all views must be on fields of type point
+    render_in_memory: bool = False
 
 
 class SerializedConfig(BaseModel):
@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, Literal
 from pydantic import BaseSettings
 from functools import lru_cache
 from chartos.utils import ValueDependable
@@ -17,15 +17,108 @@ class Settings(BaseSettings):
     psql_dsn: str
     psql_user: Optional[str] = None
     psql_password: Optional[str] = None
+    # tiles are rendered on read replicas when some are configured,
+    # writes and schema changes always go to the primary
+    psql_replica_dsns: List[str] = []
+    # the bounds of the size of each postgresql connection pool
+    psql_min_size: int = 10
+    psql_max_size: int = 10
+    # adaptive pools start using psql_min_size connections, and use more connections, up to
+    # psql_max_size, while the 95th percentile of acquisition times is above psql_target_wait seconds
+    psql_adaptive_pool: bool = False
+    psql_target_wait: float = 0.01
     redis_url: str
+    # additional redis nodes. tile keys are spread over all nodes using consistent
+    # hashing, and other keys are stored on the redis_url node
+    redis_shard_urls: List[str] = []
+    # the maximum number of connections to each redis node
+    redis_max_conns: int = 10
+    # with the keys layout, each tile is a redis key. with the hashes layout, tiles are
+    # grouped in a redis hash per block of 2^tile_cache_block_bits * 2^tile_cache_block_bits
+    # tiles, which uses less memory
+    tile_cache_layout: Literal["keys", "hashes"] = "keys"
+    tile_cache_block_bits: int = 4
+
+    def redis_urls(self) -> List[str]:
+        return [self.redis_url, *self.redis_shard_urls]
+
+    def tile_block_bits(self) -> Optional[int]:
+        if self.tile_cache_layout == "hashes":
+            return self.tile_cache_block_bits
+        return None
+
+    # optional on-disk tile cache, checked after redis and before postgresql
+    disk_cache_path: Optional[str] = None
+    disk_cache_mmap_size: int = 256 * 1024 * 1024
+    # how many tile files each disk cache thread keeps open, the least recently used are closed
+    disk_cache_max_open_files: int = 64
+    # expired tiles are deleted every disk_cache_purge_interval seconds. when set, the tiles closest
+    # to their expiration are deleted too, until tiles take less than disk_cache_max_size bytes
+    disk_cache_max_size: Optional[int] = None
+    disk_cache_purge_interval: float = 300
+
+    # how many tiles can be rendered at once, and how many renders can wait
+    # for their turn before the server starts answering 503
+    render_concurrency: int = 8
+    render_queue_size: int = 64
+    # the maximum duration of a tile query, in seconds. 0 disables the timeout
+    render_timeout: float = 30
+    # the Retry-After delay sent when a tile can't be rendered, in seconds
+    render_retry_after: int = 5
+    # how many background renders (regenerations and exports) can be running or waiting
+    # in the render queue at once. the others wait in a queue of their own, of
+    # render_background_queue_size renders
+    render_background_concurrency: int = 2
+    render_background_queue_size: int = 256
+
+    # how many versions of layers rendered in memory each worker keeps loaded
+    memory_render_max_versions: int = 8
+
+    # how many layer events can be pending for an event stream client,
+    # before they get replaced by a reset event
+    events_buffer_size: int = 64
+
+    # how many tiles are rendered in parallel when exporting a tile pyramid
+    export_concurrency: int = 4
+    # how many missing tiles of a batch request are loaded in parallel
+    batch_concurrency: int = 4
+
+    # the fraction of tile requests counted to track tile popularity. 0 disables tracking
+    popularity_sample_rate: float = 0.05
+    # popularity scores are halved after this many seconds
+    popularity_half_life: int = 3600
+    # after a push, at most this many of the most popular invalidated tiles
+    # of each view are rendered again in the background. 0 disables it
+    regeneration_count: int = 100
+    # how many tiles can be regenerated in parallel by each worker
+    regeneration_concurrency: int = 2
+
+    # the fraction of requests which traces are exported, between 0 and 1
+    trace_sample_rate: float = 0
+    # where traces are exported: stdout, or file:<path> to append json lines to a file
+    trace_exporter: str = "stdout"
+    # trace all requests, and send the duration of their stages in a Server-Timing header
+    trace_server_timing: bool = False
+
+    # the token expected in the X-Admin-Token header of admin endpoints,
+    # which are disabled when it isn't set
+    admin_token: Optional[str] = None
 
     def psql_settings(self):
         return {
             "dsn": self.psql_dsn,
             "user": self.psql_user,
             "password": self.psql_password,
+            "min_size": self.psql_min_size,
+            "max_size": self.psql_max_size,
         }
 
+    def psql_replica_settings(self):
+        return [
+            {**self.psql_settings(), "dsn": dsn}
+            for dsn in self.psql_replica_dsns
+        ]
+
 
 get_settings = ValueDependable("get_settings")
 
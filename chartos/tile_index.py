@@ -0,0 +1,127 @@
+from typing import Iterable, Iterator, List, Set, Tuple
+
+from shapely.prepared import prep
+
+from .config import Layer
+from .layer_cache import AffectedTile, find_affected_tiles, find_prepared_affected_tiles
+
+
+# layers with a tile index store, for each feature and geometry field used by views,
+# the quadkeys of the tiles the feature touches at the index zoom level. quadkeys are
+# morton codes, so that the descendants of a tile make up a contiguous range of quadkeys
+TILE_INDEX_COLUMNS = ["version", "feature_id", "field", "quadkey"]
+
+# the (layer, version) pairs known to have tile index rows. versions without rows, such
+# as versions being indexed by a migration, are rendered with the geometry filter instead
+indexed_versions: Set[Tuple[str, str]] = set()
+
+
+def spread_bits(value: int) -> int:
+    """Inserts a zero bit before each of the 32 lower bits of value"""
+    value &= 0xFFFFFFFF
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+
+def compact_bits(value: int) -> int:
+    """The inverse of spread_bits"""
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value >> 4)) & 0x00FF00FF00FF00FF
+    value = (value | (value >> 8)) & 0x0000FFFF0000FFFF
+    value = (value | (value >> 16)) & 0x00000000FFFFFFFF
+    return value
+
+
+def get_quadkey(x: int, y: int) -> int:
+    return spread_bits(x) | (spread_bits(y) << 1)
+
+
+def get_quadkey_tile(quadkey: int, index_zoom: int) -> AffectedTile:
+    return AffectedTile(compact_bits(quadkey), compact_bits(quadkey >> 1), index_zoom)
+
+
+def get_quadkey_range(tile: AffectedTile, index_zoom: int) -> Tuple[int, int]:
+    """The range of quadkeys, end excluded, of features which may be inside a tile"""
+    zoom_delta = index_zoom - tile.z
+    if zoom_delta < 0:
+        # the index is coarser than the tile, use the quadkey of its ancestor
+        quadkey = get_quadkey(tile.x >> -zoom_delta, tile.y >> -zoom_delta)
+        return quadkey, quadkey + 1
+    quadkey = get_quadkey(tile.x, tile.y)
+    return quadkey << (2 * zoom_delta), (quadkey + 1) << (2 * zoom_delta)
+
+
+def tile_index_filter(layer: Layer, field_name: str, tile: AffectedTile, version_param: str) -> str:
+    """A SQL condition selecting the features of a layer which may be inside a tile"""
+    assert layer.tile_index_zoom is not None
+    start, end = get_quadkey_range(tile, layer.tile_index_zoom)
+    return (
+        f"{layer.id_field.pg_name()} IN ("
+        f"SELECT feature_id FROM {layer.pg_tile_index_table_name()} "
+        f"WHERE version = {version_param} AND field = '{field_name}' "
+        f"AND quadkey >= {start} AND quadkey < {end})"
+    )
+
+
+async def has_tile_index(psql, layer: Layer, version: str) -> bool:
+    key = (layer.name, version)
+    if key in indexed_versions:
+        return True
+    indexed = await psql.fetchval(
+        f"SELECT EXISTS (SELECT 1 FROM {layer.pg_tile_index_table_name()} WHERE version = $1);", version)
+    # versions only lose their rows when truncated, which empties the layer too
+    if indexed:
+        indexed_versions.add(key)
+    return indexed
+
+
+def find_indexed_tiles(max_zoom: int, index_zoom: int, geom) -> Tuple[List[AffectedTile], List[int]]:
+    """Finds the tiles affected by a geometry up to max_zoom, and the quadkeys of its index cells"""
+    tiles = []
+    quadkeys = []
+    for tile in find_affected_tiles(max(max_zoom, index_zoom), geom):
+        if tile.z == index_zoom:
+            quadkeys.append(get_quadkey(tile.x, tile.y))
+        if tile.z <= max_zoom:
+            tiles.append(tile)
+    return tiles, quadkeys
+
+
+async def insert_tile_index_rows(psql, layer: Layer, rows: List[Tuple]):
+    """Inserts (version, feature_id, field, quadkey) rows into the tile index of a layer"""
+    if rows:
+        await psql.copy_records_to_table(layer.pg_tile_index_table_name(), records=rows, columns=TILE_INDEX_COLUMNS)
+
+
+def tile_ancestors(tile: AffectedTile) -> Iterator[AffectedTile]:
+    for zoom_delta in range(1, tile.z + 1):
+        yield AffectedTile(tile.x >> zoom_delta, tile.y >> zoom_delta, tile.z - zoom_delta)
+
+
+def find_indexed_affected_tiles(
+        max_zoom: int,
+        geom,
+        quadkeys: Iterable[int],
+        index_zoom: int,
+) -> Iterator[AffectedTile]:
+    """
+    Finds the tiles affected by a geometry which index cells are known. Tiles up to the index
+    zoom level are derived from the cells, and deeper tiles are only searched inside the cells.
+    """
+    prepared_geom = None
+    for quadkey in quadkeys:
+        cell = get_quadkey_tile(quadkey, index_zoom)
+        for tile in tile_ancestors(cell):
+            if tile.z <= max_zoom:
+                yield tile
+        if index_zoom > max_zoom:
+            continue
+        if prepared_geom is None:
+            prepared_geom = prep(geom)
+        yield from find_prepared_affected_tiles(max_zoom, prepared_geom, cell.z, cell.x, cell.y)
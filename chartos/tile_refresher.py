@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from typing import Coroutine, Dict, Optional, Set
+
+from .config import Field, Layer, View
+from .disk_cache import DiskTileCache
+from .psql import PSQLReadPool
+from .redis import RedisPool
+from .render import render_tile
+from .memory_render import MemoryLayerStore
+from .render_scheduler import RenderScheduler, RenderUnavailable
+from .popularity import PopularityTracker
+from .tracing import untraced
+from .layer_cache import (
+    AffectedTile,
+    get_cache_tile_key,
+    get_refresh_lock_key,
+    get_view_cache_prefix,
+    store_cached_tile,
+)
+from .utils import AsyncProcess, process_dependable
+
+
+logger = logging.getLogger(__name__)
+
+
+# background regenerations wait behind all user requested renders
+REGENERATION_PRIORITY_OFFSET = 64
+
+
+class TileRefresher(AsyncProcess):
+    """Renders tiles in the background, and stores them in the cache"""
+
+    def __init__(
+            self,
+            read_pool: PSQLReadPool,
+            scheduler: RenderScheduler,
+            redis_pool: RedisPool,
+            disk_cache: DiskTileCache,
+            popularity: PopularityTracker,
+            memory_store: MemoryLayerStore,
+            regeneration_count: int,
+            regeneration_concurrency: int,
+    ):
+        self.read_pool = read_pool
+        self.memory_store = memory_store
+        self.scheduler = scheduler
+        self.redis_pool = redis_pool
+        self.disk_cache = disk_cache
+        self.popularity = popularity
+        self.regeneration_count = regeneration_count
+        self.regeneration_concurrency = regeneration_concurrency
+        self.regeneration_budget: Optional[asyncio.Semaphore] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def on_startup(self):
+        # semaphores must be created within the event loop
+        self.regeneration_budget = asyncio.Semaphore(self.regeneration_concurrency)
+
+    async def on_shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    @process_dependable
+    async def get(self) -> "TileRefresher":
+        yield self
+
+    def spawn(self, coro: Coroutine):
+        # background renders outlive the request which started them, and aren't part of its trace
+        task = asyncio.create_task(untraced(coro))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @property
+    def lock_duration(self) -> int:
+        # the lock must outlive the render, unless the worker died
+        return int(self.scheduler.timeout) + 30
+
+    async def refresh(self, redis, layer: Layer, version: str, view: View, tile: AffectedTile):
+        """Starts refreshing a tile in the background, unless some worker already is"""
+        view_prefix = get_view_cache_prefix(layer, version, view)
+        cache_key = get_cache_tile_key(view_prefix, tile)
+        lock_key = get_refresh_lock_key(cache_key)
+        if not await redis.shard_for(cache_key).set(lock_key, b"", nx=True, ex=self.lock_duration):
+            return
+        self.spawn(self.render(layer, version, view, tile, cache_key, lock_key))
+
+    async def render(
+            self,
+            layer: Layer, version: str, view: View,
+            tile: AffectedTile,
+            cache_key: str,
+            lock_key: str,
+            priority: Optional[int] = None,
+            background: bool = False,
+    ):
+        redis = self.redis_pool.acquire()
+        try:
+            tile_data = await render_tile(
+                self.read_pool, self.scheduler, redis, layer, version, view, tile, priority, self.memory_store,
+                background,
+            )
+            await self.disk_cache.write_tile(layer, version, view, tile, tile_data)
+            await store_cached_tile(redis, view, get_view_cache_prefix(layer, version, view), tile, tile_data)
+        except RenderUnavailable as err:
+            logger.info("couldn't refresh tile %s: %s", cache_key, err.details)
+        except Exception:
+            logger.exception("failed to refresh tile %s", cache_key)
+        finally:
+            await redis.shard_for(cache_key).delete(lock_key)
+
+    def regenerate_popular(self, layer: Layer, version: str, affected_tiles: Dict[Field, Set[AffectedTile]]):
+        """Starts re-rendering the most popular of the tiles invalidated by a change, in the background"""
+        if self.regeneration_count <= 0 or self.regeneration_budget is None:
+            return
+        for view in layer.views.values():
+            view_affected_tiles = affected_tiles.get(view.on_field)
+            if view_affected_tiles:
+                self.spawn(self.regenerate_view(layer, version, view, view_affected_tiles))
+
+    async def regenerate_view(self, layer: Layer, version: str, view: View, affected_tiles: Set[AffectedTile]):
+        try:
+            await self.regenerate_view_tiles(layer, version, view, affected_tiles)
+        except Exception:
+            logger.exception("failed to regenerate the tiles of %s.%s", layer.name, view.name)
+
+    async def regenerate_view_tiles(self, layer: Layer, version: str, view: View, affected_tiles: Set[AffectedTile]):
+        assert self.regeneration_budget is not None
+        redis = self.redis_pool.acquire()
+        # look for the invalidated tiles among the tiles which are popular enough to be worth it
+        popular_tiles = await self.popularity.most_popular(
+            redis, layer, version, view, self.regeneration_count * 10)
+        tiles = [tile for tile in popular_tiles if tile in affected_tiles][:self.regeneration_count]
+        view_prefix = get_view_cache_prefix(layer, version, view)
+        # tiles are rendered by decreasing popularity, within the regeneration budget
+        for tile in tiles:
+            cache_key = get_cache_tile_key(view_prefix, tile)
+            lock_key = get_refresh_lock_key(cache_key)
+            await self.regeneration_budget.acquire()
+            if not await redis.shard_for(cache_key).set(lock_key, b"", nx=True, ex=self.lock_duration):
+                self.regeneration_budget.release()
+                continue
+            self.spawn(self.regenerate_tile(layer, version, view, tile, cache_key, lock_key))
+
+    async def regenerate_tile(
+            self,
+            layer: Layer, version: str, view: View,
+            tile: AffectedTile,
+            cache_key: str,
+            lock_key: str,
+    ):
+        try:
+            # no user is waiting for regenerations, which go through the background render queue
+            await self.render(
+                layer, version, view, tile, cache_key, lock_key, REGENERATION_PRIORITY_OFFSET + tile.z, background=True)
+        finally:
+            assert self.regeneration_budget is not None
+            self.regeneration_budget.release()
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+from collections import defaultdict
+from math import floor, log2
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, Query
+
+from .config import Config, Layer, View, get_config
+from .settings import Settings, get_settings
+from .redis import RedisPool
+from .layer_cache import AffectedTile
+from .utils import AsyncProcess
+
+
+logger = logging.getLogger(__name__)
+
+
+router = APIRouter()
+
+
+# the number of tiles kept in each per zoom ranking
+STATS_TOP_SIZE = 100
+# stats of versions which aren't rendered anymore end up expiring
+STATS_TTL = 7 * 24 * 3600
+# how often buffered stats are sent to redis, in seconds
+STATS_FLUSH_INTERVAL = 1.0
+
+# the recorded metrics, and their unit
+STATS_METRICS = {
+    "size": "bytes",
+    "features": "features",
+    "render_time": "milliseconds",
+}
+
+
+def get_zoom_stats_prefix(layer: Layer, version: str, view: View, z: int) -> str:
+    # stats are outside of the layer cache prefix, so that they survive invalidations
+    return f"chartis.stats.{layer.name}.version_{version}.{view.name}.z{z}"
+
+
+def get_histogram_bucket(value: float) -> int:
+    """Returns the lower bound of the power of two bucket of a value"""
+    if value < 1:
+        return 0
+    return 1 << floor(log2(value))
+
+
+class ZoomStatsBuffer:
+    """The stats of the renders of a zoom level, which weren't sent to redis yet"""
+
+    def __init__(self):
+        self.renders = 0
+        self.totals: Dict[str, float] = defaultdict(float)
+        self.histograms: Dict[str, Dict[int, int]] = {metric: defaultdict(int) for metric in STATS_METRICS}
+        # the highest value of each tile, per metric
+        self.top: Dict[str, Dict[str, float]] = {metric: {} for metric in STATS_METRICS}
+
+    def add(self, member: str, values: Dict[str, float]):
+        self.renders += 1
+        for metric, value in values.items():
+            self.totals[metric] += value
+            self.histograms[metric][get_histogram_bucket(value)] += 1
+            top = self.top[metric]
+            top[member] = max(value, top.get(member, value))
+
+    def flush(self, pipe, prefix: str):
+        for metric in STATS_METRICS:
+            top_key = f"{prefix}.top_{metric}"
+            # tiles keep the highest value recorded by any flush (ZADD GT, redis >= 6.2)
+            scores = [item for member, value in self.top[metric].items() for item in (value, member)]
+            pipe.execute_command("ZADD", top_key, "GT", *scores)
+            # only keep the highest scores
+            pipe.zremrangebyrank(top_key, 0, -STATS_TOP_SIZE - 1)
+            pipe.expire(top_key, STATS_TTL)
+            histogram_key = f"{prefix}.histogram_{metric}"
+            for bucket, count in self.histograms[metric].items():
+                pipe.hincrby(histogram_key, str(bucket), count)
+            pipe.expire(histogram_key, STATS_TTL)
+        totals_key = f"{prefix}.totals"
+        pipe.hincrby(totals_key, "renders", self.renders)
+        for metric, total in self.totals.items():
+            pipe.hincrbyfloat(totals_key, metric, total)
+        pipe.expire(totals_key, STATS_TTL)
+
+
+# renders are recorded in this buffer, which the TileStatsFlusher sends to redis
+# every STATS_FLUSH_INTERVAL seconds. stats are keyed by their redis prefix
+stats_buffer: Dict[str, ZoomStatsBuffer] = defaultdict(ZoomStatsBuffer)
+
+
+def record_tile_stats(
+        layer: Layer, version: str, view: View,
+        tile: AffectedTile,
+        size: int,
+        feature_count: int,
+        render_time: float,
+):
+    """Records the cost of rendering a tile. render_time is in seconds."""
+    prefix = get_zoom_stats_prefix(layer, version, view, tile.z)
+    values = {"size": size, "features": feature_count, "render_time": render_time * 1000}
+    stats_buffer[prefix].add(f"{tile.x}/{tile.y}", values)
+
+
+async def flush_tile_stats(redis):
+    """Sends the buffered stats to redis, with a single pipeline per shard"""
+    if not stats_buffer:
+        return
+    buffers = list(stats_buffer.items())
+    stats_buffer.clear()
+    prefixes = [prefix for prefix, _ in buffers]
+
+    # all stats of a zoom level are on the same shard
+    async def flush_shard(shard: int, indices: List[int]):
+        async with redis.shards[shard].pipeline(transaction=False) as pipe:
+            for i in indices:
+                prefix, buffer = buffers[i]
+                buffer.flush(pipe, prefix)
+            await pipe.execute()
+
+    await asyncio.gather(*(
+        flush_shard(shard, indices)
+        for shard, indices in redis.group_by_shard(prefixes).items()
+    ))
+
+
+class TileStatsFlusher(AsyncProcess):
+    """
+    Periodically sends the buffered tile stats to redis, off the path of renders.
+    Stats are best effort: the stats of a failed flush are dropped.
+    """
+
+    def __init__(self, redis_pool: RedisPool, flush_interval: float = STATS_FLUSH_INTERVAL):
+        self.redis_pool = redis_pool
+        self.flush_interval = flush_interval
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def on_startup(self):
+        self.flush_task = asyncio.create_task(self.flush_loop())
+
+    async def on_shutdown(self):
+        if self.flush_task is None:
+            return
+        self.flush_task.cancel()
+        await asyncio.gather(self.flush_task, return_exceptions=True)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        try:
+            await flush_tile_stats(self.redis_pool.acquire())
+        except Exception:
+            logger.exception("failed to send tile stats to redis")
+
+
+def parse_zoom_stats(totals, metric_results) -> Dict:
+    if not totals:
+        return {}
+    renders = int(totals[b"renders"])
+    zoom_stats: Dict = {"renders": renders}
+    for i, (metric, unit) in enumerate(STATS_METRICS.items()):
+        top_tiles, histogram = metric_results[2 * i], metric_results[2 * i + 1]
+        zoom_stats[metric] = {
+            "unit": unit,
+            "mean": float(totals[metric.encode()]) / renders,
+            "top": [
+                {**dict(zip("xy", map(int, member.split(b"/")))), "value": value}
+                for member, value in top_tiles
+            ],
+            "histogram": {
+                int(bucket): int(count)
+                for bucket, count in sorted(histogram.items(), key=lambda item: int(item[0]))
+            },
+        }
+    return zoom_stats
+
+
+async def load_stats(redis, prefixes: List[str], top: int) -> List[Dict]:
+    """Loads the stats of many zoom levels, with a single pipeline per shard"""
+    results: List[Dict] = [{} for _ in prefixes]
+    # each zoom level takes a command for its totals, and two per metric
+    zoom_command_count = 1 + 2 * len(STATS_METRICS)
+
+    async def load_shard(shard: int, indices: List[int]):
+        async with redis.shards[shard].pipeline(transaction=False) as pipe:
+            for i in indices:
+                prefix = prefixes[i]
+                pipe.hgetall(f"{prefix}.totals")
+                for metric in STATS_METRICS:
+                    pipe.zrevrange(f"{prefix}.top_{metric}", 0, top - 1, withscores=True)
+                    pipe.hgetall(f"{prefix}.histogram_{metric}")
+            replies = await pipe.execute()
+        for reply_index, i in enumerate(indices):
+            totals, *metric_results = replies[reply_index * zoom_command_count:(reply_index + 1) * zoom_command_count]
+            results[i] = parse_zoom_stats(totals, metric_results)
+
+    await asyncio.gather(*(
+        load_shard(shard, indices)
+        for shard, indices in redis.group_by_shard(prefixes).items()
+    ))
+    return results
+
+
+@router.get("/stats/{layer_slug}/{view_slug}")
+async def tile_stats(
+        layer_slug: str,
+        view_slug: str,
+        version: str = Query(...),
+        top: int = Query(10, gt=0, le=STATS_TOP_SIZE),
+        config: Config = Depends(get_config),
+        settings: Settings = Depends(get_settings),
+        redis=Depends(RedisPool.get),
+):
+    """
+    The cost of rendering the tiles of a view, per zoom level: the heaviest, most crowded
+    and slowest tiles, along with histograms which buckets are powers of two.
+    """
+    layer = config.layers[layer_slug]
+    view = layer.views[view_slug]
+    zooms = range(settings.max_zoom + 1)
+    prefixes = [get_zoom_stats_prefix(layer, version, view, z) for z in zooms]
+    all_zoom_stats = await load_stats(redis, prefixes, top)
+    return {"zooms": {z: zoom_stats for z, zoom_stats in zip(zooms, all_zoom_stats) if zoom_stats}}
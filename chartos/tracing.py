@@ -0,0 +1,177 @@
+import json
+import random
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Awaitable, Dict, Iterator, List, Optional, TypeVar
+
+from starlette.datastructures import MutableHeaders
+
+
+@dataclass
+class Span:
+    id: int
+    parent_id: Optional[int]
+    name: str
+    # seconds since the start of the trace
+    start: float
+    duration: float = 0.
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": self.start * 1000,
+            "duration_ms": self.duration * 1000,
+        }
+
+
+class Trace:
+    """The spans recorded while handling a request"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.
+        self.spans: List[Span] = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def finish(self):
+        self.duration = self.elapsed()
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration_ms": self.duration * 1000,
+            "spans": [span.to_json() for span in self.spans],
+        }
+
+    def server_timing(self) -> str:
+        """Builds a Server-Timing header, with the total duration of each span name"""
+        durations: Dict[str, float] = defaultdict(float)
+        for span in self.spans:
+            durations[span.name] += span.duration
+        metrics = [f"{name};dur={duration * 1000:.2f}" for name, duration in durations.items()]
+        metrics.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span_id: ContextVar[Optional[int]] = ContextVar("current_span_id", default=None)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Records the duration of a block in the current trace, if any"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    new_span = Span(len(trace.spans), current_span_id.get(), name, trace.elapsed())
+    trace.spans.append(new_span)
+    token = current_span_id.set(new_span.id)
+    try:
+        yield
+    finally:
+        new_span.duration = trace.elapsed() - new_span.start
+        current_span_id.reset(token)
+
+
+T = TypeVar("T")
+
+
+async def untraced(awaitable: Awaitable[T]) -> T:
+    """
+    Awaits outside of any trace. Tasks copy the context they are created in, so background
+    tasks started while handling a request would otherwise record spans in its trace.
+    """
+    current_trace.set(None)
+    current_span_id.set(None)
+    return await awaitable
+
+
+class TraceExporter(ABC):
+    @abstractmethod
+    def export(self, trace: Trace):
+        raise NotImplementedError
+
+
+class StdoutExporter(TraceExporter):
+    def export(self, trace: Trace):
+        sys.stdout.write(json.dumps(trace.to_json()) + "\n")
+        sys.stdout.flush()
+
+
+class FileExporter(TraceExporter):
+    """Appends traces to a file, one json object per line"""
+
+    def __init__(self, path: str):
+        self.file = open(path, "a", buffering=1)
+
+    def export(self, trace: Trace):
+        self.file.write(json.dumps(trace.to_json()) + "\n")
+
+
+def make_exporter(spec: str) -> TraceExporter:
+    """Parses an exporter specification: either stdout, or file:<path>"""
+    if spec == "stdout":
+        return StdoutExporter()
+    if spec.startswith("file:"):
+        return FileExporter(spec[len("file:"):])
+    raise ValueError(f"unknown trace exporter: {spec}")
+
+
+class TracingMiddleware:
+    """
+    Traces a sample of requests and exports them. When server_timing is enabled,
+    all requests are traced, and the durations of their spans are sent to clients.
+    """
+
+    def __init__(self, app, exporter: TraceExporter, sample_rate: float, server_timing: bool):
+        self.app = app
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        sampled = random.random() < self.sample_rate
+        if not sampled and not self.server_timing:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        response_start: Optional[float] = None
+
+        async def traced_send(message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = trace.elapsed()
+                if self.server_timing:
+                    MutableHeaders(scope=message).append("Server-Timing", trace.server_timing())
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, traced_send)
+        finally:
+            current_trace.reset(token)
+            trace.finish()
+            if response_start is not None:
+                trace.spans.append(Span(
+                    len(trace.spans), None, "response", response_start, trace.duration - response_start))
+            if sampled:
+                self.exporter.export(trace)
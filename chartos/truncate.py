@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends
-from .config import Config, get_config
+from .config import Config, Layer, get_config
 from .psql import PSQLPool
 from .redis import RedisPool
+from .disk_cache import DiskTileCache
 from fastapi.responses import JSONResponse
-from .layer_cache import invalidate_full_layer_cache
+from .layer_cache import invalidate_full_layer_cache, record_write_position
+from .generations import read_cache_generation
 
 
 router = APIRouter()
@@ -15,9 +17,20 @@ async def truncate(
         version: str,
         psql=Depends(PSQLPool.get),
         redis=Depends(RedisPool.get),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
         config: Config = Depends(get_config),
 ):
     layer = config.layers[layer_slug]
+    async with psql.transaction():
+        await delete_version_rows(psql, layer, version)
+    await record_write_position(psql, redis, layer, version)
+    generation = await read_cache_generation(redis, layer, version)
+    await invalidate_full_layer_cache(redis, disk_cache, layer, version, generation)
+    impacted_tiles = {view_name: ['*'] for view_name in layer.views}
+    return JSONResponse(status_code=201, content={'impacted_tiles': impacted_tiles})
+
+
+async def delete_version_rows(psql, layer: Layer, version: str):
     await psql.execute(f'DELETE FROM {layer.pg_table_name()} WHERE version = $1;', version)
-    await invalidate_full_layer_cache(redis, layer.name, version)
-    return JSONResponse(status_code=201, content={'impacted_tiles': {'geo': ['*'], 'sch': ['*'], }})
+    if layer.tile_index_zoom is not None:
+        await psql.execute(f'DELETE FROM {layer.pg_tile_index_table_name()} WHERE version = $1;', version)
@@ -2,3 +2,8 @@ from .peekable_iterator import PeekableIterator as PeekableIterator
 from .async_process import AsyncProcess as AsyncProcess
 from .async_process import process_dependable as process_dependable
 from .value_dependable import ValueDependable as ValueDependable
+from .hash_ring import HashRing as HashRing
+from .priority_limiter import PriorityLimiter as PriorityLimiter
+from .priority_limiter import QueueFull as QueueFull
+from .sampling_profiler import SamplingProfiler as SamplingProfiler
+from .wait_stats import WaitStats as WaitStats
@@ -0,0 +1,40 @@
+import bisect
+import hashlib
+from typing import Generic, List, Sequence, Tuple, TypeVar
+
+
+NodeT = TypeVar("NodeT")
+
+
+def hash64(key: str) -> int:
+    """A hash which is stable across processes, unlike hash()"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing(Generic[NodeT]):
+    """
+    Maps keys to nodes using consistent hashing. Each node is placed at
+    many points on the ring, so that keys are evenly spread, and adding
+    or removing a node only moves the keys of this node.
+    """
+    __slots__ = ("points", "owners")
+
+    points: List[int]
+    owners: List[NodeT]
+
+    def __init__(self, nodes: Sequence[Tuple[str, NodeT]], replicas: int = 160) -> None:
+        if not nodes:
+            raise ValueError("a hash ring needs at least one node")
+        ring = sorted(
+            (hash64(f"{name}#{i}"), node)
+            for name, node in nodes
+            for i in range(replicas)
+        )
+        self.points = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+
+    def get_node(self, key: str) -> NodeT:
+        i = bisect.bisect(self.points, hash64(key))
+        if i == len(self.points):
+            i = 0
+        return self.owners[i]
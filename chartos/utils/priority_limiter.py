@@ -0,0 +1,80 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Tuple
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PriorityLimiter:
+    """
+    Limits how many tasks run at once. Tasks which can't start right away
+    wait in a bounded queue, and start by increasing priority value, then
+    in arrival order.
+    """
+    __slots__ = ("concurrency", "queue_size", "running", "waiters", "counter")
+
+    running: int
+    waiters: List[Tuple[int, int, "asyncio.Future[None]"]]
+
+    def __init__(self, concurrency: int, queue_size: int) -> None:
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self, priority: int) -> None:
+        if self.running < self.concurrency and not self.waiters:
+            self.running += 1
+            return
+
+        if len(self.waiters) >= self.queue_size:
+            raise QueueFull()
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.counter), future)
+        heapq.heappush(self.waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over right before the cancellation
+                self.release()
+            else:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            raise
+
+    def release(self) -> None:
+        # hand the slot over to the next waiter, if any, unless the concurrency was lowered
+        while self.waiters and self.running <= self.concurrency:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def set_concurrency(self, concurrency: int) -> None:
+        """Changes how many tasks run at once. Running tasks above a lowered concurrency finish normally"""
+        self.concurrency = concurrency
+        while self.waiters and self.running < self.concurrency:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, priority: int) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
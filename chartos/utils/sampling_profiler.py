@@ -0,0 +1,41 @@
+import sys
+import threading
+from collections import Counter
+from typing import Optional
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the call stack of a thread from a background thread.
+    Stacks are counted in the collapsed format used by flame graph tools.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stop_event = threading.Event()
+        self.sampler: Optional[threading.Thread] = None
+
+    def start(self):
+        self.sampler = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
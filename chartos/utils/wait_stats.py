@@ -0,0 +1,29 @@
+from collections import deque
+from math import ceil
+from typing import Deque, Dict, Iterable, Optional
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    rank = max(ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class WaitStats:
+    """The durations of the latest waits for a resource, in seconds"""
+    __slots__ = ("samples",)
+
+    samples: Deque[float]
+
+    def __init__(self, size: int = 1024) -> None:
+        self.samples = deque(maxlen=size)
+
+    def record(self, duration: float) -> None:
+        self.samples.append(duration)
+
+    def percentiles(self, fractions: Iterable[float] = (0.5, 0.95, 0.99)) -> Dict[str, Optional[float]]:
+        sorted_samples = sorted(self.samples)
+        return {
+            f"p{round(fraction * 100)}": percentile(sorted_samples, fraction) if sorted_samples else None
+            for fraction in fractions
+        }
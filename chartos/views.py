@@ -2,12 +2,26 @@ from typing import Dict, List
 from collections import defaultdict
 from fastapi import APIRouter, Depends, HTTPException, Query
 from dataclasses import asdict as dataclass_as_dict
-from .config import Config, Field, GeomField, JsonField, get_config
+from .config import Config, get_config
 from .settings import Settings, get_settings
-from .psql import PSQLPool
+from .psql import PSQLPool, PSQLReadPool
+from .render import render_tile
+from .tile_refresher import TileRefresher
+from .popularity import PopularityTracker
 from .redis import RedisPool
+from .disk_cache import DiskTileCache
+from .render_scheduler import RenderScheduler
+from .memory_render import MemoryLayerStore
+from .tracing import span
+from .generations import check_cache_generation, check_public_version
 from fastapi.responses import Response
-from .layer_cache import get_view_cache_prefix, get_cache_tile_key, AffectedTile
+from starlette.background import BackgroundTask
+from .layer_cache import (
+    get_view_cache_prefix,
+    load_cached_tile,
+    store_cached_tile,
+    AffectedTile,
+)
 from urllib.parse import quote as url_quote
 
 
@@ -24,6 +38,22 @@ async def health(
     return ""
 
 
+@router.get("/health/pools")
+async def pools_health(
+        psql_pool: PSQLPool = Depends(PSQLPool.get_pool),
+        read_pool: PSQLReadPool = Depends(PSQLReadPool.get_pool),
+        redis_pool: RedisPool = Depends(RedisPool.get_pool),
+):
+    """
+    Reports the connections in use and idle in each pool, as well as percentiles
+    of the time taken to acquire the latest connections, in seconds
+    """
+    return {
+        "psql": [psql_pool.pool.stats(), *(pool.stats() for pool in read_pool.pools)],
+        "redis": redis_pool.stats(),
+    }
+
+
 @router.get("/info")
 async def info(config: Config = Depends(get_config)):
     return {
@@ -83,64 +113,46 @@ async def mvt_view_tile(
         version: str,
         z: int, x: int, y: int,
         config: Config = Depends(get_config),
-        psql=Depends(PSQLPool.get),
+        read_pool: PSQLReadPool = Depends(PSQLReadPool.get_pool),
         redis=Depends(RedisPool.get),
+        disk_cache: DiskTileCache = Depends(DiskTileCache.get),
+        scheduler: RenderScheduler = Depends(RenderScheduler.get),
+        memory_store: MemoryLayerStore = Depends(MemoryLayerStore.get),
+        refresher: TileRefresher = Depends(TileRefresher.get),
+        popularity: PopularityTracker = Depends(PopularityTracker.get),
 ):
     layer = config.layers[layer_slug]
     view = layer.views[view_slug]
+    check_public_version(version)
+    await check_cache_generation(redis, layer, version)
 
     # try to fetch the tile from the cache
+    tile = AffectedTile(x, y, z)
+    await popularity.record(redis, layer, version, view, tile)
     view_cache_prefix = get_view_cache_prefix(layer, version, view)
-    cache_key = get_cache_tile_key(view_cache_prefix, AffectedTile(x, y, z))
-    tile_data = await redis.get(cache_key)
+    with span("redis.load_tile"):
+        tile_data, is_stale = await load_cached_tile(redis, view, view_cache_prefix, tile)
     if tile_data is not None:
-        return ProtobufResponse(tile_data)
-
-    # if the key isn't found, build the tile
-    tile_data = await mvt_query(psql, layer, version, view, z, x, y)
+        if not is_stale:
+            return ProtobufResponse(tile_data, headers={"X-Cache-Status": "hit"})
+        # serve the stale tile right away, and refresh it in the background
+        await refresher.refresh(redis, layer, version, view, tile)
+        return ProtobufResponse(tile_data, headers={"X-Cache-Status": "stale"})
+
+    # on redis miss, try the disk cache, and build the tile if it isn't there either
+    with span("disk_cache.read_tile"):
+        tile_data = await disk_cache.read_tile(layer, version, view, tile)
+    cache_status = "disk"
+    disk_write = None
+    if tile_data is None:
+        cache_status = "miss"
+        with span("render"):
+            tile_data = await render_tile(
+                read_pool, scheduler, redis, layer, version, view, tile, memory_store=memory_store)
+        # disk writes may wait for other processes, and happen once the response is sent
+        disk_write = BackgroundTask(disk_cache.write_tile, layer, version, view, tile, tile_data)
 
     # store the tile in the cache
-    await redis.set(cache_key, tile_data, ex=view.cache_duration)
-    return ProtobufResponse(tile_data)
-
-
-def select_field(field: Field) -> str:
-    field_name = field.pg_name()
-    if isinstance(field.type, GeomField):
-        return f"ST_Transform({field_name}, 4326) AS {field_name}"
-    if isinstance(field.type, JsonField):
-        return f"{field_name}::text"
-    return field_name
-
-
-async def mvt_query(psql, layer, version, view, z, x, y) -> bytes:
-    view_field_names = ", ".join(map(select_field, view.fields))
-    on_field_name = view.on_field.pg_name()
-    mvt_layer_name = f"'{layer.name}'"
-    tile_content_subquery = (
-        "SELECT "
-        # the geometry the view is based on, converted to MVT. this field must
-        # come first for ST_AsMVT to index the tile on the correct geometry
-        f"ST_AsMVTGeom({on_field_name}, bbox.geom, 4096, 64) AS MVTGeom, "
-        # select all the fields the user requested
-        f"{view_field_names} "
-        # read from the table corresponding to the layer, as well as the bbox
-        # the bbox table is built by the WITH clause of the top-level query
-        f"FROM {layer.pg_table_name()}, bbox "
-        # filter by version
-        "WHERE version = $4 "
-        # we only want objects which are inside the tile BBox
-        f"AND {on_field_name} && bbox.geom "
-        # exclude geometry collections
-        f"AND ST_GeometryType({on_field_name}) != 'ST_GeometryCollection'"
-    )
-    query = (
-        # prepare the bbox of the tile for use in the tile content subquery
-        "WITH bbox AS (SELECT TileBBox($1, $2, $3, 3857) AS geom), "
-        # find all objects in the tile
-        f"tile_content AS ({tile_content_subquery}) "
-        # package those inside an MVT tile
-        f"SELECT ST_AsMVT(tile_content, {mvt_layer_name}) FROM tile_content"
-    )
-    (record,) = await psql.fetch(query, z, x, y, version)
-    return record.get("st_asmvt")
+    with span("redis.store_tile"):
+        await store_cached_tile(redis, view, view_cache_prefix, tile, tile_data)
+    return ProtobufResponse(tile_data, headers={"X-Cache-Status": cache_status}, background=disk_write)
@@ -1,6 +1,7 @@
 import httpx
 import pytest
 import asyncpg
+from fastapi import FastAPI
 
 from chartos import make_app, get_env_settings
 from chartos.psql import PSQLPool
@@ -22,6 +23,17 @@ COMMENT ON SCHEMA public IS 'standard public schema';
 """
 
 
+@pytest.fixture
+async def redis(settings):
+    """A redis client on an empty database, for tests which don't need the whole app"""
+    redis_pool = RedisPool.setup(FastAPI(), settings.redis_urls(), settings.redis_max_conns, settings.tile_block_bits())
+    await redis_pool.on_startup()
+    async with redis_pool.acquire() as redis:
+        await redis.flushdb()
+        yield redis
+    await redis_pool.on_shutdown()
+
+
 async def flush_database(conn):
     query = "select tablename from pg_tables where schemaname = 'public';"
     for (tablename,) in await conn.fetch(query):
@@ -0,0 +1,25 @@
+import struct
+from chartos.archive import PMTilesWriter, zxy_to_tile_id
+from chartos.layer_cache import AffectedTile
+
+
+def test_zxy_to_tile_id():
+    assert zxy_to_tile_id(0, 0, 0) == 0
+    assert [zxy_to_tile_id(1, x, y) for x, y in ((0, 0), (0, 1), (1, 1), (1, 0))] == [1, 2, 3, 4]
+    assert zxy_to_tile_id(2, 0, 0) == 5
+    assert zxy_to_tile_id(12, 3423, 1763) == 19078479
+
+
+def test_pmtiles_header():
+    writer = PMTilesWriter({"name": "test", "vector_layers": []}, 0, 2)
+    try:
+        writer.add_tile(AffectedTile(0, 0, 0), b"root")
+        writer.add_tile(AffectedTile(1, 1, 1), b"child")
+        archive = b"".join(writer.finish())
+    finally:
+        writer.cleanup()
+
+    assert archive[:8] == b"PMTiles\x03"
+    data_offset, data_length, addressed_tiles = struct.unpack_from("<3Q", archive, 56)
+    assert addressed_tiles == 2
+    assert archive[data_offset:data_offset + data_length] == b"rootchild"
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+from .test_data import campus_sncf_gps
+from .test_insert import MVTClient
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.csv  # noqa: E402
+import pyarrow.ipc  # noqa: E402
+
+from chartos.arrow_ingest import ARROW_STREAM_CONTENT_TYPE, encode_staged_batch, hex_column  # noqa: E402
+
+
+def arrow_stream(**columns) -> bytes:
+    batch = pyarrow.record_batch(list(columns.values()), names=list(columns))
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue()
+
+
+def test_hex_column():
+    column = pyarrow.array([b"\x00\x01\xff", None, b"", b"ab"])
+    assert hex_column(column).to_pylist() == ["0001FF", None, "", "6162"]
+    assert hex_column(column.slice(1)).to_pylist() == [None, "", "6162"]
+    assert hex_column(pyarrow.array([None], pyarrow.binary())).to_pylist() == [None]
+
+
+def test_staged_batch_csv():
+    batch = encode_staged_batch(pyarrow.record_batch([
+        pyarrow.array([b"\x01", None, b"\x02"]),
+        pyarrow.array(['{"a": "b,c"}', "", None]),
+    ], names=["geom", "components"]))
+    csv_data = io.BytesIO()
+    pyarrow.csv.write_csv(batch, csv_data, pyarrow.csv.WriteOptions(include_header=False))
+    # postgresql reads unquoted empty values as null, and quoted ones as empty strings
+    assert csv_data.getvalue() == b'"01","{""a"": ""b,c""}"\n,""\n"02",\n'
+
+
+@pytest.mark.asyncio
+async def test_insert_arrow(client):
+    mvt_client = await MVTClient.init(client, "osrd_track_section", "arrow", "geo")
+    payload = arrow_stream(
+        entity_id=pyarrow.array([1, 2], pyarrow.int32()),
+        geom_geo=pyarrow.array([campus_sncf_gps.wkb, None]),
+        components=pyarrow.array(['{"test": 42}', None]),
+    )
+    response = await client.post(
+        "/push/osrd_track_section/insert/",
+        params={"version": "arrow"},
+        content=payload,
+        # parameters of the content type are ignored
+        headers={"content-type": f"{ARROW_STREAM_CONTENT_TYPE}; charset=binary"},
+    )
+    assert response.status_code == 201
+    assert (await mvt_client.get_tile(14, 8299, 5632)) != b""
+
+
+@pytest.mark.asyncio
+async def test_insert_arrow_invalid_value(client):
+    payload = arrow_stream(
+        entity_id=pyarrow.array([1], pyarrow.int32()),
+        components=pyarrow.array(["not json"]),
+    )
+    response = await client.post(
+        "/push/osrd_track_section/insert/",
+        params={"version": "arrow"},
+        content=payload,
+        headers={"content-type": ARROW_STREAM_CONTENT_TYPE},
+    )
+    assert response.status_code == 400
@@ -0,0 +1,51 @@
+import pytest
+from fastapi import FastAPI
+
+from chartos import batch
+from chartos.batch import FRAME_ERROR, FRAME_HEADER, FRAME_OK, FRAME_UNAVAILABLE, batch_tiles
+from chartos.config import Config
+from chartos.disk_cache import DiskTileCache
+from chartos.layer_cache import AffectedTile, get_view_cache_prefix, store_cached_tile
+from chartos.render_scheduler import RenderUnavailable
+
+from .test_config import make_layer
+
+
+def decode_frames(data: bytes):
+    frames = {}
+    while data:
+        z, status, x, y, length = FRAME_HEADER.unpack_from(data)
+        data = data[FRAME_HEADER.size:]
+        frames[(z, x, y)] = (status, data[:length])
+        data = data[length:]
+    return frames
+
+
+@pytest.mark.asyncio
+async def test_batch_statuses(redis, settings, monkeypatch):
+    layer = make_layer()
+    view = layer.views["geo"]
+    await store_cached_tile(redis, view, get_view_cache_prefix(layer, "1", view), AffectedTile(0, 0, 1), b"cached")
+
+    async def render_tile(read_pool, scheduler, redis, layer, version, view, tile, memory_store=None):
+        if tile.x == 1:
+            return b"rendered"
+        if tile.y == 1:
+            raise RenderUnavailable("busy", 1)
+        raise ValueError("broken tile")
+
+    monkeypatch.setattr(batch, "render_tile", render_tile)
+    disk_cache = DiskTileCache.setup(FastAPI(), None, 0)
+    config = Config("test", "", {layer.name: layer})
+    response = await batch_tiles(
+        layer.name, view.name, "1", [(1, 0, 0), (1, 1, 0), (1, 0, 1), (2, 2, 2)],
+        config, settings, None, redis, disk_cache, None, None, None,
+    )
+    frames = decode_frames(b"".join([chunk async for chunk in response.body_iterator]))
+    # a failed tile doesn't prevent the others from being sent
+    assert frames == {
+        (1, 0, 0): (FRAME_OK, b"cached"),
+        (1, 1, 0): (FRAME_OK, b"rendered"),
+        (1, 0, 1): (FRAME_UNAVAILABLE, b""),
+        (2, 2, 2): (FRAME_ERROR, b""),
+    }
@@ -0,0 +1,127 @@
+import pytest
+from chartos.config import Layer, PayloadError
+from chartos.render import cluster_subquery
+from chartos.serialized_config import SerializedLayer
+
+
+def make_layer(**view):
+    return Layer.parse(SerializedLayer.parse_obj({
+        "name": "osrd_signal",
+        "id_field_name": "id",
+        "fields": [
+            {"name": "id", "type": "string", "description": ""},
+            {"name": "geo", "type": "geom", "description": ""},
+            {"name": "components", "type": "json", "description": ""},
+        ],
+        "views": [{"name": "geo", "on_field": "geo", **view}],
+    }))
+
+
+def test_json_projection():
+    layer = make_layer(json_projections=[
+        {"path": "components.signaling_type", "name": "signaling_type"},
+        {"path": "components.speed.max", "type": "double"},
+    ])
+    view = layer.views["geo"]
+    # the projected json field is excluded unless requested
+    assert [field.name for field in view.fields] == ["id", "geo"]
+    signaling_type, max_speed = view.json_projections
+    assert signaling_type.pg_select() == (
+        """("components" #>> '{signaling_type}')::varchar AS "signaling_type\""""
+    )
+    # values of the wrong type become null
+    assert max_speed.pg_select() == (
+        """(CASE WHEN jsonb_typeof(("components" #> '{speed,max}')) = 'number' THEN """
+        """CASE WHEN ("components" #> '{speed,max}')::numeric """
+        """BETWEEN -1.7976931348623157e308 AND 1.7976931348623157e308 """
+        """THEN ("components" #>> '{speed,max}')::double precision END END) AS "components.speed.max\""""
+    )
+
+
+def test_json_projection_type():
+    with pytest.raises(ValueError):
+        make_layer(json_projections=[{"path": "components.date", "type": "timestamp"}])
+
+
+def test_view_attribute_names():
+    # projected fields can still be excluded
+    make_layer(json_projections=[{"path": "components.speed"}], exclude_fields=["components"])
+    with pytest.raises(ValueError):
+        make_layer(exclude_fields=["compnents"])
+    with pytest.raises(ValueError):
+        make_layer(json_projections=[{"path": "components.speed", "name": "id"}])
+    with pytest.raises(ValueError):
+        make_layer(json_projections=[
+            {"path": "components.speed", "name": "speed"},
+            {"path": "components.max_speed", "name": "speed"},
+        ])
+
+
+def test_json_projection_explicit_fields():
+    layer = make_layer(
+        fields=["geo", "components"],
+        json_projections=[{"path": "components.signaling_type"}],
+    )
+    assert [field.name for field in layer.views["geo"].fields] == ["geo", "components"]
+
+
+def test_json_projection_invalid_path():
+    with pytest.raises(ValueError):
+        make_layer(json_projections=[{"path": "geo.type"}])
+    with pytest.raises(ValueError):
+        make_layer(json_projections=[{"path": "components.a'b"}])
+
+
+def test_payload_validator():
+    validator = make_layer().validator
+    geom = {"type": "Point", "coordinates": [2.35, 48.85]}
+    validator.validate([{"id": "a", "geo": geom, "components": {"x": 1}}])
+    invalid_rows = [
+        ({"id": "b", "geo": geom, "unknown": 1}, "Unknown field name `unknown`"),
+        ({"id": "b"}, "Field `geo` is mandatory."),
+        ({"id": 1, "geo": geom}, "Field `id` expects str, got int"),
+    ]
+    for row, details in invalid_rows:
+        with pytest.raises(PayloadError) as error:
+            validator.validate([{"id": "a", "geo": geom}, row], 10)
+        assert error.value.row_index == 11
+        assert error.value.details == details
+
+
+def test_clustering():
+    view = make_layer(cluster_below_zoom=10, cluster_grid_size=512).views["geo"]
+    assert view.is_clustered(9)
+    assert not view.is_clustered(10)
+    assert not make_layer().views["geo"].is_clustered(0)
+    query = cluster_subquery(view, "SELECT 1")
+    assert 'count(*) AS point_count, (array_agg("id"))[1] AS "id"' in query
+    assert query.endswith("GROUP BY ST_SnapToGrid(ST_Centroid(MVTGeom), 512)")
+    with pytest.raises(ValueError):
+        make_layer(cluster_grid_size=0)
+
+
+def test_view_fingerprint():
+    view = make_layer().views["geo"]
+    assert make_layer(cache_duration=60).views["geo"].fingerprint == view.fingerprint
+    assert make_layer(exclude_fields=["components"]).views["geo"].fingerprint != view.fingerprint
+    assert make_layer(cluster_below_zoom=8).views["geo"].fingerprint != view.fingerprint
+
+
+def test_render_in_memory():
+    def make_memory_layer(geom_type):
+        return Layer.parse(SerializedLayer.parse_obj({
+            "name": "osrd_signal",
+            "id_field_name": "id",
+            "render_in_memory": True,
+            "fields": [
+                {"name": "id", "type": "string", "description": ""},
+                {"name": "geo", "type": geom_type, "description": ""},
+            ],
+            "views": [{"name": "geo", "on_field": "geo"}],
+        }))
+
+    layer = make_memory_layer("point")
+    with pytest.raises(PayloadError, match="Point"):
+        layer.validator.validate([{"id": "a", "geo": {"type": "LineString", "coordinates": []}}])
+    with pytest.raises(ValueError, match="point fields"):
+        make_memory_layer("geom")
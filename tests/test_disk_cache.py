@@ -0,0 +1,80 @@
+import time
+from dataclasses import replace
+
+import pytest
+from fastapi import FastAPI
+
+from chartos.disk_cache import DiskTileCache
+from chartos.layer_cache import AffectedTile
+
+from .test_config import make_layer
+
+
+@pytest.fixture
+async def disk_cache(tmp_path):
+    disk_cache = DiskTileCache.setup(FastAPI(), str(tmp_path), 1 << 20, max_open_files=2, max_workers=1)
+    await disk_cache.on_startup()
+    yield disk_cache
+    await disk_cache.on_shutdown()
+
+
+@pytest.mark.asyncio
+async def test_read_write_evict(disk_cache):
+    layer = make_layer()
+    view = layer.views["geo"]
+    tile = AffectedTile(1, 2, 3)
+    assert await disk_cache.read_tile(layer, "1", view, tile) is None
+    await disk_cache.write_tile(layer, "1", view, tile, b"tile")
+    assert await disk_cache.read_tile(layer, "1", view, tile) == b"tile"
+    # versions have their own files
+    assert await disk_cache.read_tile(layer, "2", view, tile) is None
+    await disk_cache.evict_tiles(layer, "1", view, [tile])
+    assert await disk_cache.read_tile(layer, "1", view, tile) is None
+
+
+@pytest.mark.asyncio
+async def test_tile_expiry(disk_cache, monkeypatch):
+    layer = make_layer()
+    view = replace(layer.views["geo"], cache_duration=60)
+    tile = AffectedTile(0, 0, 0)
+    await disk_cache.write_tile(layer, "1", view, tile, b"tile")
+    assert await disk_cache.read_tile(layer, "1", view, tile) == b"tile"
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert await disk_cache.read_tile(layer, "1", view, tile) is None
+
+
+@pytest.mark.asyncio
+async def test_open_files(disk_cache):
+    layer = make_layer()
+    view = layer.views["geo"]
+    tile = AffectedTile(0, 0, 0)
+    for version in ("1", "2", "3"):
+        await disk_cache.write_tile(layer, version, view, tile, version.encode())
+    # the least recently used file was closed, and is opened again when needed
+    assert len(disk_cache.connections) == 2
+    for version in ("1", "2", "3"):
+        assert await disk_cache.read_tile(layer, version, view, tile) == version.encode()
+    assert len(disk_cache.connections) == 2
+
+
+@pytest.mark.asyncio
+async def test_purge(tmp_path, monkeypatch):
+    disk_cache = DiskTileCache.setup(FastAPI(), str(tmp_path), 1 << 20, max_workers=1, max_size=64 * 1024)
+    await disk_cache.on_startup()
+    layer = make_layer()
+    view = replace(layer.views["geo"], cache_duration=60)
+    try:
+        await disk_cache.write_tile(layer, "1", view, AffectedTile(0, 0, 0), b"expired")
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 61)
+        tiles = [AffectedTile(x, y, 6) for x in range(16) for y in range(16)]
+        for tile in tiles:
+            await disk_cache.write_tile(layer, "1", view, tile, bytes(1024))
+        await disk_cache.purge()
+        # expired tiles are deleted, and the cache is brought under its maximum size
+        assert await disk_cache.read_tile(layer, "1", view, AffectedTile(0, 0, 0)) is None
+        kept_tiles = [tile for tile in tiles if await disk_cache.read_tile(layer, "1", view, tile) is not None]
+        assert 0 < len(kept_tiles) < 64
+    finally:
+        await disk_cache.on_shutdown()
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+
+from chartos.events import EventBroker, Subscription, publish_impacted_tiles
+from chartos.generations import cache_generations, get_cache_generation
+from chartos.redis import RedisPool
+
+from .test_config import make_layer
+
+
+@pytest.mark.asyncio
+async def test_subscription_overflow():
+    subscription = Subscription(2)
+    subscription.push("a")
+    subscription.push("b")
+    assert await subscription.get() == "a"
+    subscription.push("c")
+    # slow clients get a single reset event instead of the pending ones
+    subscription.push("d")
+    assert await subscription.get() is Subscription.RESET
+    assert subscription.queue.empty()
+    subscription.push("e")
+    assert await subscription.get() == "e"
+
+
+@pytest.mark.asyncio
+async def test_dispatch():
+    layer = make_layer()
+    broker = EventBroker.setup(FastAPI(), None, 4)
+    received = []
+    broker.listeners.append(received.append)
+    try:
+        with broker.subscribe(layer, "1") as subscription, broker.subscribe(layer, "2") as other_subscription:
+            event = json.dumps({"layer": layer.name, "version": "1", "impacted_tiles": {}, "generation": 3})
+            broker.dispatch(event)
+            # only the subscribers of the version get the event
+            assert await subscription.get() == event
+            assert other_subscription.queue.empty()
+            assert received == [json.loads(event)]
+            assert get_cache_generation(layer, "1") == 3
+        assert not broker.subscriptions
+    finally:
+        cache_generations.clear()
+
+
+@pytest.mark.asyncio
+async def test_publish(settings):
+    layer = make_layer()
+    redis_pool = RedisPool.setup(FastAPI(), settings.redis_urls())
+    broker = EventBroker.setup(FastAPI(), redis_pool, 4)
+    await broker.on_startup()
+    try:
+        with broker.subscribe(layer, "1") as subscription:
+            async with redis_pool.acquire() as redis:
+                # the listener subscribes in the background
+                while not await redis.pubsub_numpat():
+                    await asyncio.sleep(0.01)
+                await publish_impacted_tiles(redis, layer, "1", {"geo": [[0, 0, 0]]})
+            event = json.loads(await asyncio.wait_for(subscription.get(), 5))
+            assert event == {"layer": layer.name, "version": "1", "impacted_tiles": {"geo": [[0, 0, 0]]}}
+    finally:
+        await broker.on_shutdown()
+        await redis_pool.on_shutdown()
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chartos import export
+from chartos.export import PyramidExporter
+from chartos.layer_cache import AffectedTile
+from chartos.render_scheduler import RenderUnavailable
+
+from .test_config import make_layer
+
+
+@pytest.mark.asyncio
+async def test_export_retries(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_RETRY_DELAY", 0)
+    layer = make_layer()
+    redis_pool = SimpleNamespace(acquire=lambda: None)
+    exporter = PyramidExporter(None, None, redis_pool, None, None, layer, "1", layer.views["geo"])
+    attempts = []
+
+    async def load_tile(tile):
+        attempts.append(tile)
+        if len(attempts) < 3:
+            raise RenderUnavailable("too many pending tile renders", 5)
+        return b"tile"
+
+    async def broken_tile(tile):
+        raise ValueError("broken tile")
+
+    try:
+        # busy renders are tried again, instead of failing the whole export
+        assert await exporter.with_retries(load_tile, AffectedTile(0, 0, 0)) == b"tile"
+        assert len(attempts) == 3
+        with pytest.raises(ValueError):
+            await exporter.with_retries(broken_tile, AffectedTile(0, 0, 0))
+    finally:
+        exporter.cleanup()
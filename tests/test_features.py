@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from fastapi import HTTPException
+from shapely.geometry import mapping
+
+from chartos import features
+from chartos.archive import WEB_MERCATOR_MAX_LAT
+from chartos.features import parse_bbox, resolve_fields
+
+from .test_config import make_layer
+from .test_data import campus_sncf_gps
+
+
+def test_parse_bbox():
+    # web mercator can't represent the poles
+    assert parse_bbox("-180,-90,180,90") == [-180, -WEB_MERCATOR_MAX_LAT, 180, WEB_MERCATOR_MAX_LAT]
+    with pytest.raises(HTTPException):
+        parse_bbox("1,2,3")
+
+
+def test_resolve_fields():
+    layer = make_layer()
+    assert [field.name for field in resolve_fields(layer, "geo,id")] == ["geo", "id"]
+    with pytest.raises(HTTPException):
+        resolve_fields(layer, "geo,missing")
+
+
+@pytest.mark.asyncio
+async def test_features_pages(client, monkeypatch):
+    # features are read by many small pages
+    monkeypatch.setattr(features, "FETCH_PAGE_SIZE", 2)
+    geom = mapping(campus_sncf_gps)
+    rows = [{"entity_id": i, "geom_geo": geom, "components": {"index": i}} for i in range(5)]
+    response = await client.post("/push/osrd_track_section/insert/", params={"version": "1"}, json=rows)
+    assert response.status_code == 201
+
+    response = await client.get("/layer/osrd_track_section/features/", params={"version": "1"})
+    assert response.status_code == 200
+    collection = response.json()
+    assert [feature["id"] for feature in collection["features"]] == [0, 1, 2, 3, 4]
+    first = collection["features"][0]
+    assert first["properties"]["components"] == {"index": 0}
+    assert list(first["properties"]) == ["entity_id", "geom_sch", "geom_geo", "components"]
+
+    response = await client.get(
+        "/layer/osrd_track_section/features/",
+        params={"version": "1", "format": "ndjson", "fields": "entity_id", "after": "0", "limit": "3"},
+    )
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert [json.loads(line)["properties"] for line in lines] == [{"entity_id": i} for i in (1, 2, 3)]
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from chartos.generations import (
+    cache_generations,
+    check_cache_generation,
+    check_public_version,
+    generation_checks,
+    get_generation_key,
+    get_staging_version,
+    parse_generation_key,
+    read_cache_generation,
+    set_cache_generation,
+)
+from chartos.layer_cache import get_layer_cache_prefix
+from tests.test_config import make_layer
+
+
+def test_cache_generations():
+    layer = make_layer()
+    assert parse_generation_key(get_generation_key("osrd_signal", "v.1")) == ("osrd_signal", "v.1")
+    assert get_layer_cache_prefix(layer, "v.1") == "chartis.layer.osrd_signal.version_v.1"
+    try:
+        set_cache_generation("osrd_signal", "v.1", 2)
+        # generations never go back
+        set_cache_generation("osrd_signal", "v.1", 1)
+        assert get_layer_cache_prefix(layer, "v.1") == "chartis.layer.osrd_signal.generation_2.version_v.1"
+    finally:
+        cache_generations.clear()
+
+
+@pytest.mark.asyncio
+async def test_check_cache_generation():
+    layer = make_layer()
+    generations = {get_generation_key("osrd_signal", "v.1"): b"3"}
+    reads = []
+
+    async def get(key):
+        reads.append(key)
+        return generations.get(key)
+
+    redis = SimpleNamespace(primary=SimpleNamespace(get=get))
+    try:
+        # workers which missed the event of a publication find the generation in redis
+        await check_cache_generation(redis, layer, "v.1")
+        assert get_layer_cache_prefix(layer, "v.1") == "chartis.layer.osrd_signal.generation_3.version_v.1"
+        # and don't read it again right away
+        await check_cache_generation(redis, layer, "v.1")
+        assert len(reads) == 1
+    finally:
+        cache_generations.clear()
+        generation_checks.clear()
+
+
+@pytest.mark.asyncio
+async def test_read_cache_generation():
+    layer = make_layer()
+    generations = {}
+
+    async def get(key):
+        return generations.get(key)
+
+    redis = SimpleNamespace(primary=SimpleNamespace(get=get))
+    try:
+        await check_cache_generation(redis, layer, "v.1")
+        generations[get_generation_key("osrd_signal", "v.1")] = b"2"
+        # writers read the generation even when it was checked recently
+        assert await read_cache_generation(redis, layer, "v.1") == 2
+        assert get_layer_cache_prefix(layer, "v.1") == "chartis.layer.osrd_signal.generation_2.version_v.1"
+        assert await read_cache_generation(redis, make_layer(), "v.2") == 0
+    finally:
+        cache_generations.clear()
+        generation_checks.clear()
+
+
+def test_staging_versions_are_hidden():
+    check_public_version("v.1")
+    with pytest.raises(HTTPException) as error:
+        check_public_version(get_staging_version("v.1"))
+    assert error.value.status_code == 404
@@ -0,0 +1,25 @@
+from collections import Counter
+from chartos.utils import HashRing
+
+
+KEYS = [f"chartis.layer.osrd_signal.version_1.geo.tile/14/{x}/5632" for x in range(10000)]
+
+
+def test_hash_ring_balance():
+    ring = HashRing([(f"redis://node{i}", i) for i in range(4)])
+    counts = Counter(ring.get_node(key) for key in KEYS)
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > len(KEYS) / 4 * 0.7
+
+
+def test_hash_ring_stability():
+    nodes = [(f"redis://node{i}", i) for i in range(4)]
+    ring = HashRing(nodes)
+    # the order of nodes doesn't matter
+    reversed_ring = HashRing(nodes[::-1])
+    assert all(reversed_ring.get_node(key) == ring.get_node(key) for key in KEYS)
+    # adding a node only moves keys to the new node
+    bigger_ring = HashRing(nodes + [("redis://node4", 4)])
+    for key in KEYS:
+        new_node = bigger_ring.get_node(key)
+        assert new_node == 4 or new_node == ring.get_node(key)
@@ -0,0 +1,55 @@
+import pytest
+import yaml
+from shapely.geometry import mapping
+
+from chartos import get_env_settings
+
+from .test_data import campus_sncf_gps
+from .test_insert import MVTClient
+from .test_mvt import decode_tile
+
+
+PROJECTED_LAYER = {
+    "name": "projected",
+    "id_field_name": "id",
+    "fields": [
+        {"name": "id", "type": "string", "description": ""},
+        {"name": "geom", "type": "geom", "description": ""},
+        {"name": "components", "type": "json", "description": ""},
+    ],
+    "views": [{
+        "name": "geo",
+        "on_field": "geom",
+        "json_projections": [
+            {"path": "components.speed", "name": "speed", "type": "double"},
+            {"path": "components.count", "name": "count", "type": "int"},
+            {"path": "components.ok", "name": "ok", "type": "bool"},
+        ],
+    }],
+}
+
+
+@pytest.fixture
+def settings(tmp_path):
+    settings = get_env_settings()
+    config_path = tmp_path / "layer.yml"
+    config_path.write_text(yaml.safe_dump({"name": "test", "description": "", "layers": [PROJECTED_LAYER]}))
+    settings.config_path = str(config_path)
+    return settings
+
+
+@pytest.mark.asyncio
+async def test_malformed_projected_values(client):
+    mvt_client = await MVTClient.init(client, "projected", "1", "geo")
+    geom = mapping(campus_sncf_gps)
+    await mvt_client.insert([
+        {"id": "valid", "geom": geom, "components": {"speed": 1.5, "count": 3, "ok": True}},
+        # values of the wrong type, or out of range, don't fail the tile
+        {"id": "malformed", "geom": geom, "components": {"speed": "fast", "count": 1e12, "ok": "yes"}},
+    ])
+    [layer] = decode_tile(await mvt_client.get_tile(14, 8299, 5632))
+    properties = sorted((feature["properties"] for feature in layer["features"]), key=lambda p: p["id"])
+    assert properties == [
+        {"id": "malformed"},
+        {"id": "valid", "speed": 1.5, "count": 3, "ok": True},
+    ]
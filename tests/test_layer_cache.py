@@ -0,0 +1,66 @@
+from dataclasses import replace
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+
+from chartos.disk_cache import DiskTileCache
+from chartos.generations import cache_generations
+from chartos.layer_cache import (
+    AffectedTile,
+    drop_previous_cache_generation_later,
+    get_cache_tile_key,
+    get_view_cache_prefix,
+    invalidate_cache,
+    load_cached_tile,
+    store_cached_tile,
+    switch_cache_generation,
+)
+
+from .test_config import make_layer
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("block_bits", [None, 2])
+async def test_mark_stale(redis, monkeypatch, block_bits):
+    monkeypatch.setattr(redis, "tile_block_bits", block_bits)
+    layer = make_layer()
+    view = replace(layer.views["geo"], cache_duration=3600, max_stale=60)
+    layer.views["geo"] = view
+    view_prefix = get_view_cache_prefix(layer, "1", view)
+    tiles = [AffectedTile(x, 0, 3) for x in range(3)]
+    for tile in tiles:
+        await store_cached_tile(redis, view, view_prefix, tile, f"tile {tile.x}".encode())
+    assert await load_cached_tile(redis, view, view_prefix, tiles[0]) == (b"tile 0", False)
+
+    disk_cache = DiskTileCache.setup(FastAPI(), None, 0)
+    await invalidate_cache(redis, disk_cache, layer, "1", {view.on_field: set(tiles[:2])}, 0)
+    # invalidated tiles are still served, but stale, and the others stay fresh
+    assert await load_cached_tile(redis, view, view_prefix, tiles[0]) == (b"tile 0", True)
+    assert await load_cached_tile(redis, view, view_prefix, tiles[1]) == (b"tile 1", True)
+    assert await load_cached_tile(redis, view, view_prefix, tiles[2]) == (b"tile 2", False)
+    if block_bits is None:
+        # stale tiles expire after max_stale
+        cache_key = get_cache_tile_key(view_prefix, tiles[0])
+        assert 0 < await redis.shard_for(cache_key).ttl(cache_key) <= 60
+        cache_key = get_cache_tile_key(view_prefix, tiles[2])
+        assert await redis.shard_for(cache_key).ttl(cache_key) > 60
+
+
+@pytest.mark.asyncio
+async def test_switch_cache_generation(redis):
+    layer = make_layer()
+    view = layer.views["geo"]
+    disk_cache = DiskTileCache.setup(FastAPI(), None, 0)
+    redis_pool = SimpleNamespace(acquire=lambda: redis)
+    tile = AffectedTile(0, 0, 0)
+    try:
+        await store_cached_tile(redis, view, get_view_cache_prefix(layer, "1", view), tile, b"old")
+        generation = await switch_cache_generation(redis, disk_cache, layer, "1")
+        assert await load_cached_tile(redis, view, get_view_cache_prefix(layer, "1", view, 0), tile) == (None, False)
+        # a worker which didn't switch yet stores a tile in the previous generation
+        await store_cached_tile(redis, view, get_view_cache_prefix(layer, "1", view, 0), tile, b"late")
+        await drop_previous_cache_generation_later(redis_pool, disk_cache, layer, "1", generation, 0)
+        assert await load_cached_tile(redis, view, get_view_cache_prefix(layer, "1", view, 0), tile) == (None, False)
+    finally:
+        cache_generations.clear()
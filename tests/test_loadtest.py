@@ -0,0 +1,22 @@
+import random
+from chartos.loadtest.report import percentile
+from chartos.loadtest.scenarios import SCENARIOS
+from chartos.loadtest.traffic import PanningSession
+
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert percentile(values, 0.5) == 0.5
+    assert percentile(values, 0.99) == 0.99
+    assert percentile([1.], 0.99) == 1.
+
+
+def test_panning_session():
+    scenario = SCENARIOS["browse"]
+    session = PanningSession(random.Random(42), scenario.hotspots, scenario.zoom_weights)
+    for _, tiles in zip(range(1000), session):
+        assert tiles
+        for tile in tiles:
+            assert tile.z in scenario.zoom_weights
+            assert 0 <= tile.x < 2 ** tile.z
+            assert 0 <= tile.y < 2 ** tile.z
@@ -0,0 +1,79 @@
+import pyproj
+import pytest
+import yaml
+from shapely.geometry import Point, mapping
+from shapely.ops import transform
+
+from chartos import get_env_settings
+from chartos.layer_cache import AffectedTile, find_affected_tiles
+from chartos.memory_render import MemoryLayerStore
+from chartos.psql import PSQLPool
+from chartos.reload import read_config
+from chartos.render import mvt_query_with_count
+
+from .test_data import campus_sncf_gps
+from .test_mvt import decode_tile
+
+
+POINT_LAYER = {
+    "name": "memory_point",
+    "id_field_name": "id",
+    "render_in_memory": True,
+    "fields": [
+        {"name": "id", "type": "string", "description": ""},
+        {"name": "geom", "type": "point", "description": ""},
+        {"name": "speed", "type": "double", "description": ""},
+        {"name": "count", "type": "int", "description": ""},
+        {"name": "ok", "type": "bool", "description": ""},
+        {"name": "components", "type": "json", "description": ""},
+    ],
+    "views": [{"name": "geo", "on_field": "geom"}],
+}
+
+
+@pytest.fixture
+def settings(tmp_path):
+    settings = get_env_settings()
+    config_path = tmp_path / "layer.yml"
+    config_path.write_text(yaml.safe_dump({"name": "test", "description": "", "layers": [POINT_LAYER]}))
+    settings.config_path = str(config_path)
+    return settings
+
+
+@pytest.mark.asyncio
+async def test_memory_render(app, client, settings):
+    to_mercator = pyproj.Transformer.from_crs(4326, 3857, always_xy=True).transform
+    to_gps = pyproj.Transformer.from_crs(3857, 4326, always_xy=True).transform
+    center = transform(to_mercator, campus_sncf_gps)
+    # points spread over a few tiles, with all kinds of attribute values
+    points = [
+        transform(to_gps, Point(center.x + (i - 20) * 37.3, center.y + (i % 7 - 3) * 51.7))
+        for i in range(40)
+    ]
+    rows = [
+        {
+            "id": f"point_{i:02}",
+            "geom": mapping(point),
+            "speed": None if i % 5 == 0 else i * 1.25 - 10,
+            "count": i - 20,
+            "ok": i % 3 == 0,
+            "components": {"index": i},
+        }
+        for i, point in enumerate(points)
+    ]
+    response = await client.post("/push/memory_point/insert/", params={"version": "1"}, json=rows)
+    assert response.status_code == 201
+
+    layer = read_config(settings).layers["memory_point"]
+    view = layer.views["geo"]
+    memory_store = MemoryLayerStore.get_process(app)
+    tiles = {tile for point in points for tile in find_affected_tiles(18, point)}
+    # neighbor tiles have points in their buffer
+    tiles |= {AffectedTile(tile.x + 1, tile.y, tile.z) for tile in tiles}
+    async with PSQLPool.get_process(app).acquire() as psql:
+        for tile in tiles:
+            expected = await mvt_query_with_count(psql, layer, "1", view, tile.z, tile.x, tile.y)
+            rendered = await memory_store.render(layer, "1", view, tile, None)
+            # decoded tiles tell what differs, bytes also check the order of features and values
+            assert decode_tile(rendered[0]) == decode_tile(expected[0])
+            assert rendered == expected
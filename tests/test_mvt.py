@@ -0,0 +1,170 @@
+import struct
+from decimal import Decimal
+
+import pyproj
+from shapely.ops import transform
+
+from chartos.layer_cache import AffectedTile
+from chartos.memory_render import ViewSnapshot, float32_down, float32_up, index_box, tile_bounds
+from chartos.mvt import MVTLayerEncoder, encode_varint, mvt_point, zigzag
+
+from .test_data import campus_sncf_gps, ref_tiles
+
+
+def decode_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def decode_message(data):
+    """Decodes the fields of a protobuf message, in order"""
+    fields = []
+    pos = 0
+    while pos < len(data):
+        key, pos = decode_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        else:
+            size, pos = decode_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        fields.append((key >> 3, value))
+    return fields
+
+
+def decode_packed(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = decode_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_value(data):
+    [(field, value)] = decode_message(data)
+    if field == 1:
+        return value.decode()
+    if field == 3:
+        return struct.unpack("<d", value)[0]
+    if field == 5:
+        return value
+    if field == 6:
+        return unzigzag(value)
+    assert field == 7
+    return bool(value)
+
+
+def decode_tile(data):
+    """Decodes a tile into comparable layers, with the properties of each feature"""
+    layers = []
+    for tile_field, layer_data in decode_message(data):
+        assert tile_field == 3
+        layer_fields = decode_message(layer_data)
+        keys = [value.decode() for field, value in layer_fields if field == 3]
+        values = [decode_value(value) for field, value in layer_fields if field == 4]
+        features = []
+        for field, feature_data in layer_fields:
+            if field != 2:
+                continue
+            feature = dict(decode_message(feature_data))
+            tags = decode_packed(feature.get(2, b""))
+            features.append({
+                "type": feature[3],
+                "geometry": decode_packed(feature[4]),
+                "properties": {keys[key]: values[value] for key, value in zip(tags[::2], tags[1::2])},
+            })
+        layers.append({
+            "name": dict(layer_fields)[1].decode(),
+            "extent": dict(layer_fields)[5],
+            "version": dict(layer_fields)[15],
+            "keys": keys,
+            "features": features,
+        })
+    return layers
+
+
+def test_varints():
+    out = bytearray()
+    encode_varint(300, out)
+    assert out == b"\xac\x02"
+    assert [zigzag(value) for value in (0, -1, 1, -2, 2)] == [0, 1, 2, 3, 4]
+
+
+def test_mvt_point():
+    bounds = (0., 0., 4096., 4096.)
+    # y goes down in tile coordinates, and halves are rounded to even
+    assert mvt_point(25.4, 4096 - 17.5, bounds) == (25, 18)
+    assert mvt_point(-64.4, 100, bounds) == (-64, 3996)
+    assert mvt_point(-100, 100, bounds) is None
+
+
+def test_tile_bounds():
+    # TileBBox computes bounds in numeric, from a tile size rounded to 15 digits
+    assert tile_bounds(AffectedTile(0, 0, 0)) == (-20037508.34, -20037508.34, 20037508.34, 20037508.34)
+    tile_size = Decimal("2445.98490478516")
+    assert tile_bounds(AffectedTile(8299, 5632, 14))[0] == float(Decimal("-20037508.34") + 8299 * tile_size)
+
+
+def test_index_box():
+    assert float32_down(0.1) < 0.1 < float32_up(0.1)
+    assert float32_down(-0.1) < -0.1 < float32_up(-0.1)
+    assert float32_down(0.5) == 0.5 == float32_up(0.5)
+    min_x, _, max_x, _ = index_box((1.1, 0., 2.2, 0.))
+    assert min_x < 1.1 and max_x > 2.2
+
+
+def test_encode_point():
+    encoder = MVTLayerEncoder("layer", ["name", "empty", "speed", "count", "delta", "ok"])
+    encoder.add_point(25, 17, ("test", None, 1.5, 3, -3, True))
+    encoder.add_point(1, 1, ("test", None, None, None, None, False))
+    [layer] = decode_tile(encoder.encode())
+    assert layer["name"] == "layer" and layer["extent"] == 4096 and layer["version"] == 2
+    assert layer["keys"] == ["name", "empty", "speed", "count", "delta", "ok"]
+    first, second = layer["features"]
+    # the example of the specification
+    assert first == {
+        "type": 1,
+        "geometry": [9, 50, 34],
+        "properties": {"name": "test", "speed": 1.5, "count": 3, "delta": -3, "ok": True},
+    }
+    assert second["properties"] == {"name": "test", "ok": False}
+    assert MVTLayerEncoder("layer", []).encode() == b""
+
+
+def test_view_snapshot():
+    to_mercator = pyproj.Transformer.from_crs(4326, 3857, always_xy=True).transform
+    point = transform(to_mercator, campus_sncf_gps)
+    snapshot = ViewSnapshot("layer", "", ["id"], [(point.x, point.y)], [(1,)])
+    for x, y, z in ref_tiles:
+        tile_data, feature_count = snapshot.render(AffectedTile(x, y, z))
+        assert feature_count == 1
+        [layer] = decode_tile(tile_data)
+        assert layer["features"][0]["properties"] == {"id": 1}
+    assert snapshot.render(AffectedTile(8300, 5632, 14)) == (b"", 0)
+
+
+def test_view_snapshot_tile_edge():
+    tile = AffectedTile(8299, 5632, 14)
+    _, min_y, max_x, _ = tile_bounds(tile)
+    # like postgis, points whose single precision box touches the tile are rendered in the buffer,
+    # and points further away aren't, even if they are in the buffer
+    touching_x = float32_up(max_x)
+    assert touching_x > max_x
+    snapshot = ViewSnapshot("layer", "", ["id"], [(touching_x, min_y + 10), (max_x + 1, min_y + 10)], [(1,), (2,)])
+    tile_data, feature_count = snapshot.render(tile)
+    assert feature_count == 1
+    [layer] = decode_tile(tile_data)
+    assert [feature["properties"] for feature in layer["features"]] == [{"id": 1}]
@@ -0,0 +1,40 @@
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from chartos.modify import read_payload_batches
+
+
+def make_request(content_type: str, chunks):
+    messages = [{"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+
+    async def receive():
+        return messages.pop(0)
+
+    scope = {"type": "http", "method": "POST", "headers": [(b"content-type", content_type.encode())]}
+    return Request(scope, receive)
+
+
+async def read_batches(request, batch_size):
+    return [batch async for batch in read_payload_batches(request, batch_size)]
+
+
+@pytest.mark.asyncio
+async def test_ndjson_chunks():
+    body = b'{"id": 1, "name": "a"}\n\n{"id": 2, "name": "\xc3\xa9"}\n{"id": 3}'
+    # split everywhere, including inside rows and multibyte characters
+    chunks = [body[i:i + 5] for i in range(0, len(body), 5)]
+    request = make_request("application/x-ndjson; charset=utf-8", chunks)
+    assert await read_batches(request, 2) == [
+        [{"id": 1, "name": "a"}, {"id": 2, "name": "é"}],
+        [{"id": 3}],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_json_array():
+    request = make_request("application/json", [b'[{"id": 1},', b' {"id": 2}]'])
+    assert await read_batches(request, 1) == [[{"id": 1}], [{"id": 2}]]
+    with pytest.raises(HTTPException):
+        await read_batches(make_request("application/json", [b'{"id": 1}']), 1)
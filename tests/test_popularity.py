@@ -0,0 +1,46 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+
+from chartos import popularity
+from chartos.layer_cache import AffectedTile
+from chartos.popularity import PopularityTracker, get_popularity_key
+
+from .test_config import make_layer
+
+
+@pytest.mark.asyncio
+async def test_record_sampling(redis, monkeypatch):
+    layer = make_layer()
+    view = layer.views["geo"]
+    tracker = PopularityTracker.setup(FastAPI(), None, 0.5, 3600)
+    samples = iter([0.7, 0.2, 0.2, 0.2])
+    monkeypatch.setattr(random, "random", lambda: next(samples))
+    for tile in (AffectedTile(0, 0, 1), AffectedTile(0, 0, 1), AffectedTile(1, 0, 1), AffectedTile(1, 0, 1)):
+        await tracker.record(redis, layer, "1", view, tile)
+    # sampled accesses count for the accesses which weren't sampled
+    key = get_popularity_key(layer, "1", view)
+    assert 0 < await redis.primary.ttl(key) <= 8 * 3600
+    assert await redis.primary.zscore(key, "1/0/0") == 2
+    assert await redis.primary.zscore(key, "1/1/0") == 4
+    assert await tracker.most_popular(redis, layer, "1", view, 10) == [AffectedTile(1, 0, 1), AffectedTile(0, 0, 1)]
+
+
+@pytest.mark.asyncio
+async def test_decay(redis, monkeypatch):
+    layer = make_layer()
+    view = layer.views["geo"]
+    monkeypatch.setattr(popularity, "POPULARITY_MAX_TILES", 2)
+    redis_pool = SimpleNamespace(acquire=lambda: redis)
+    tracker = PopularityTracker.setup(FastAPI(), redis_pool, 1, 3600)
+    key = get_popularity_key(layer, "1", view)
+    await redis.primary.zadd(key, {"1/0/0": 1, "1/1/0": 4, "1/0/1": 8, "1/1/1": 16})
+    await tracker.decay()
+    # scores are halved, tiles under 1 are dropped, and only the most popular ones are kept
+    assert await redis.primary.zrange(key, 0, -1, withscores=True) == [(b"1/0/1", 4), (b"1/1/1", 8)]
+    assert await redis.primary.ttl(key) > 0
+    # the next decay waits for the end of the half life
+    await tracker.decay()
+    assert await redis.primary.zrange(key, 0, -1, withscores=True) == [(b"1/0/1", 4), (b"1/1/1", 8)]
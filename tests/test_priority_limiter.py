@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from chartos.utils import PriorityLimiter, QueueFull
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_order():
+    limiter = PriorityLimiter(1, 10)
+    started = []
+
+    async def task(priority):
+        async with limiter.slot(priority):
+            started.append(priority)
+            await asyncio.sleep(0)
+
+    await limiter.acquire(0)
+    tasks = [asyncio.create_task(task(priority)) for priority in (12, 3, 18, 0)]
+    await asyncio.sleep(0)
+    assert limiter.queued == 4
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert started == [0, 3, 12, 18]
+    assert limiter.running == 0
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_queue_full():
+    limiter = PriorityLimiter(1, 1)
+    await limiter.acquire(0)
+    waiter = asyncio.create_task(limiter.acquire(5))
+    await asyncio.sleep(0)
+    with pytest.raises(QueueFull):
+        await limiter.acquire(1)
+
+    # cancelled waiters leave the queue
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.queued == 0
+    limiter.release()
+    assert limiter.running == 0
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_set_concurrency():
+    limiter = PriorityLimiter(1, 10)
+    await limiter.acquire(0)
+    waiters = [asyncio.create_task(limiter.acquire(0)) for _ in range(3)]
+    await asyncio.sleep(0)
+    limiter.set_concurrency(3)
+    await asyncio.sleep(0)
+    assert limiter.running == 3 and limiter.queued == 1
+    # slots above the lowered concurrency are dropped instead of being handed over
+    limiter.set_concurrency(1)
+    limiter.release()
+    limiter.release()
+    assert limiter.running == 1 and limiter.queued == 1
+    limiter.release()
+    await asyncio.gather(*waiters)
+    assert limiter.running == 1
@@ -0,0 +1,53 @@
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from chartos import render
+from chartos.layer_cache import AffectedTile, get_write_position_key
+from chartos.render import render_tile
+
+from .test_config import make_layer
+
+
+@pytest.mark.asyncio
+async def test_write_position_after_slot(monkeypatch):
+    layer = make_layer()
+    events = []
+
+    @asynccontextmanager
+    async def slot(priority, background):
+        events.append("slot")
+        yield
+
+    @asynccontextmanager
+    async def statement_timeout(psql):
+        yield psql
+
+    @asynccontextmanager
+    async def acquire():
+        yield None
+
+    async def get(key):
+        events.append(f"get {key}")
+        return b"0/1"
+
+    async def is_caught_up(psql, write_position):
+        events.append(f"is_caught_up {write_position.decode()}")
+        return True
+
+    async def mvt_query_with_count(psql, layer, version, view, z, x, y):
+        return b"tile", 1
+
+    def record_tile_stats(*args):
+        pass
+
+    monkeypatch.setattr(render, "mvt_query_with_count", mvt_query_with_count)
+    monkeypatch.setattr(render, "record_tile_stats", record_tile_stats)
+    scheduler = SimpleNamespace(slot=slot, statement_timeout=statement_timeout)
+    read_pool = SimpleNamespace(has_replicas=True, acquire=acquire, is_caught_up=is_caught_up)
+    redis = SimpleNamespace(get=get)
+    tile_data = await render_tile(read_pool, scheduler, redis, layer, "1", layer.views["geo"], AffectedTile(0, 0, 0))
+    assert tile_data == b"tile"
+    # writes made while the render waits for its slot are checked
+    assert events == ["slot", f"get {get_write_position_key(layer, '1')}", "is_caught_up 0/1"]
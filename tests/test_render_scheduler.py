@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+
+from chartos.render_scheduler import RenderScheduler, RenderUnavailable
+
+
+@pytest.mark.asyncio
+async def test_background_slots():
+    scheduler = RenderScheduler.setup(FastAPI(), 1, 2, 0, 5, background_concurrency=1, background_queue_size=1)
+    started = []
+
+    async def render(name, background):
+        async with scheduler.slot(0, background):
+            started.append(name)
+
+    await scheduler.limiter.acquire(0)
+    background_renders = [asyncio.create_task(render(f"background {i}", True)) for i in range(2)]
+    await asyncio.sleep(0)
+    # a single background render takes a place in the queue of user renders
+    assert scheduler.limiter.queued == 1
+    assert scheduler.background_limiter.queued == 1
+    user_render = asyncio.create_task(render("user", False))
+    await asyncio.sleep(0)
+    with pytest.raises(RenderUnavailable):
+        await render("rejected", True)
+
+    scheduler.limiter.release()
+    await asyncio.gather(user_render, *background_renders)
+    assert started == ["background 0", "user", "background 1"]
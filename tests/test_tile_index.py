@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+from shapely.geometry import LineString
+
+from chartos.config import Layer
+from chartos.dbinit import schema_objects
+from chartos.layer_cache import AffectedTile, find_affected_tiles
+from chartos.tile_index import (
+    find_indexed_affected_tiles,
+    find_indexed_tiles,
+    get_quadkey,
+    get_quadkey_range,
+    get_quadkey_tile,
+)
+from chartos.serialized_config import SerializedLayer
+
+
+def test_quadkeys():
+    assert get_quadkey(0b11, 0b01) == 0b0111
+    assert get_quadkey_tile(get_quadkey(1234, 5678), 13) == AffectedTile(1234, 5678, 13)
+    # descendants at the index zoom are a contiguous range
+    start, end = get_quadkey_range(AffectedTile(3, 2, 2), 4)
+    assert end - start == 16
+    assert all(start <= get_quadkey(x, y) < end for x in range(12, 16) for y in range(8, 12))
+    # the index is coarser than the tile
+    assert get_quadkey_range(AffectedTile(12, 8, 4), 2) == (get_quadkey(3, 2), get_quadkey(3, 2) + 1)
+
+
+def test_indexed_affected_tiles():
+    geom = LineString([(2.29, 48.85), (2.40, 48.87)])
+    expected = set(find_affected_tiles(14, geom))
+    tiles, quadkeys = find_indexed_tiles(14, 10, geom)
+    assert set(tiles) == expected
+    assert set(find_indexed_affected_tiles(14, geom, quadkeys, 10)) == expected
+    # the index is deeper than the maximum zoom
+    tiles, quadkeys = find_indexed_tiles(8, 10, geom)
+    assert set(find_indexed_affected_tiles(8, geom, quadkeys, 10)) == set(tiles)
+
+
+def test_tile_index_migration():
+    def tile_index_object(tile_index_zoom):
+        layer = Layer.parse(SerializedLayer.parse_obj({
+            "name": "indexed",
+            "id_field_name": "id",
+            "tile_index_zoom": tile_index_zoom,
+            "fields": [
+                {"name": "id", "type": "string", "description": ""},
+                {"name": "geo", "type": "geom", "description": ""},
+            ],
+            "views": [{"name": "geo", "on_field": "geo"}],
+        }))
+        objects = {obj.name: obj for obj in schema_objects(SimpleNamespace(layers={layer.name: layer}))}
+        # the index is filled from the layer table, once it and the quadkey function exist
+        assert objects["tile_index:indexed"].stage > objects["layer:indexed"].stage
+        assert objects["tile_index:indexed"].stage > objects["function:TileQuadkey"].stage
+        return objects["tile_index:indexed"]
+
+    index_object = tile_index_object(10)
+    assert any("TileBBox(10, tile_x::int, tile_y::int, 4326)" in statement for statement in index_object.statements)
+    # changing the zoom rebuilds the index
+    assert tile_index_object(12).fingerprint != index_object.fingerprint
@@ -0,0 +1,118 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+
+from chartos import tile_refresher
+from chartos.disk_cache import DiskTileCache
+from chartos.layer_cache import (
+    AffectedTile,
+    get_cache_tile_key,
+    get_refresh_lock_key,
+    get_view_cache_prefix,
+    load_cached_tile,
+)
+from chartos.popularity import PopularityTracker
+from chartos.tile_refresher import TileRefresher
+
+from .test_config import make_layer
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Renders tiles once unblocked, keeping track of the renders running at the same time"""
+    renders = SimpleNamespace(tiles=[], background=[], running=0, max_running=0, unblock=asyncio.Event())
+
+    async def render_tile(
+            read_pool, scheduler, redis, layer, version, view, tile, priority=None, memory_store=None, background=False,
+    ):
+        renders.tiles.append(tile)
+        renders.background.append(background)
+        renders.running += 1
+        renders.max_running = max(renders.max_running, renders.running)
+        try:
+            await renders.unblock.wait()
+        finally:
+            renders.running -= 1
+        return f"tile {tile.x}".encode()
+
+    monkeypatch.setattr(tile_refresher, "render_tile", render_tile)
+    return renders
+
+
+async def make_refresher(redis, regeneration_count=0, regeneration_concurrency=1):
+    redis_pool = SimpleNamespace(acquire=lambda: redis)
+    popularity = PopularityTracker.setup(FastAPI(), redis_pool, 1, 3600)
+    refresher = TileRefresher.setup(
+        FastAPI(), None, SimpleNamespace(timeout=10), redis_pool, DiskTileCache.setup(FastAPI(), None, 0),
+        popularity, None, regeneration_count, regeneration_concurrency,
+    )
+    await refresher.on_startup()
+    return refresher
+
+
+async def wait_renders(renders, count):
+    async def poll():
+        while len(renders.tiles) < count:
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), 5)
+
+
+async def wait_tasks(refresher):
+    while refresher.tasks:
+        await asyncio.gather(*refresher.tasks)
+
+
+@pytest.mark.asyncio
+async def test_refresh_lock(redis, renders):
+    layer = make_layer()
+    view = layer.views["geo"]
+    view_prefix = get_view_cache_prefix(layer, "1", view)
+    tile = AffectedTile(1, 0, 1)
+    refresher = await make_refresher(redis)
+    cache_key = get_cache_tile_key(view_prefix, tile)
+    lock_key = get_refresh_lock_key(cache_key)
+    try:
+        # concurrent refreshes of a tile only render it once
+        await asyncio.gather(*(refresher.refresh(redis, layer, "1", view, tile) for _ in range(3)))
+        await wait_renders(renders, 1)
+        assert renders.tiles == [tile]
+        # locks are stored next to their tile
+        assert await redis.shard_for(cache_key).exists(lock_key)
+        renders.unblock.set()
+        await wait_tasks(refresher)
+    finally:
+        await refresher.on_shutdown()
+    assert await load_cached_tile(redis, view, view_prefix, tile) == (b"tile 1", False)
+    # the lock is released once the tile is stored
+    assert not await redis.shard_for(cache_key).exists(lock_key)
+
+
+@pytest.mark.asyncio
+async def test_regenerate_popular(redis, renders):
+    layer = make_layer()
+    view = layer.views["geo"]
+    view_prefix = get_view_cache_prefix(layer, "1", view)
+    refresher = await make_refresher(redis, regeneration_count=3, regeneration_concurrency=1)
+    tiles = [AffectedTile(x, 0, 2) for x in range(5)]
+    for tile, accesses in zip(tiles, (1, 3, 2, 5, 8)):
+        for _ in range(accesses):
+            await refresher.popularity.record(redis, layer, "1", view, tile)
+    # some other worker is refreshing the most popular of the invalidated tiles
+    locked_key = get_cache_tile_key(view_prefix, tiles[3])
+    await redis.shard_for(locked_key).set(get_refresh_lock_key(locked_key), b"")
+    try:
+        # the last tile wasn't invalidated, and the least popular one is outside of the regeneration count
+        refresher.regenerate_popular(layer, "1", {view.on_field: set(tiles[:4])})
+        await wait_renders(renders, 1)
+        await asyncio.sleep(0.05)
+        # tiles are regenerated one at a time, by decreasing popularity
+        assert renders.tiles == [tiles[1]]
+        renders.unblock.set()
+        await wait_tasks(refresher)
+    finally:
+        await refresher.on_shutdown()
+    assert renders.tiles == [tiles[1], tiles[2]]
+    assert renders.max_running == 1
+    assert renders.background == [True, True]
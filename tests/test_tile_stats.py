@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+
+from chartos.config import Config
+from chartos.layer_cache import AffectedTile
+from chartos.tile_stats import TileStatsFlusher, flush_tile_stats, record_tile_stats, stats_buffer, tile_stats
+
+from .test_config import make_layer
+
+
+@pytest.mark.asyncio
+async def test_tile_stats(redis, settings):
+    layer = make_layer()
+    view = layer.views["geo"]
+    stats_buffer.clear()
+    # renders are buffered, and sent to redis together
+    record_tile_stats(layer, "1", view, AffectedTile(1, 2, 3), 100, 10, 0.002)
+    record_tile_stats(layer, "1", view, AffectedTile(1, 2, 3), 300, 30, 0.004)
+    record_tile_stats(layer, "1", view, AffectedTile(4, 5, 3), 3000, 3, 0.001)
+    record_tile_stats(layer, "1", view, AffectedTile(0, 0, 0), 10, 1, 0.001)
+    await flush_tile_stats(redis)
+    assert not stats_buffer
+    # later flushes don't lower the highest value of a tile
+    record_tile_stats(layer, "1", view, AffectedTile(1, 2, 3), 200, 20, 0.001)
+    await flush_tile_stats(redis)
+
+    config = Config("test", "", {layer.name: layer})
+    stats = (await tile_stats(layer.name, view.name, "1", 1, config, settings, redis))["zooms"]
+    assert list(stats) == [0, 3]
+    zoom_stats = stats[3]
+    assert zoom_stats["renders"] == 4
+    assert zoom_stats["size"]["mean"] == pytest.approx(3600 / 4)
+    assert zoom_stats["size"]["top"] == [{"x": 4, "y": 5, "value": 3000}]
+    # tiles rendered many times keep their highest value
+    assert zoom_stats["features"]["top"] == [{"x": 1, "y": 2, "value": 30}]
+    assert zoom_stats["features"]["histogram"] == {2: 1, 8: 1, 16: 2}
+    assert stats[0]["render_time"]["histogram"] == {1: 1}
+
+
+@pytest.mark.asyncio
+async def test_failed_flush():
+    layer = make_layer()
+    view = layer.views["geo"]
+    stats_buffer.clear()
+    record_tile_stats(layer, "1", view, AffectedTile(0, 0, 0), 10, 1, 0.001)
+
+    def group_by_shard(keys):
+        raise ConnectionError("redis is down")
+
+    # stats are best effort, and failing to send them doesn't fail anything else
+    redis = SimpleNamespace(group_by_shard=group_by_shard)
+    flusher = TileStatsFlusher.setup(FastAPI(), SimpleNamespace(acquire=lambda: redis))
+    await flusher.flush()
+    assert not stats_buffer
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from chartos.tracing import Trace, current_trace, span, untraced
+
+
+def test_spans():
+    # spans are only recorded inside a trace
+    with span("ignored"):
+        pass
+
+    trace = Trace("GET /tile")
+    token = current_trace.set(trace)
+    try:
+        with span("render"):
+            with span("mvt_query"):
+                pass
+        with span("redis.store_tile"):
+            pass
+    finally:
+        current_trace.reset(token)
+
+    assert [(s.name, s.parent_id) for s in trace.spans] == [
+        ("render", None),
+        ("mvt_query", 0),
+        ("redis.store_tile", None),
+    ]
+    assert trace.spans[0].duration >= trace.spans[1].duration
+    server_timing = trace.server_timing()
+    assert server_timing.startswith("render;dur=")
+    assert "total;dur=" in server_timing
+
+
+@pytest.mark.asyncio
+async def test_untraced_tasks():
+    async def background():
+        with span("background"):
+            return current_trace.get()
+
+    trace = Trace("GET /tile")
+    token = current_trace.set(trace)
+    try:
+        with span("render"):
+            assert await asyncio.create_task(untraced(background())) is None
+    finally:
+        current_trace.reset(token)
+    assert [s.name for s in trace.spans] == ["render"]